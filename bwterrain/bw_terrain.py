@@ -1,6 +1,8 @@
 from dataclasses import dataclass
 from struct import pack, unpack, unpack_from, Struct
-from .vectors import Triangle, Vector3, Quad, Line
+from .vectors import Triangle, Vector3, Line
+from .heightfield import HeightfieldRaycaster
+import numpy
 from numpy import array
 from math import inf
 from timeit import default_timer
@@ -70,165 +72,6 @@ class Vertex:
     uv2: UVPoint
 
 
-# 11 12
-# 13 14
-
-# 21 22
-# 23 24
-
-
-class AABB(object):
-    def __init__(self, min: Vector3, max: Vector3):
-        self.min = min
-        self.max = max
-        self.middle = (self.min + self.max)*0.5
-        self.quads = []
-
-        corner11 = Vector3(min.x, max.y, min.z)
-        corner12 = Vector3(max.x, max.y, min.z)
-        corner13 = Vector3(min.x, max.y, max.z)
-        corner14 = Vector3(max.x, max.y, max.z)
-
-        corner21 = Vector3(min.x, min.y, min.z)
-        corner22 = Vector3(max.x, min.y, min.z)
-        corner23 = Vector3(min.x, min.y, max.z)
-        corner24 = Vector3(max.x, min.y, max.z)
-
-        # Top
-        self.quads.append(Quad(corner11, corner12, corner13, corner14))
-
-        # Sides
-        self.quads.append(Quad(corner13, corner14, corner23, corner24))
-        self.quads.append(Quad(corner11, corner13, corner21, corner23))
-        self.quads.append(Quad(corner12, corner11, corner22, corner21))
-        self.quads.append(Quad(corner14, corner12, corner24, corner22))
-
-        # Bottom
-        self.quads.append(Quad(corner21, corner22, corner23, corner24))
-
-    def ray_hits_box(self, line: Line, d_filter=inf):
-        for quad in self.quads:
-            result = line.collide_quad(quad, d_filter)
-            if result is not False:
-                return True
-        return False
-
-    @classmethod
-    def from_aabb_list(cls, aabbs: list["AABB"]):
-        min_vec = Vector3(inf, inf, inf)
-        max_vec = Vector3(-inf, -inf, -inf)
-
-        for aabb in aabbs:
-            if aabb.min.x < min_vec.x:
-                min_vec.x = aabb.min.x
-
-            if aabb.min.y < min_vec.y:
-                min_vec.y = aabb.min.y
-
-            if aabb.min.z < min_vec.z:
-                min_vec.z = aabb.min.z
-
-            if aabb.max.x > max_vec.x:
-                max_vec.x = aabb.max.x
-
-            if aabb.max.y > max_vec.y:
-                max_vec.y = aabb.max.y
-
-            if aabb.max.z > max_vec.z:
-                max_vec.z = aabb.max.z
-
-        return cls(min_vec, max_vec)
-
-
-class TileModel(object):
-    def __init__(self, tile, materials, offsetx, offsety):
-        self.vertices = []
-        self.quads = []
-        self.material = materials[tile.material_index]
-        self.quads_collision = []
-
-        br = tile.surface_coordinates[0]
-        bl = tile.surface_coordinates[1]
-        tr = tile.surface_coordinates[2]
-        tl = tile.surface_coordinates[3]
-
-        aabb_max = Vector3(-inf, -inf, -inf)
-        aabb_min = Vector3(inf, inf, inf)
-
-
-        for y in range(4):
-            for x in range(4):
-                fx = x/3.0
-                fy = y/3.0
-                u = fy*(fx*tl.x + (1-fx)*tr.x) + (1-fy)*(fx*bl.x + (1-fx)*br.x)
-                v = fy*(fx*tl.y + (1-fx)*tr.y) + (1-fy)*(fx*bl.y + (1-fx)*br.y)
-
-                index = 4*y + x
-                height = tile.heights[index]/16.0
-                position = array([(x+offsetx)*4*(4/3)-2048, height, (y+offsety)*4*(4/3)-2048])
-                uv1 = UVPoint(u, v)
-                uv2 = tile.detail_coordinates[index]
-                color = tile.vertex_colors[index]
-
-                self.vertices.append(Vertex(position, color, uv1, uv2))
-
-                if x < 3 and y < 3:
-                    indexr = 4*y + x+1
-                    indexb = 4*(y+1) + x
-                    indexbr = 4*(y+1) + x+1
-
-                    self.quads.append((index, indexr, indexbr, indexb))
-
-        v1 = Vector3(*self.vertices[0].pos)
-        v2 = Vector3(*self.vertices[3].pos)
-        v3 = Vector3(*self.vertices[3*4+0].pos)
-        v4 = Vector3(*self.vertices[3*4+3].pos)
-        self.lod_quad = Quad(v1, v2, v3, v4)
-
-        for v1i, v2i, v4i, v3i in self.quads:
-            v1 = Vector3(*self.vertices[v1i].pos)
-            v2 = Vector3(*self.vertices[v2i].pos)
-            v3 = Vector3(*self.vertices[v3i].pos)
-            v4 = Vector3(*self.vertices[v4i].pos)
-            quad = Quad(v1, v2, v3, v4)
-            self.quads_collision.append(quad)
-
-            aabb_min.x = min(aabb_min.x, v1.x, v2.x, v3.x, v4.x)
-            aabb_min.y = min(aabb_min.y, v1.y, v2.y, v3.y, v4.y)
-            aabb_min.z = min(aabb_min.z, v1.z, v2.z, v3.z, v4.z)
-            aabb_max.x = max(aabb_max.x, v1.x, v2.x, v3.x, v4.x)
-            aabb_max.y = max(aabb_max.y, v1.y, v2.y, v3.y, v4.y)
-            aabb_max.z = max(aabb_max.z, v1.z, v2.z, v3.z, v4.z)
-
-        self.aabb = AABB(aabb_min, aabb_max)
-
-    def ray_collide(self, line: Line, d_filter=inf):
-        hit = self.aabb.ray_hits_box(line, d_filter)
-
-        if hit:
-            aabb_dist = (line.origin - self.aabb.middle).norm_nosqrt()
-
-            if aabb_dist > 350**2:
-                quads = [self.lod_quad]
-            else:
-                quads = self.quads_collision
-
-            dist = d_filter
-            point = None
-            for quad in quads:#self.quads_collision:
-                result = line.collide_quad(quad, dist)
-                if result is not False:
-                    p, d = result
-                    if d < dist:
-                        dist = d
-                        point = p
-            if point is not None:
-                return point, dist
-            else:
-                return False
-        else:
-            return False
-
 @dataclass
 class TileVertex:
     height: int 
@@ -343,77 +186,19 @@ class MapChunkReference:
         return cls(*unpack_from(">BBH", array, i*4))
 
 
-class AABBGroup(object):
-    def __init__(self, items: list[TileModel] | list["AABBGroup"]):
-        self.items = items
-        self.aabb = AABB.from_aabb_list([item.aabb for item in items])
-
-    def subdivide(self, levels=1):
-        if levels > 0 and len(self.items) > 0:
-            middle = self.aabb.middle
-
-            # group2 group3
-            # group1 group4
-            group1 = []
-            group2 = []
-            group3 = []
-            group4 = []
-
-            for item in self.items:
-                item_middle = item.aabb.middle
-                if item_middle.x <= middle.x:
-                    if item_middle.z <= middle.z:
-                        group1.append(item)  # -x -z
-                    else:
-                        group4.append(item)  # +x -z
-                else:
-                    if item_middle.z <= middle.z:
-                        group2.append(item)  # -x -z
-                    else:
-                        group3.append(item)  # -x +z
-
-            aabbgroup1 = AABBGroup(group1)
-            aabbgroup2 = AABBGroup(group2)
-            aabbgroup3 = AABBGroup(group3)
-            aabbgroup4 = AABBGroup(group4)
-
-            aabbgroup1.subdivide(levels - 1)
-            aabbgroup2.subdivide(levels - 1)
-            aabbgroup3.subdivide(levels - 1)
-            aabbgroup4.subdivide(levels - 1)
-
-            self.items = [aabbgroup1, aabbgroup2, aabbgroup3, aabbgroup4]
-
-    def ray_collide(self, line: Line, d_filter=inf, sort_level=0):
-        if self.aabb.ray_hits_box(line, d_filter):
-            point, dist = None, d_filter
-
-            sorted_items = []
-
-            if sort_level < 3:
-                for item in self.items:
-                    item_dist = (item.aabb.middle - line.origin).norm_nosqrt()
-                    sorted_items.append((item, item_dist))
-                sorted_items.sort(key=lambda x: x[1])
-            else:
-                sorted_items.extend(self.items)
-
-            for item, itemdist in sorted_items:
-                result = item.ray_collide(line, dist)
-
-                if result is not False:
-                    p, d = result
-                    if d < dist:
-                        dist = d
-                        point = p
-
-            if point is not None:
-                return point, dist
-            else:
-                return False
-        else:
-            return False
-            
+# Same layouts as Tile, Chunk and MapChunkReference, for viewing whole sections at once
+TILE_DTYPE = numpy.dtype([
+    ("heights", ">u2", (16,)),
+    ("vertex_colors", "u1", (16, 4)),
+    ("surface_coordinates", ">u2", (4, 2)),
+    ("detail_coordinates", ">u2", (16, 2)),
+    ("material_index", ">u4")
+])
+assert TILE_DTYPE.itemsize == Tile.size
+
+CHUNK_DTYPE = numpy.dtype([("tiles", TILE_DTYPE, (16,))])
+MAP_DTYPE = numpy.dtype([("a", "u1"), ("b", "u1"), ("chunkindex", ">u2")])
+
 
 class Timer(object):
     def __init__(self):
@@ -429,72 +214,109 @@ class Timer(object):
 class BWTerrainV2(BWSectionedFile):
     def __init__(self, f):
         super().__init__(f)
-        timer = Timer()
         #width, height, unk1, unk2 = unpack("IIII", self.sections[b"RRET"])
         self.terrain_data = TerrainData.from_section(self.sections[b"RRET"])
-        self.chunks = initiate_from_section(Chunk, self.sections[b"KNHC"])
-        self.map = initiate_from_section(MapChunkReference, self.sections[b"PAMC"])
+        self.chunks = numpy.frombuffer(self.sections[b"KNHC"], dtype=CHUNK_DTYPE)
+        self.map = numpy.frombuffer(self.sections[b"PAMC"], dtype=MAP_DTYPE)
         self.materials = initiate_from_section(MapMaterial, self.sections[b"LTAM"])
 
         assert self.terrain_data.chunks_x == self.terrain_data.chunks_y == 64
 
-        self.pointdata = [[None for y in range(self.terrain_data.chunks_y * 16 + 1)] for x in range(self.terrain_data.chunks_y * 16 + 1)]
-        self.material_map = [[None for y in range(self.terrain_data.chunks_y * 4 + 1)] for x in range(self.terrain_data.chunks_y * 4 + 1)]
-        self.grids = []
-        chunk_group = []
-        
-        print("Initialized in", timer.passed())
-        
-        self.meshes: dict[TileModel] = {}
-        for chunkx in range(64):
-            for chunky in range(64):
-                mapchunk = self.map[chunky*64 + chunkx]
-                if mapchunk.b == 1:
-                    chunk = self.chunks[mapchunk.chunkindex]
-
-                    chunk_tiles = []
-
-                    for tilex in range(4):
-                        for tiley in range(4):
-                            tile = chunk.tiles[tiley*4+tilex]
-
-                            if tile.material_index not in self.meshes:
-                                self.meshes[tile.material_index] = []
-                            
-                            self.material_map[chunkx*4+tilex][chunky*4+tiley] = tile.material_index
-                            for x in range(4):
-                                for y in range(4):
-                                    index = y*4 + x
-                                    self.pointdata[chunkx*16 + tilex*4 + x][chunky*16+tiley*4+y] = tile.get_vertex(x,y)
-
-                            #tilemodel = TileModel(tile, self.materials, chunkx*16 + tilex*4 - tilex -chunkx*4, chunky*16 + tiley*4 - tiley - chunky*4)
-                            #self.meshes[tile.material_index].append(tilemodel)
-                            #chunk_tiles.append(tilemodel)
-                            #chunk_group.append(tilemodel)
-            print(f"Row {chunkx} done in {timer.passed()}")
-            #self.chunk_group = AABBGroup(chunk_group)
-            #self.chunk_group.subdivide(5)
+        # Chunk map is stored y-major, the grids below are indexed [x][y]
+        chunkmap = self.map.reshape(self.terrain_data.chunks_y, self.terrain_data.chunks_x).T
+        self.chunk_exists = chunkmap["b"] == 1
+        tiles = self.chunks["tiles"][chunkmap["chunkindex"][self.chunk_exists]]
+
+        self.heights = self._to_point_grid(tiles["heights"]/16.0, numpy.nan)
+        self.point_exists = ~numpy.isnan(self.heights)
+        self.colors = self._to_point_grid(tiles["vertex_colors"]/255.0, 0.0)
+        self.uv_detail = self._to_point_grid(tiles["detail_coordinates"]/4096.0, 0.0)
+
+        surface = tiles["surface_coordinates"]/4096.0
+        br = surface[:, :, 0:1]
+        bl = surface[:, :, 1:2]
+        tr = surface[:, :, 2:3]
+        tl = surface[:, :, 3:4]
+        fx = (numpy.arange(16) % 4/3.0).reshape(16, 1)
+        fy = (numpy.arange(16)//4/3.0).reshape(16, 1)
+        uv_main = fy*(fx*tl + (1-fx)*tr) + (1-fy)*(fx*bl + (1-fx)*br)
+        self.uv_main = self._to_point_grid(uv_main, 0.0)
+
+        materials = numpy.full((64, 64, 4, 4), -1, dtype=numpy.int32)
+        materials[self.chunk_exists] = tiles["material_index"].reshape(-1, 4, 4)
+        self.material_map = numpy.full((64*4+1, 64*4+1), -1, dtype=numpy.int32)
+        # chunkx, chunky, tiley, tilex -> chunkx, tilex, chunky, tiley
+        self.material_map[:-1, :-1] = materials.transpose(0, 3, 1, 2).reshape(64*4, 64*4)
+
+        self.raycaster = None
+
+    def _to_point_grid(self, values, fill):
+        # values: (existing chunks, 16 tiles, 16 points, ...) -> (1025, 1025, ...) indexed [x][y]
+        extra = values.shape[3:]
+        dense = numpy.full((64, 64) + values.shape[1:], fill, dtype=numpy.float32)
+        dense[self.chunk_exists] = values
+        dense = dense.reshape((64, 64, 4, 4, 4, 4) + extra)
+        # chunkx, chunky, tiley, tilex, y, x -> chunkx, tilex, x, chunky, tiley, y
+        order = (0, 3, 5, 1, 2, 4) + tuple(range(6, 6 + len(extra)))
+        grid = numpy.full((64*16+1, 64*16+1) + extra, fill, dtype=numpy.float32)
+        grid[:-1, :-1] = dense.transpose(order).reshape((64*16, 64*16) + extra)
+        return grid
+
+    def get_vertex(self, x, y):
+        if not self.point_exists[x, y]:
+            return None
+
+        return TileVertex(float(self.heights[x, y]),
+                          Color(*(float(c) for c in self.colors[x, y])),
+                          UVPoint(*(float(c) for c in self.uv_main[x, y])),
+                          UVPoint(*(float(c) for c in self.uv_detail[x, y])))
 
     def check_height(self, x, y):
         mapx = int((x + 2048)*0.25)
         mapy = int((y + 2048)*0.25)
         if 0 <= mapx < 1024 and 0 <= mapy < 1024:
-            if self.pointdata[mapx][mapy] is None:
-                return None
-            return self.pointdata[mapx][mapy]
+            return self.get_vertex(mapx, mapy)
         else:
             return None
 
-    def ray_collide(self, line: Line):
-        point, dist = None, inf
-        result = self.chunk_group.ray_collide(line)
-        if result is not False:
-            p, d = result
-            dist = d
-            point = p
+    def get_raycaster(self):
+        if self.raycaster is None:
+            self.raycaster = HeightfieldRaycaster.from_tile_points(self.heights)
+        return self.raycaster
+
+    def sample_heights(self, xs, ys, normals=False, slopes=False, triangles=False):
+        # Bilinear heights at world x, y positions (same coordinates as check_height),
+        # NaN outside the map and on deleted terrain. With normals and/or slopes
+        # a tuple is returned: heights, (..., 3) unit normals as x, height, y and
+        # slopes in degrees from horizontal.
+        # ray_collide hits two triangles per cell instead, which can be a few units
+        # off the bilinear surface on uneven cells. triangles=True samples those
+        # triangles so that both agree, see HeightfieldRaycaster.sample.
+        heights, gradient_x, gradient_y = self.get_raycaster().sample(xs, ys, triangles)
+        if not normals and not slopes:
+            return heights
+
+        result = [heights]
+        if normals:
+            normal = numpy.stack((-gradient_x, numpy.ones_like(heights), -gradient_y), axis=-1)
+            result.append(normal/numpy.linalg.norm(normal, axis=-1, keepdims=True))
+        if slopes:
+            result.append(numpy.degrees(numpy.arctan(numpy.hypot(gradient_x, gradient_y))))
+        return tuple(result)
+
+    def ray_collide_many(self, origins, directions, max_distance=inf):
+        # origins, directions: (n, 3) arrays of x, height, y like in Line
+        return self.get_raycaster().ray_collide_many(origins, directions, max_distance)
 
-        if point is not None:
-            return point, dist
+    def ray_collide(self, line: Line, d_filter=inf):
+        result = self.get_raycaster().ray_collide(
+            (line.origin.x, line.origin.y, line.origin.z),
+            (line.direction.x, line.direction.y, line.direction.z),
+            d_filter)
+
+        if result is not None:
+            point, dist = result
+            return Vector3(*(float(v) for v in point)), dist
         else:
             return False
 
@@ -578,15 +400,3 @@ class BWTerrain(BWSectionedFile):
         a, b, tileindex = unpack_from(">BBH", self.map, index*4)
         return a, b, tileindex
 
-
-if __name__ == "__main__":
-    with open("MP4.out", "rb") as f:
-        bwterrain = BWTerrainV2(f)
-
-    #print(bwterrain.chunks)
-    #print(bwterrain.map)
-    print(bwterrain.materials)
-
-    for chunk in bwterrain.chunks:
-        for tile in chunk.tiles:
-            print(tile.surface_coordinates)
\ No newline at end of file
@@ -1,7 +1,11 @@
 import os
 import gzip
+import shutil
+import tempfile
 from struct import unpack, pack
 
+from .gzipio import open_path, ParallelGzipWriter
+
 
 def read_uint32(fileobj):
     return unpack("I", fileobj.read(4))[0]
@@ -20,6 +24,88 @@ def write_uint32(fileobj, val):
     fileobj.write(pack("I", val))
     
     
+class NameIndex(object):
+    """Case-folded name -> resource lookup for a list of resources. The archive
+    methods keep it up to date when resources are added or removed, and a
+    NamedSection re-keys itself in its indexes when it is renamed. If the
+    list's length was changed directly, it is rebuilt on the next lookup.
+    Like the linear search it replaces, the first resource with a name wins."""
+    def __init__(self, key=None):
+        self.key = key if key is not None else (lambda res: res.name.lower())
+        self.items = {}  # key -> resources with that key in list order
+        self.order = {}  # resource -> its position when it was indexed
+        self.next = 0
+        self.count = None
+
+    def rebuild(self, resources):
+        for res in self.order:
+            if isinstance(res, NamedSection):
+                res._name_indexes.discard(self)
+        self.items = {}
+        self.order = {}
+        self.next = 0
+        for res in resources:
+            self.insert(res)
+        self.count = len(resources)
+
+    def insert(self, res):
+        key = self.key(res)
+        if key is None:
+            return
+
+        self.order[res] = self.next
+        self.next += 1
+        self.place(res, key)
+        if isinstance(res, NamedSection):
+            res._name_indexes.add(self)
+
+    def place(self, res, key):
+        entries = self.items.setdefault(key, [])
+        position = self.order[res]
+        i = len(entries)
+        while i > 0 and self.order[entries[i-1]] > position:
+            i -= 1
+        entries.insert(i, res)
+
+    def unplace(self, res, key):
+        entries = self.items[key]
+        entries.remove(res)
+        if not entries:
+            del self.items[key]
+
+    def get(self, resources, key):
+        if self.count != len(resources):
+            self.rebuild(resources)
+
+        entries = self.items.get(key)
+        if entries is None:
+            return None
+        res = entries[0]
+        if self.key(res) != key:
+            # Renamed without going through NamedSection
+            self.rebuild(resources)
+            return self.get(resources, key)
+        return res
+
+    def added(self, resource):
+        if self.count is not None:
+            self.insert(resource)
+            self.count += 1
+
+    def removed(self, resource):
+        if self.count is not None:
+            if resource in self.order:
+                self.unplace(resource, self.key(resource))
+                del self.order[resource]
+                if isinstance(resource, NamedSection):
+                    resource._name_indexes.discard(self)
+            self.count -= 1
+
+    def renamed(self, resource, old_key):
+        self.unplace(resource, old_key)
+        self.place(resource, self.key(resource))
+
+
 class Section(object):
     def __init__(self, secname, data):
         self.secname = secname
@@ -38,12 +124,116 @@ class Section(object):
         f.write(self.data)
 
 
+class NamedSection(Section):
+    """Section of a resource with a name. Renaming it updates the NameIndexes
+    it is in."""
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        old_keys = [(index, index.key(self)) for index in self._name_indexes]
+        self._name = name
+        for index, old_key in old_keys:
+            index.renamed(self, old_key)
+
+    @property
+    def _name_indexes(self):
+        return self.__dict__.setdefault("_name_indexes", set())
+
+
+COPY_BUFFER_SIZE = 1024*1024
+
+
+class ArchiveSource(object):
+    """Path of the archive file that lazy sections are read from."""
+    def __init__(self, path):
+        self.path = path
+
+    def open(self):
+        return open_path(self.path, "rb")
+
+
+class CountingWriter(object):
+    """Passes writes on to f and counts the bytes written."""
+    def __init__(self, f):
+        self.f = f
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return self.f.write(data)
+
+
+class LazySection(Section):
+    """Section whose payload stays in the archive file. It is only read when
+    data is accessed, an untouched section is written by copying it straight
+    from the source file."""
+    def __init__(self, secname, source, offset, size):
+        self.secname = secname
+        self.source = source
+        self.offset = offset
+        self.size = size
+        self._data = None
+
+    @classmethod
+    def from_file(cls, f, source):
+        secname = f.read(4)
+        size = read_uint32(f)
+        offset = f.tell()
+        f.seek(size, 1)
+        return cls(secname, source, offset, size)
+
+    @property
+    def loaded(self):
+        return self._data is not None
+
+    @property
+    def data(self):
+        if self._data is None:
+            with self.source.open() as f:
+                f.seek(self.offset)
+                self._data = f.read(self.size)
+                assert len(self._data) == self.size
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+
+    def write(self, f, source_file=None):
+        # source_file: already opened handle of self.source so that consecutive
+        # sections don't reopen (and for gzip, decompress again) the file
+        if self._data is not None:
+            super().write(f)
+            return
+
+        f.write(self.secname)
+        write_uint32(f, self.size)
+        if source_file is None:
+            with self.source.open() as src:
+                self.copy_payload(src, f)
+        else:
+            self.copy_payload(source_file, f)
+
+    def copy_payload(self, src, f):
+        src.seek(self.offset)
+        remaining = self.size
+        while remaining > 0:
+            data = src.read(min(remaining, COPY_BUFFER_SIZE))
+            assert len(data) > 0, "Archive file ended early"
+            f.write(data)
+            remaining -= len(data)
+
+
 class TextureArchive(Section):
     def __init__(self, name, level_name, textures, is_bw1):
         super().__init__(name, b"")
         self.level_name = level_name
         self.textures = textures
         self.is_bw1 = is_bw1
+        self.index = NameIndex()
 
     @classmethod
     def from_file(cls, f):
@@ -74,9 +264,10 @@ class TextureArchive(Section):
         return cls(secname, level_name, textures, is_bw1)
 
     def write(self, f):
+        # Sizes are calculated up front so that f doesn't need to be seekable
+        subarchive_size = 4 + sum(tex.written_size() for tex in self.textures)
         f.write(self.secname)
-        archive_size = f.tell()
-        write_uint32(f, 0xFFAABBCC)  # Placeholder
+        write_uint32(f, 4 + len(self.level_name) + 8 + subarchive_size)
         write_uint32(f, len(self.level_name))
         f.write(self.level_name)
 
@@ -85,27 +276,16 @@ class TextureArchive(Section):
         else:
             f.write(b"FTBG")
 
-        subarchive_size = f.tell()
-        write_uint32(f, 0xFFAABBCC)
+        write_uint32(f, subarchive_size)
         write_uint32(f, len(self.textures))
         for tex in self.textures:
             tex.write(f)
 
-        end = f.tell()
-        f.seek(archive_size)
-        write_uint32(f, end-(archive_size+4))
-        f.seek(subarchive_size)
-        write_uint32(f, end-(subarchive_size+4))
-        f.seek(end)
-
     def get_texture(self, texname):
-        for tex in self.textures:
-            if tex.name.lower() == texname.lower():
-                return tex
-        return None
+        return self.index.get(self.textures, texname.lower())
 
 
-class TextureBW1(Section):
+class TextureBW1(NamedSection):
     def __init__(self, secname, texname, data):
         super().__init__(secname, b"")
         self.name = texname
@@ -151,6 +331,9 @@ class TextureBW1(Section):
 
         return cls(b"TXET", fname.replace(".texture", ""), data)
 
+    def written_size(self):
+        return 8 + 0x10 + len(self.data)
+
     def write(self, f):
         f.write(self.secname)
         encoded_name = bytes(self.name, "ascii").ljust(0x10, b"\x00")
@@ -160,7 +343,7 @@ class TextureBW1(Section):
         f.write(self.data)
 
 
-class TextureBW2(Section):
+class TextureBW2(NamedSection):
     def __init__(self, secname, texname, data):
         super().__init__(secname, b"")
         self.name = texname
@@ -206,6 +389,9 @@ class TextureBW2(Section):
 
         return cls(b"DXTG", fname.replace(".texture", ""), data)
 
+    def written_size(self):
+        return 8 + 0x20 + len(self.data)
+
     def write(self, f):
         f.write(self.secname)
         encoded_name = bytes(self.name, "ascii").ljust(0x20, b"\x00")
@@ -221,6 +407,7 @@ class SoundArchive(Section):
         self.level_name = level_name
         self.sounds = sounds
         self._padding = 0
+        self.index = NameIndex()
 
     @classmethod
     def from_file(cls, f):
@@ -249,8 +436,8 @@ class SoundArchive(Section):
 
     def write(self, f):
         f.write(b"DNOS")
-        archive_size = f.tell()
-        write_uint32(f, 0xFFAABBCC)  # Placeholder
+        size = 4 + len(self.level_name) + 12 + sum(sound.written_size() for sound in self.sounds) + self._padding
+        write_uint32(f, size)
         write_uint32(f, len(self.level_name))
         f.write(self.level_name)
         f.write(b"HFSB")
@@ -263,13 +450,8 @@ class SoundArchive(Section):
         if self._padding > 0:
             f.write(b"\x00"*self._padding)
 
-        end = f.tell()
-        f.seek(archive_size)
-        write_uint32(f, end-(archive_size+4))
-        f.seek(end)
 
-
-class Sound(Section):
+class Sound(NamedSection):
     def __init__(self, sound_name, data):
         super().__init__(b"HPSD", data)
         self.name = sound_name
@@ -303,6 +485,9 @@ class Sound(Section):
 
         return cls(fname.replace(".adp", ""), data)
 
+    def written_size(self):
+        return 8 + 0x20 + 8 + len(self.data)
+
     def write(self, f):
         f.write(b"HPSD")
         write_uint32(f, 0x20)
@@ -314,7 +499,7 @@ class Sound(Section):
         f.write(self.data)
 
 
-class Model(Section):
+class Model(NamedSection):
     def __init__(self, modelname, data):
         super().__init__(b"LDOM", b"")
         self.name = modelname
@@ -356,7 +541,7 @@ class Model(Section):
         f.write(self.data)
 
 
-class Animation(Section):
+class Animation(NamedSection):
     def __init__(self, animname, data):
         super().__init__(b"MINA", b"")
         self.name = animname
@@ -395,7 +580,7 @@ class Animation(Section):
         f.write(self.data)
 
 
-class Effect(Section):
+class Effect(NamedSection):
     def __init__(self, effect_name, data):
         super().__init__(b"FEQT", b"")
         self.name = effect_name
@@ -434,7 +619,7 @@ class Effect(Section):
         f.write(self.data)
 
 
-class LuaScript(Section):
+class LuaScript(NamedSection):
     def __init__(self, name, script_name, data):
         super().__init__(name, data)
         self.name = script_name
@@ -478,6 +663,14 @@ class LuaScript(Section):
     
 ORDERLIST = [b"RXET", b"DNOS", b"LDOM", b"MINA", b"PRCS", b"FEQT"]
 ORDER = {v: i for i,v in enumerate(ORDERLIST)}
+NAMED_SECTIONS = (b"LDOM", b"MINA", b"PRCS", b"FEQT")
+
+
+def section_key(sec):
+    # Sections that were skipped by from_file_textures have no name
+    if sec.secname in NAMED_SECTIONS and hasattr(sec, "name"):
+        return (sec.secname, sec.name.lower())
+    return None
 
 
 class BattalionArchive(object):
@@ -485,9 +678,15 @@ class BattalionArchive(object):
         self.sections = []
         self.textures = None
         self.sounds = None
+        self.section_index = NameIndex(section_key)
+        self.complete = True
     
     @classmethod
-    def from_file_textures(cls, f):
+    def from_file_textures(cls, f, source=None, textures_only=False):
+        # Only the texture archive is parsed. With a source the other sections
+        # are skipped and become LazySections that read from the source when
+        # needed. textures_only stops after the texture archive, the result is
+        # then read-only.
         arc = cls()
         while True:
             curr = f.tell()
@@ -497,14 +696,26 @@ class BattalionArchive(object):
                 if peek == b"RXET":
                     section = TextureArchive.from_file(f)
                     arc.textures = section
+                elif source is not None:
+                    section = LazySection.from_file(f, source)
                 else:
                     section = Section.from_file(f)
                 arc.sections.append(section)
+                
+                if textures_only and arc.textures is not None:
+                    arc.complete = False
+                    break
             else:
                 break 
                 
         return arc
     
+    @classmethod
+    def from_path_textures(cls, path, textures_only=False):
+        source = ArchiveSource(path)
+        with source.open() as f:
+            return cls.from_file_textures(f, source, textures_only)
+    
     @classmethod
     def from_file(cls, f):
         arc = cls()
@@ -538,32 +749,86 @@ class BattalionArchive(object):
         return arc
     
     def write(self, f):
+        assert self.complete, "Archive was read with textures_only and can't be written"
+        # Returns the lazy sections that were copied from their source with the
+        # offsets their payload was written to
         self.sort_sections()
-        for section in self.sections:
-            section.write(f)
+        
+        f = CountingWriter(f)
+        copied = []
+        sources = {}
+        try:
+            for section in self.sections:
+                if isinstance(section, LazySection) and not section.loaded:
+                    if section.source not in sources:
+                        sources[section.source] = section.source.open()
+                    copied.append((section, f.written + 8))
+                    section.write(f, sources[section.source])
+                else:
+                    section.write(f)
+        finally:
+            for source_file in sources.values():
+                source_file.close()
+        
+        return copied
+
+    def save(self, path):
+        # Writes to a temporary file next to path that replaces it once it's
+        # complete. Lazy sections are streamed from their source file, which can
+        # be path itself, so only modified sections are serialized in memory.
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path)+".", suffix=".tmp")
+        try:
+            f = os.fdopen(fd, "wb")
+            if path.endswith(".gz"):
+                f = ParallelGzipWriter(f)
+            with f:
+                copied = self.write(f)
+            # mkstemp creates the file only readable by the user, the archive
+            # keeps the permissions it had or gets the usual ones for a new file
+            if os.path.exists(path):
+                shutil.copymode(path, tmp_path)
+            else:
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(tmp_path, 0o666 & ~umask)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        
+        # The old file at path is gone, lazy sections read from the new one
+        source = ArchiveSource(path)
+        for section, offset in copied:
+            section.source = source
+            section.offset = offset
 
     def add_script(self, script: LuaScript):
-        for sec in self.sections:
-            if sec.secname == b"PRCS" and sec.name == script.name:
-                sec.data = script.data 
-                break 
+        sec = self.get_script(script.name)
+        if sec is not None:
+            sec.data = script.data 
         else:
             self.sections.append(script)
+            self.section_index.added(script)
             self.sections.sort(key=lambda x: ORDER[x.secname])
     
     def delete_script(self, script_name):
-        for i in range(len(self.sections)):
-            sec = self.sections[i]
-            if sec.secname == b"PRCS" and sec.name == script_name:
-                self.sections.pop(i)
-                break
+        sec = self.get_script(script_name)
+        if sec is not None:
+            self.sections.remove(sec)
+            self.section_index.removed(sec)
 
     def get_script(self, script_name):
-        for i in range(len(self.sections)):
-            sec = self.sections[i]
-            if sec.secname == b"PRCS" and sec.name == script_name:
-                return self.sections[i]
-        return None
+        # Script names are matched case sensitively
+        sec = self.section_index.get(self.sections, (b"PRCS", script_name.lower()))
+        if sec is not None and sec.name != script_name:
+            sec = None
+            for script in self.scripts():
+                if script.name == script_name:
+                    sec = script
+                    break
+        return sec
     
     def iter_sections(self, secname):
         for sec in self.sections:
@@ -597,45 +862,57 @@ class BattalionArchive(object):
 
         return resource_list
 
-    def resource_exists(self, restype, resname):
-        resource_list = self._get_resource_list(restype)
+    def _find_resource(self, restype, resname):
+        if restype in (b"DXTG", b"TXET"):
+            res = self.textures.index.get(self.textures.textures, resname.lower())
+        elif restype in (b"HFSB", b"HPSD"):
+            res = self.sounds.index.get(self.sounds.sounds, resname.lower())
+        elif restype in (b"MINA", b"LDOM", b"FEQT"):
+            res = self.section_index.get(self.sections, (restype, resname.lower()))
+        else:
+            res = None
 
-        for res in resource_list:
-            if res.secname == restype and res.name.lower() == resname.lower():
-                return True
-        return False
+        if res is not None and res.secname != restype:
+            res = None
+        return res
 
-    def get_resource(self, restype, resname):
-        resource_list = self._get_resource_list(restype)
-        for res in resource_list:
-            if res.secname == restype and res.name.lower() == resname.lower():
-                return res
+    def resource_exists(self, restype, resname):
+        return self._find_resource(restype, resname) is not None
 
-        return None
+    def get_resource(self, restype, resname):
+        return self._find_resource(restype, resname)
 
     def add_resource(self, resource):
         if isinstance(resource, TextureBW1):
             assert self.textures.is_bw1
             self.textures.textures.append(resource)
+            self.textures.index.added(resource)
         elif isinstance(resource, TextureBW2):
             assert not self.textures.is_bw1
             self.textures.textures.append(resource)
+            self.textures.index.added(resource)
         elif isinstance(resource, Sound):
             self.sounds.sounds.append(resource)
+            self.sounds.index.added(resource)
         elif isinstance(resource, (Model, Animation, Effect)):
             self.sections.append(resource)
+            self.section_index.added(resource)
 
     def delete_resource(self, resource):
         if isinstance(resource, TextureBW1):
             assert self.textures.is_bw1
             self.textures.textures.remove(resource)
+            self.textures.index.removed(resource)
         elif isinstance(resource, TextureBW2):
             assert not self.textures.is_bw1
             self.textures.textures.remove(resource)
+            self.textures.index.removed(resource)
         elif isinstance(resource, Sound):
             self.sounds.sounds.remove(resource)
+            self.sounds.index.removed(resource)
         elif isinstance(resource, (Model, Animation, Effect)):
             self.sections.remove(resource)
+            self.section_index.removed(resource)
 
     def sort_sections(self):
         self.sections.sort(key=lambda x: ORDER[x.secname])
@@ -1,8 +1,14 @@
 import sys
 import os
 from math import log2
+from struct import unpack_from
+from concurrent.futures import ThreadPoolExecutor
 #from PIL import Image
-import bpy 
+try:
+    import bpy 
+except ImportError:
+    # Reading and writing texture data works without Blender
+    bpy = None
 import importlib
 from .texlib import read_binary
 from .texlib import texture_utils
@@ -83,6 +89,119 @@ def valuerange_assertion(val, start, end):
         raise RuntimeError("Value needs to be in range of {0} to {1} but is {2}.")
 
 
+def encode_mipmaps(mipmaps, image_format):
+    # Mip levels are independent so they're encoded on a thread pool, the numpy
+    # encoders release the GIL. Levels that are Blender images are read on the
+    # calling thread first, bpy data can't be accessed from the pool.
+    mipmaps = [mipmap if mipmap.pixel_array is not None else Image.from_rgba(mipmap.rgba())
+               for mipmap in mipmaps]
+    def encode(mipmap):
+        return encode_image(mipmap, image_format, PaletteFormat.RGB5A3, mipmap_count=1)
+    
+    if len(mipmaps) == 1:
+        return [encode(mipmaps[0])]
+    with ThreadPoolExecutor(max_workers=min(len(mipmaps), os.cpu_count() or 1)) as executor:
+        return list(executor.map(encode, mipmaps))
+
+
+class LazyMipmapList(object):
+    """Stands in for Texture.mipmaps of a texture read from a file. Only the
+    offset and size of every mip level is kept, a level is decoded the first
+    time it's accessed."""
+    def __init__(self, data, fmt, palette, num_colors, levels):
+        self.data = data 
+        self.fmt = fmt 
+        self.palette = palette 
+        self.num_colors = num_colors 
+        self.levels = levels # (offset, size, width, height) per mip level
+        self.mipmaps = [None for i in range(len(levels))]
+    
+    @classmethod
+    def from_file(cls, f, fmt, size_x, size_y, mipcount, ignoremips=False):
+        # Reads the PAL and MIP sections that follow the texture header, f is left
+        # at the end of the last one. With ignoremips only the first mip level is kept.
+        start = f.tell()
+        in_memory = isinstance(f, BytesIO)
+        raw = bytearray()
+        
+        count = 1 if ignoremips else mipcount
+        palette_range = None 
+        levels = []
+        offset = 0
+        
+        while len(levels) < count:
+            header = f.read(8)
+            section = header[:4][::-1]
+            size = unpack_from("I", header, 4)[0]
+            offset += 8
+            
+            if section == PALLETE:
+                assert fmt in ("P4", "P8") and palette_range is None and len(levels) == 0
+                palette_range = (offset, size)
+            else:
+                assert section == MIP
+                i = len(levels)
+                levels.append((offset, size, max(size_x >> i, 1), max(size_y >> i, 1)))
+            
+            # A BytesIO's data is used without copying, other files are read
+            # section by section
+            if in_memory:
+                f.seek(size, 1)
+            else:
+                raw += header 
+                raw += f.read(size)
+            offset += size
+        
+        if in_memory:
+            # getvalue doesn't copy a BytesIO that was created from bytes
+            data = memoryview(f.getvalue())[start:start+offset]
+        else:
+            data = memoryview(raw)
+        
+        palette = None 
+        num_colors = 0
+        if palette_range is not None:
+            palette_offset, palette_size = palette_range
+            palette = BytesIO(data[palette_offset:palette_offset+palette_size])
+            num_colors = palette_size//2  # Max 16 for P4 and max 256 for P8
+        
+        if fmt in ("P4", "P8"):
+            assert palette is not None 
+        
+        return cls(data, fmt, palette, num_colors, levels)
+    
+    def decode(self, index):
+        offset, size, width, height = self.levels[index]
+        return decode_image(
+                    BytesIO(self.data[offset:offset+size]), self.palette, FORMAT[self.fmt], PaletteFormat.RGB5A3, 
+                    self.num_colors, width, height
+                    )
+    
+    def __len__(self):
+        return len(self.mipmaps)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.mipmaps)))]
+        
+        mip = self.mipmaps[index]
+        if mip is None:
+            mip = self.decode(index)
+            self.mipmaps[index] = mip 
+        return mip 
+    
+    def __setitem__(self, index, mip):
+        self.mipmaps[index] = mip 
+    
+    def __iter__(self):
+        for i in range(len(self.mipmaps)):
+            yield self[i]
+    
+    def append(self, mip):
+        self.levels.append(None)
+        self.mipmaps.append(mip)
+
+
 class Texture(object):
     def __init__(self, name):
         self.name = name
@@ -320,51 +439,10 @@ class BW2Texture(Texture):
         assert mipcount == mipcount2
         assert mipcount >= 1
         
-        section = read_id(f)
-        #print(section)
-        size = read_uint32_le(f)
-        #print(name, tex.format)
-        if tex.fmt in ("P4", "P8"):
-            assert section == PALLETE
-            palette = BytesIO(f.read(size))
-            num_colors = len(palette.getbuffer())//2  # Max 16 for P4 and max 256 for P8
-            section = read_id(f)
-            size = read_uint32_le(f)
-            assert section == MIP
-        else:
-            palette = None 
-            num_colors = 0
-            assert section == MIP
-        
-        #tex.mipmaps.append(f.read(size))
-
-        imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
-        
-        #assert size == len(imagedata.getbuffer())
-        mip = decode_image(
-                        imagedata, palette, FORMAT[tex.fmt], PaletteFormat.RGB5A3, num_colors, 
-                        tex.size_x, tex.size_y
-                        )
-        
-        tex.mipmaps.append(mip)
-        
         if mipcount > 1:
             assert log2(tex.size_x) % 1 == 0 and log2(tex.size_y) % 1 == 0
-
-        if not ignoremips:
-            for i in range(mipcount-1):
-                section = read_id(f)
-                size = read_uint32_le(f)
-                assert section == MIP
-                imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
-                mip_tex_x = max(tex.size_x//(2**(i+1)), 1)
-                mip_tex_y = max(tex.size_y//(2**(i+1)), 1)
-                #print(tex.size_x, mip_tex_x, tex.size_y, mip_tex_y)
-                mip = decode_image(
-                            imagedata, palette, FORMAT[tex.fmt], PaletteFormat.RGB5A3, num_colors,
-                            mip_tex_x, mip_tex_y
-                            )
-                tex.mipmaps.append(mip)
+        
+        tex.mipmaps = LazyMipmapList.from_file(f, tex.fmt, tex.size_x, tex.size_y, mipcount, ignoremips)
         return tex 
         
         
@@ -493,7 +571,10 @@ class BW1Texture(Texture):
         tex.unkint5 = unkint5
         tex.unkint6 = unkint6
         tex.unkint7 = unkint7
-        img = Image.from_blender(blenderimg)
+        # The pixels are read from Blender once, here, so that encoding (which can
+        # run on other threads) never touches bpy data
+        pixels = Image.from_blender(blenderimg).rgba()
+        img = Image.from_rgba(pixels)
         tex.mipmaps.append(img)
         
         if autogenmipmaps:
@@ -501,15 +582,9 @@ class BW1Texture(Texture):
                 print("Warning: Cannot generate mipmaps for non-power of 2 texture. Skipping mipmap generation.")
             else:
                 mipmap_count = int(log2(min(img.width, img.height)))
-                mipmap_width = img.width 
-                mipmap_height = img.height 
-                
-                for i in range(mipmap_count):
-                    if i != 0:
-                        mipmap_width //= 2
-                        mipmap_height //= 2
-                        mipmap_image = img.resize((mipmap_width, mipmap_height), Image.NEAREST)
-                        tex.mipmaps.append(mipmap_image)
+                # Every level is filtered from the previous one
+                for mipmap in generate_mipmap_chain(pixels, mipmap_count)[1:]:
+                    tex.mipmaps.append(Image.from_rgba(mipmap))
         return tex
     
     def write(self, f):
@@ -538,23 +613,18 @@ class BW1Texture(Texture):
         write_uint32_le(f, mipcount)
         assert f.tell()-start == 0x54
         
-        imgdata, palettedata, _ = encode_image(image, FORMAT[self.fmt], PaletteFormat.RGB5A3, mipmap_count=1)
+        encoded = encode_mipmaps(self.mipmaps, FORMAT[self.fmt])
+        imgdata, palettedata, _ = encoded[0]
         if self.fmt in ("P4", "P8"):
             write_id(f, PALLETE)
             write_uint32_le(f, 512)
             f.write(palettedata.getbuffer())
             f.write(b"\x00"*(512-len(palettedata.getbuffer())))
         
-        write_id(f, MIP)
-        write_uint32_le(f, len(imgdata.getbuffer()))
-        f.write(imgdata.getbuffer())
-        
-        if len(self.mipmaps) > 1:
-            for mipmap in self.mipmaps[1:]:
-                imgdata, palettedata, _ = encode_image(mipmap, FORMAT[self.fmt], PaletteFormat.RGB5A3, mipmap_count=1)
-                write_id(f, MIP)
-                write_uint32_le(f, len(imgdata.getbuffer()))
-                f.write(imgdata.getbuffer())
+        for imgdata, palettedata, _ in encoded:
+            write_id(f, MIP)
+            write_uint32_le(f, len(imgdata.getbuffer()))
+            f.write(imgdata.getbuffer())
                 
     @classmethod 
     def from_file(cls, name, f, ignoremips=False):
@@ -591,51 +661,8 @@ class BW1Texture(Texture):
         assert pad == b"\x00"*0xC
         mipcount = read_uint32_le(f)
         print(mipcount,"mips")
-        section = read_id(f)
-        assert section in (MIP, PALLETE)
-        #print(section)
-        size = read_uint32_le(f)
-        #print(name, tex.format)
-        
-        if tex.fmt in ("P4", "P8"):
-            assert section == PALLETE
-            palette = BytesIO(f.read(size))
-            num_colors = len(palette.getbuffer())//2  # Max 16 for P4 and max 256 for P8
-            section = read_id(f)
-            size = read_uint32_le(f)
-            assert section == MIP
-        else:
-            palette = None 
-            num_colors = 0
-            assert section == MIP
- 
-        #tex.mipmaps.append(f.read(size))
-        imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
-        
-        #assert size == len(imagedata.getbuffer())
-        #print(FORMAT[tex.fmt], hex(size), tex.size_x, tex.size_y)
-        mip = decode_image(
-                        imagedata, palette, FORMAT[tex.fmt], PaletteFormat.RGB5A3, num_colors, 
-                        tex.size_x, tex.size_y
-                        )
-        
-        tex.mipmaps.append(mip)
-        
         if mipcount > 1:
             assert log2(tex.size_x) % 1 == 0 and log2(tex.size_y) % 1 == 0
-
-        if not ignoremips:
-            for i in range(mipcount-1):
-                section = read_id(f)
-                size = read_uint32_le(f)
-                assert section == MIP
-                imagedata = BytesIO(f.read(size)+b"\x00"*256*256)
-                mip_tex_x = max(tex.size_x//(2**(i+1)), 1)
-                mip_tex_y = max(tex.size_y//(2**(i+1)), 1)
-                #print(tex.size_x, mip_tex_x, tex.size_y, mip_tex_y)
-                mip = decode_image(
-                            imagedata, palette, FORMAT[tex.fmt], PaletteFormat.RGB5A3, num_colors,
-                            mip_tex_x, mip_tex_y
-                            )
-                tex.mipmaps.append(mip)
+        
+        tex.mipmaps = LazyMipmapList.from_file(f, tex.fmt, tex.size_x, tex.size_y, mipcount, ignoremips)
         return tex
\ No newline at end of file
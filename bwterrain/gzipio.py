@@ -0,0 +1,223 @@
+import gzip
+import io
+import os
+import queue
+import struct
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+BLOCK_SIZE = 1024*1024
+DICTIONARY_SIZE = 32*1024
+READ_CHUNK_SIZE = 1024*1024
+READ_QUEUE_SIZE = 8
+# Bytes of already consumed data the reader keeps so that short backwards
+# seeks (like peeking at a section name) don't restart decompression
+READ_KEEP_SIZE = 64*1024
+
+
+def open_path(path, mode="rb"):
+    if path.endswith(".gz"):
+        if "w" in mode:
+            return ParallelGzipWriter(open(path, "wb"))
+        else:
+            return ThreadedGzipReader(path)
+    else:
+        return open(path, mode)
+
+
+def compress_block(block, dictionary, last, level):
+    # Raw deflate data for one block. Blocks other than the last end with a sync
+    # flush so that the blocks can be concatenated into one deflate stream, the
+    # previous block's tail is used as dictionary to keep the compression ratio.
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(block)
+    return data + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter(io.RawIOBase):
+    """Writes a single member gzip file like gzip.open(path, "wb") would, but the
+    data is split into blocks that are deflated on a thread pool. Takes
+    ownership of fileobj and closes it. The default level is gzip.open's."""
+    def __init__(self, fileobj, level=9, workers=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.buffer = bytearray()
+        self.dictionary = b""
+        self.crc = 0
+        self.size = 0
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = []
+
+        # No file name, mtime 0 so that the output only depends on the data
+        self.fileobj.write(b"\x1f\x8b\x08\x00" + struct.pack("<I", 0) + b"\x00\xff")
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        self.buffer += data
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+
+        while len(self.buffer) > BLOCK_SIZE:
+            block = bytes(self.buffer[:BLOCK_SIZE])
+            del self.buffer[:BLOCK_SIZE]
+            self.submit(block, last=False)
+        return len(data)
+
+    def submit(self, block, last):
+        self.pending.append(self.executor.submit(compress_block, block, self.dictionary, last, self.level))
+        self.dictionary = block[-DICTIONARY_SIZE:]
+
+        # Write out finished blocks in order and don't queue up more than a few
+        # blocks so that memory use stays bounded
+        while self.pending and (self.pending[0].done() or len(self.pending) > self.workers*2):
+            self.fileobj.write(self.pending.pop(0).result())
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.submit(bytes(self.buffer), last=True)
+            for future in self.pending:
+                self.fileobj.write(future.result())
+            self.pending = []
+            self.fileobj.write(struct.pack("<II", self.crc, self.size & 0xFFFFFFFF))
+        finally:
+            self.executor.shutdown()
+            self.fileobj.close()
+            super().close()
+
+
+class ThreadedGzipReader(io.RawIOBase):
+    """Reads a gzip file with the decompression running on a background thread
+    that stays a few chunks ahead of the reader. Supports tell() and seek(),
+    seeking backwards further than READ_KEEP_SIZE starts over from the
+    beginning of the file."""
+    def __init__(self, path):
+        self.path = path
+        self.thread = None
+        self.start()
+
+    def start(self):
+        self.stop()
+        self.chunks = queue.Queue(maxsize=READ_QUEUE_SIZE)
+        self.stopping = threading.Event()
+        self.buffer = b""
+        self.buffer_start = 0
+        self.position = 0
+        self.eof = False
+        self.error = None
+        self.thread = threading.Thread(target=self.decompress, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            # Unblock the thread if it's waiting for space in the queue
+            while self.thread.is_alive():
+                try:
+                    self.chunks.get(timeout=0.01)
+                except queue.Empty:
+                    pass
+            self.thread = None
+
+    def decompress(self):
+        try:
+            with gzip.open(self.path, "rb") as f:
+                while not self.stopping.is_set():
+                    chunk = f.read(READ_CHUNK_SIZE)
+                    self.put(chunk)
+                    if not chunk:
+                        break
+        except Exception as err:
+            self.put(err)
+
+    def put(self, item):
+        while not self.stopping.is_set():
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def next_chunk(self):
+        # The thread has stopped after the end of the file or an error, there's
+        # nothing more in the queue
+        if self.error is not None:
+            raise self.error
+        if self.eof:
+            return False
+        chunk = self.chunks.get()
+        if isinstance(chunk, Exception):
+            self.error = chunk
+            raise chunk
+        if not chunk:
+            self.eof = True
+            return False
+
+        keep = self.buffer[-READ_KEEP_SIZE:]
+        self.buffer_start += len(self.buffer) - len(keep)
+        self.buffer = keep + chunk
+        return True
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = sys.maxsize
+
+        parts = []
+        while size > 0:
+            offset = self.position - self.buffer_start
+            if offset >= len(self.buffer):
+                if not self.next_chunk():
+                    break
+                continue
+            part = self.buffer[offset:offset+size]
+            parts.append(part)
+            self.position += len(part)
+            size -= len(part)
+        return b"".join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            while self.next_chunk():
+                pass
+            offset += self.buffer_start + len(self.buffer)
+
+        if offset < self.buffer_start:
+            self.start()
+
+        # Forward seeks skip chunks without joining them
+        while offset > self.buffer_start + len(self.buffer) and self.next_chunk():
+            pass
+        self.position = min(offset, self.buffer_start + len(self.buffer))
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.stop()
+        super().close()
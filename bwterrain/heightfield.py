@@ -0,0 +1,235 @@
+import numpy
+from math import inf
+
+
+# Rays are traced in batches so that the candidate lists of long, grazing rays
+# don't grow without bounds
+RAY_BATCH_SIZE = 2048
+EPSILON = 1e-9
+
+
+def slab(origin, direction, lo, hi):
+    # Range of t for which origin + t*direction is between lo and hi on one axis
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        inv = 1.0/direction
+        t1 = (lo - origin)*inv
+        t2 = (hi - origin)*inv
+    near = numpy.minimum(t1, t2)
+    far = numpy.maximum(t1, t2)
+
+    parallel = direction == 0
+    if parallel.any():
+        inside = (lo <= origin) & (origin <= hi)
+        near = numpy.where(parallel, numpy.where(inside, -inf, inf), near)
+        far = numpy.where(parallel, numpy.where(inside, inf, -inf), far)
+    return near, far
+
+
+def intersect_triangles(origin, direction, a, b, c):
+    # Moeller-Trumbore for arrays of rays and triangles, (n, 3) each. Returns t,
+    # inf where the ray misses.
+    edge1 = b - a
+    edge2 = c - a
+    p = numpy.cross(direction, edge2)
+    det = numpy.einsum("ij,ij->i", edge1, p)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        inv_det = 1.0/det
+        s = origin - a
+        u = numpy.einsum("ij,ij->i", s, p)*inv_det
+        q = numpy.cross(s, edge1)
+        v = numpy.einsum("ij,ij->i", direction, q)*inv_det
+        t = numpy.einsum("ij,ij->i", edge2, q)*inv_det
+
+    hit = ((numpy.abs(det) > EPSILON) & (u >= -EPSILON) & (v >= -EPSILON)
+           & (u + v <= 1 + EPSILON) & (t >= 0))
+    return numpy.where(hit, t, inf)
+
+
+def tile_cell_corners(heights):
+    """Cell corner heights (cells x, cells y, 2, 2) of a point grid indexed [x][y]
+    in the terrain's tile layout: every tile has 4x4 points spanning 16 units, so
+    a tile is 3x3 cells and the border points of neighbouring tiles are at the
+    same position. There are no cells between tiles."""
+    heights = numpy.asarray(heights, dtype=numpy.float32)
+    tiles_x, tiles_y = heights.shape[0]//4, heights.shape[1]//4
+    tiles = heights[:tiles_x*4, :tiles_y*4].reshape(tiles_x, 4, tiles_y, 4)
+
+    corners = numpy.empty((tiles_x, 3, tiles_y, 3, 2, 2), dtype=numpy.float32)
+    for dx in range(2):
+        for dy in range(2):
+            corners[:, :, :, :, dx, dy] = tiles[:, dx:dx+3, :, dy:dy+3]
+    return corners.reshape(tiles_x*3, tiles_y*3, 2, 2)
+
+
+class HeightfieldRaycaster(object):
+    """Ray intersection with a grid of cells given by their corner heights,
+    (cells x, cells y, 2, 2) indexed [x][y][dx][dy], NaN where the terrain is
+    deleted. Cell x, y covers world x from x*spacing + offset to
+    (x+1)*spacing + offset and likewise for world z, height is the second
+    coordinate like in the .out file. A cell is solid if all of its corners exist
+    and is split into two triangles along the (0, 0) - (1, 1) diagonal.
+
+    Rays descend a min/max pyramid of the cell heights: every level halves the
+    node size and only nodes whose bounding box the ray passes through are
+    refined, all rays of a batch at once."""
+
+    def __init__(self, corners, spacing=16/3.0, offset=-2048.0):
+        self.spacing = spacing
+        self.offset = offset
+
+        corners = numpy.asarray(corners, dtype=numpy.float32)
+        cells_x, cells_y = self.cells = corners.shape[:2]
+        size = 1
+        while size < max(cells_x, cells_y):
+            size *= 2
+
+        self.corners = numpy.full((size, size, 2, 2), numpy.nan, dtype=numpy.float32)
+        self.corners[:cells_x, :cells_y] = corners
+
+        c = self.corners
+        mins = numpy.minimum(numpy.minimum(c[:, :, 0, 0], c[:, :, 1, 0]), numpy.minimum(c[:, :, 0, 1], c[:, :, 1, 1]))
+        maxs = numpy.maximum(numpy.maximum(c[:, :, 0, 0], c[:, :, 1, 0]), numpy.maximum(c[:, :, 0, 1], c[:, :, 1, 1]))
+        missing = numpy.isnan(mins)
+        mins[missing] = inf
+        maxs[missing] = -inf
+
+        # levels[0] is per cell, levels[-1] is a single node covering everything
+        self.mins = [mins]
+        self.maxs = [maxs]
+        while size > 1:
+            size //= 2
+            self.mins.append(mins.reshape(size, 2, size, 2).min(axis=(1, 3)))
+            self.maxs.append(maxs.reshape(size, 2, size, 2).max(axis=(1, 3)))
+            mins = self.mins[-1]
+            maxs = self.maxs[-1]
+
+    @classmethod
+    def from_tile_points(cls, heights):
+        return cls(tile_cell_corners(heights))
+
+    def sample(self, xs, zs, triangles=False):
+        """Bilinearly interpolated heights at world positions xs, zs (arrays of
+        any matching shape) and the height gradients along x and z. All three are
+        NaN outside of the grid and on cells with a deleted corner.
+
+        Rays hit the two triangles of a cell instead, which differ from the
+        bilinear surface by up to a quarter of h00 + h11 - h10 - h01 in the middle
+        of the cell. With triangles the heights and gradients are those of the
+        triangles, so they agree with ray_collide_many."""
+        xs = numpy.asarray(xs, dtype=numpy.float64)
+        zs = numpy.asarray(zs, dtype=numpy.float64)
+        u = (xs - self.offset)/self.spacing
+        v = (zs - self.offset)/self.spacing
+        cells_x, cells_y = self.cells
+        inside = (u >= 0) & (u <= cells_x) & (v >= 0) & (v <= cells_y)
+
+        # A position exactly on the far border belongs to the last cell
+        cell_x = numpy.clip(numpy.floor(numpy.where(inside, u, 0)).astype(numpy.int64), 0, cells_x-1)
+        cell_y = numpy.clip(numpy.floor(numpy.where(inside, v, 0)).astype(numpy.int64), 0, cells_y-1)
+        fx = u - cell_x
+        fy = v - cell_y
+
+        corners = self.corners[cell_x, cell_y].astype(numpy.float64)
+        h00 = corners[..., 0, 0]
+        h10 = corners[..., 1, 0]
+        h01 = corners[..., 0, 1]
+        h11 = corners[..., 1, 1]
+
+        if triangles:
+            # (0, 0), (1, 1), (1, 0) below the diagonal, (0, 0), (1, 1), (0, 1) above it
+            lower = fx >= fy
+            slope_x = numpy.where(lower, h10 - h00, h11 - h01)
+            slope_z = numpy.where(lower, h11 - h10, h01 - h00)
+            heights = h00 + slope_x*fx + slope_z*fy
+            gradient_x = slope_x/self.spacing
+            gradient_z = slope_z/self.spacing
+        else:
+            heights = (h00*(1-fx) + h10*fx)*(1-fy) + (h01*(1-fx) + h11*fx)*fy
+            gradient_x = ((h10 - h00)*(1-fy) + (h11 - h01)*fy)/self.spacing
+            gradient_z = ((h01 - h00)*(1-fx) + (h11 - h10)*fx)/self.spacing
+
+        return (numpy.where(inside, heights, numpy.nan),
+                numpy.where(inside, gradient_x, numpy.nan),
+                numpy.where(inside, gradient_z, numpy.nan))
+
+    def ray_collide_many(self, origins, directions, max_distance=inf):
+        """origins and directions are (n, 3) arrays. Returns the (n, 3) hit points
+        and (n,) distances along the normalized directions, NaN points and inf
+        distances for rays that don't hit anything within max_distance."""
+        origins = numpy.asarray(origins, dtype=numpy.float64).reshape(-1, 3)
+        directions = numpy.asarray(directions, dtype=numpy.float64).reshape(-1, 3)
+        lengths = numpy.linalg.norm(directions, axis=1)
+        valid = lengths > 0
+        directions = directions/numpy.where(valid, lengths, 1.0)[:, None]
+
+        distances = numpy.full(len(origins), inf)
+        for start in range(0, len(origins), RAY_BATCH_SIZE):
+            end = start + RAY_BATCH_SIZE
+            distances[start:end] = self._cast(origins[start:end], directions[start:end], max_distance)
+        distances[~valid] = inf
+
+        hit = numpy.isfinite(distances)
+        points = numpy.full(origins.shape, numpy.nan)
+        points[hit] = origins[hit] + directions[hit]*distances[hit, None]
+        return points, distances
+
+    def ray_collide(self, origin, direction, max_distance=inf):
+        points, distances = self.ray_collide_many([origin], [direction], max_distance)
+        if numpy.isinf(distances[0]):
+            return None
+        return points[0], float(distances[0])
+
+    def _cast(self, origins, directions, max_distance):
+        # Grid space: x and y in cells, heights unchanged. t stays the world
+        # distance because the directions were normalized in world space.
+        origin_x = (origins[:, 0] - self.offset)/self.spacing
+        origin_y = (origins[:, 2] - self.offset)/self.spacing
+        origin_h = origins[:, 1]
+        dir_x = directions[:, 0]/self.spacing
+        dir_y = directions[:, 2]/self.spacing
+        dir_h = directions[:, 1]
+
+        rays = numpy.arange(len(origins))
+        node_x = numpy.zeros(len(origins), dtype=numpy.int64)
+        node_y = numpy.zeros(len(origins), dtype=numpy.int64)
+
+        for level in range(len(self.mins)-1, -1, -1):
+            lo = self.mins[level][node_x, node_y]
+            hi = self.maxs[level][node_x, node_y]
+            node_size = 1 << level
+
+            near_x, far_x = slab(origin_x[rays], dir_x[rays], node_x*node_size, (node_x+1)*node_size)
+            near_y, far_y = slab(origin_y[rays], dir_y[rays], node_y*node_size, (node_y+1)*node_size)
+            near_h, far_h = slab(origin_h[rays], dir_h[rays], lo, hi)
+            near = numpy.maximum(numpy.maximum(near_x, near_y), numpy.maximum(near_h, 0))
+            far = numpy.minimum(numpy.minimum(far_x, far_y), numpy.minimum(far_h, max_distance))
+
+            keep = (lo <= hi) & (near <= far)
+            rays, node_x, node_y = rays[keep], node_x[keep], node_y[keep]
+
+            if level > 0:
+                rays = numpy.repeat(rays, 4)
+                node_x = numpy.repeat(node_x*2, 4) + numpy.tile([0, 1, 0, 1], len(node_x))
+                node_y = numpy.repeat(node_y*2, 4) + numpy.tile([0, 0, 1, 1], len(node_y))
+
+        distances = numpy.full(len(origins), inf)
+        if len(rays) == 0:
+            return distances
+
+        corners = self.corners[node_x, node_y]
+        x = node_x.astype(numpy.float64)
+        y = node_y.astype(numpy.float64)
+        p00 = numpy.stack((x, corners[:, 0, 0], y), axis=1)
+        p10 = numpy.stack((x+1, corners[:, 1, 0], y), axis=1)
+        p01 = numpy.stack((x, corners[:, 0, 1], y+1), axis=1)
+        p11 = numpy.stack((x+1, corners[:, 1, 1], y+1), axis=1)
+
+        ray_origin = numpy.stack((origin_x[rays], origin_h[rays], origin_y[rays]), axis=1)
+        ray_direction = numpy.stack((dir_x[rays], dir_h[rays], dir_y[rays]), axis=1)
+        t = numpy.minimum(intersect_triangles(ray_origin, ray_direction, p00, p11, p10),
+                          intersect_triangles(ray_origin, ray_direction, p00, p11, p01))
+        t[t > max_distance] = inf
+
+        numpy.minimum.at(distances, rays, t)
+        return distances
@@ -0,0 +1,203 @@
+from dataclasses import dataclass
+import numpy
+
+
+@dataclass
+class PartBuffers:
+    exists: numpy.ndarray       # per vertex, False where the terrain point is deleted
+    heights: numpy.ndarray      # per vertex Height weight, NaN where deleted
+    materials: numpy.ndarray    # per vertex Material weight, NaN where no tile
+    colors: numpy.ndarray       # flat RGBA per vertex
+    blend: numpy.ndarray        # flat RGBA per vertex
+    uv_main: numpy.ndarray      # (vertices, 2), already flipped for Blender
+    uv_detail: numpy.ndarray    # (vertices, 2), already flipped for Blender
+
+    @property
+    def deleted(self):
+        return numpy.flatnonzero(~self.exists)
+
+    def stored_weights(self):
+        # Height, Delete and Material weights as they read back from the vertex
+        # groups import_terrain fills: 32 bit floats, NaN where not in the group
+        deletes = numpy.full(len(self.exists), numpy.nan)
+        deletes[self.deleted] = 1.0
+        return {
+            "Height": self.heights.astype(numpy.float32).astype(numpy.float64),
+            "Delete": deletes,
+            "Material": self.materials.astype(numpy.float32).astype(numpy.float64)
+        }
+
+
+@dataclass
+class PartAttributes:
+    buffers: PartBuffers
+    heights: list               # (weight, vertex index list) per distinct Height weight
+    materials: list             # same for Material
+    deleted: list               # vertex indices
+    uv_main: numpy.ndarray      # flat per loop UVs
+    uv_detail: numpy.ndarray
+
+
+def mesh_grid(sizex, sizey, tilesize):
+    # Vertices (x*sizey + y) and quads of a terrain part. Every 4x4 points form a
+    # tile whose border points are at the same position as the neighbouring
+    # tile's, there are no faces between tiles.
+    ix, iy = numpy.meshgrid(numpy.arange(sizex), numpy.arange(sizey), indexing="ij")
+    vertices = numpy.zeros((sizex, sizey, 3), dtype=numpy.float32)
+    vertices[:, :, 0] = (ix - ix//4)*tilesize
+    vertices[:, :, 1] = (iy - iy//4)*tilesize
+
+    has_face = (ix < sizex-1) & (iy < sizey-1) & ((ix+1) % 4 != 0) & ((iy+1) % 4 != 0)
+    first = (ix*sizey + iy)[has_face]
+    faces = numpy.stack((first, first + sizey, first + sizey + 1, first + 1), axis=1).astype(numpy.int32)
+    return vertices.reshape(-1, 3), faces
+
+
+# Vertex index inside a part is x*partsize + y, same as TerrainGrid's mesh
+def build_part_buffers(terrain, px, py, partsize, remap):
+    xs = slice(px*partsize, (px+1)*partsize)
+    ys = slice(py*partsize, (py+1)*partsize)
+    count = partsize*partsize
+
+    exists = terrain.point_exists[xs, ys].reshape(count)
+    heights = (terrain.heights[xs, ys]/512.0).reshape(count)
+
+    tiles = partsize//4
+    material_map = terrain.material_map[px*tiles:(px+1)*tiles, py*tiles:(py+1)*tiles]
+    remap_table = numpy.array([remap[i] for i in range(len(remap))], dtype=numpy.float64)
+    tile_materials = numpy.full(material_map.shape, numpy.nan)
+    has_material = material_map != -1
+    tile_materials[has_material] = remap_table[material_map[has_material]]/100.0
+    materials = tile_materials.repeat(4, axis=0).repeat(4, axis=1).reshape(count)
+
+    colors = numpy.empty((count, 4), dtype=numpy.float32)
+    colors[:] = (1.0, 1.0, 1.0, 0.0)
+    colors[exists] = terrain.colors[xs, ys].reshape(count, 4)[exists]
+
+    blend = numpy.ones((count, 4), dtype=numpy.float32)
+    blend[exists, 3] = colors[exists, 3]
+
+    uv_main = terrain.uv_main[xs, ys].reshape(count, 2).copy()
+    uv_main[:, 1] = 1 - uv_main[:, 1]
+    uv_detail = terrain.uv_detail[xs, ys].reshape(count, 2).copy()
+    uv_detail[:, 1] = 1 - uv_detail[:, 1]
+
+    return PartBuffers(exists, heights, materials, colors.reshape(-1), blend.reshape(-1),
+                       uv_main, uv_detail)
+
+
+def group_by_value(values):
+    # Yields (value, vertex indices) for every distinct non-NaN value so that each
+    # weight only needs a single vertex_group.add call
+    indices = numpy.flatnonzero(~numpy.isnan(values))
+    indices = indices[numpy.argsort(values[indices], kind="stable")]
+    unique, starts = numpy.unique(values[indices], return_index=True)
+    return zip(unique.tolist(), numpy.split(indices, starts[1:]))
+
+
+# Material weights are index/100.0 and weights can't go past 1.0
+MATERIAL_INDICES = 101
+
+
+def material_indices(weights):
+    # Material index per vertex, -1 where the vertex isn't in the group
+    indices = numpy.full(len(weights), -1, dtype=numpy.int64)
+    has_weight = ~numpy.isnan(weights)
+    indices[has_weight] = numpy.rint(weights[has_weight]*100)
+    return indices
+
+
+def deletion_remap(deleted):
+    # Material indices after removing the deleted ones. Like removing them one by
+    # one, the vertices of a deleted material end up on the material before it.
+    deleted = numpy.sort(numpy.asarray(deleted, dtype=numpy.int64))
+    indices = numpy.arange(MATERIAL_INDICES)
+    return numpy.maximum(indices - numpy.searchsorted(deleted, indices, side="right"), 0)
+
+
+def remap_material_weights(weights, remap):
+    # New Material weights for a table of old index -> new index, NaN where the
+    # weight stays the same. Indices past the end of the table are kept.
+    indices = material_indices(weights)
+    remap = numpy.asarray(remap, dtype=numpy.int64)
+    vertices = numpy.flatnonzero((indices >= 0) & (indices < len(remap)))
+    old = indices[vertices]
+    new = remap[old]
+    changed = new != old
+
+    new_weights = numpy.full(len(weights), numpy.nan)
+    new_weights[vertices[changed]] = new[changed]/100.0
+    return new_weights
+
+
+def sew_heights(parts):
+    # parts: (size, base_x, base_y, per vertex Height weights with NaN where the
+    # vertex isn't in the group). Vertices at the same position, like the border
+    # points of neighbouring tiles and parts, get the average of their weights.
+    # Returns per part arrays of the new weights, NaN where nothing changes.
+    keys = []
+    for size, base_x, base_y, heights in parts:
+        ix, iy = numpy.meshgrid(numpy.arange(size), numpy.arange(size), indexing="ij")
+        x = (base_x + ix).reshape(-1)
+        y = (base_y + iy).reshape(-1)
+        in_range = (0 <= x) & (x < 1024) & (0 <= y) & (y < 1024)
+        # Points at the same position get the same key (769 positions per axis),
+        # invalid ones -1
+        keys.append(numpy.where(in_range, (x - x//4)*769 + (y - y//4), -1))
+
+    all_keys = numpy.concatenate(keys)
+    all_heights = numpy.concatenate([heights for _, _, _, heights in parts])
+    has_weight = (all_keys >= 0) & ~numpy.isnan(all_heights)
+    counts = numpy.bincount(all_keys[has_weight], minlength=769*769)
+    sums = numpy.bincount(all_keys[has_weight], all_heights[has_weight], minlength=769*769)
+
+    shared = counts > 1
+    averages = numpy.full(769*769, numpy.nan)
+    averages[shared] = sums[shared]/counts[shared]
+
+    results = []
+    for key, (_, _, _, heights) in zip(keys, parts):
+        new = numpy.where(key >= 0, averages[key], numpy.nan)
+        # Weights are stored as 32 bit floats, skip the ones that already match
+        new[numpy.float32(new) == numpy.float32(heights)] = numpy.nan
+        results.append(new)
+    return results
+
+
+def tile_corner_loop_uvs(loop_vertices, size, base_x, base_y, selected=None):
+    # Per loop UVs that stretch every tile from one corner of the texture to the
+    # other, (loops, 2), and whether the loop gets reset: its vertex is on the map
+    # and, with a per vertex selected mask, selected
+    x = base_x + loop_vertices//size
+    y = base_y + loop_vertices % size
+    uvs = numpy.empty((len(loop_vertices), 2), dtype=numpy.float32)
+    uvs[:, 0] = x % 4
+    uvs[:, 1] = y % 4
+    uvs /= 3.0
+    reset = (0 <= x) & (x < 1024) & (0 <= y) & (y < 1024)
+    if selected is not None:
+        reset &= selected[loop_vertices]
+    return uvs, reset
+
+
+def scatter_loop_uvs(current, loop_vertices, vertex_uvs, exists):
+    # current: flat per loop UVs as read from the layer, only loops of existing
+    # vertices get overwritten
+    uvs = current.reshape(-1, 2)
+    mask = exists[loop_vertices]
+    uvs[mask] = vertex_uvs[loop_vertices[mask]]
+    return current
+
+
+def prepare_part(terrain, px, py, partsize, remap, loop_vertices, uv_main, uv_detail):
+    # Everything import_terrain writes into a part that doesn't need bpy, so it can
+    # run on a worker thread. uv_main/uv_detail are the flat per loop UVs of a
+    # freshly created part, loops of deleted vertices keep them.
+    buffers = build_part_buffers(terrain, px, py, partsize, remap)
+    return PartAttributes(
+        buffers,
+        [(value, indices.tolist()) for value, indices in group_by_value(buffers.heights)],
+        [(value, indices.tolist()) for value, indices in group_by_value(buffers.materials)],
+        buffers.deleted.tolist(),
+        scatter_loop_uvs(uv_main.copy(), loop_vertices, buffers.uv_main, buffers.exists),
+        scatter_loop_uvs(uv_detail.copy(), loop_vertices, buffers.uv_detail, buffers.exists))
@@ -0,0 +1,113 @@
+import hashlib
+import os
+import tempfile
+
+import numpy
+
+
+DEFAULT_MAX_SIZE = 512*1024*1024
+# Part of every key, bump it whenever texture decoding changes so that pixels
+# decoded by older versions stop being found
+CACHE_VERSION = 1
+
+
+def texture_key(tex):
+    # TextureBW1/TextureBW2 data starts with the size and format header so hashing
+    # the section name and the payload covers both the format and the image data
+    digest = hashlib.sha1(b"%d\0" % CACHE_VERSION)
+    digest.update(tex.secname)
+    digest.update(tex.data)
+    return digest.hexdigest()
+
+
+class TextureCache(object):
+    """Directory of decoded textures stored as .npy files of (height, width, 4)
+    uint8 RGBA rows in Blender's bottom to top order. Entries are touched on every
+    hit and the least recently used ones are removed once the directory grows
+    past max_size bytes."""
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key+".npy")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            pixels = numpy.load(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            print("Removing broken cache entry", path)
+            self.remove(path)
+            return None
+
+        if pixels.dtype != numpy.uint8 or pixels.ndim != 3 or pixels.shape[2] != 4:
+            self.remove(path)
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return pixels
+
+    def put(self, key, pixels):
+        pixels = numpy.ascontiguousarray(pixels, dtype=numpy.uint8)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                numpy.save(f, pixels)
+            os.replace(tmp_path, self.path(key))
+        except OSError:
+            self.remove(tmp_path)
+            raise
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def entries(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".npy"):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_size:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            self.remove(path)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            self.remove(path)
+
+
+def pixels_to_rgba8(pixels, width, height):
+    # Blender image pixels (flat floats) to cache layout
+    pixels = numpy.asarray(pixels, dtype=numpy.float32).reshape(height, width, 4)
+    return numpy.rint(pixels*255).astype(numpy.uint8)
+
+
+def rgba8_to_pixels(pixels):
+    return (pixels.astype(numpy.float32)/255.0).reshape(-1)
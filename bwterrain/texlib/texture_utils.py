@@ -1,8 +1,15 @@
 
 #from PIL import Image
 from io import BytesIO
-import bpy 
+try:
+  import bpy 
+except ImportError:
+  # The codecs work on arrays without Blender, only Blender images need it
+  bpy = None
 import colorsys
+import numpy
+import os
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 import operator
 
@@ -33,9 +40,20 @@ class PixelsAdapter(object):
         return self.pixels[pix_index:pix_index+4]
     
 
+class ArrayPixelsAdapter(object):
+    # PixelsAdapter for an Image that only exists as an RGBA array
+    def __init__(self, pixels):
+        self.pixels = pixels 
+    
+    def __getitem__(self, index):
+        x, y = index 
+        return self.pixels[y, x].tolist()
+    
+
 class Image(object):
     def __init__(self):
         self.image = None 
+        self.pixel_array = None 
         self.width = self.height = None 
         
     @classmethod 
@@ -51,6 +69,14 @@ class Image(object):
         img.width, img.height = blenderimg.size 
         return img 
     
+    @classmethod
+    def from_rgba(cls, pixels):
+        # pixels: (height, width, 4) integer RGBA, top row first
+        img = cls()
+        img.pixel_array = pixels 
+        img.height, img.width = pixels.shape[:2]
+        return img 
+    
     def resize(self, dim, texfilter):
         copy = self.image.copy()
         copy._bw_is_copy = True 
@@ -59,8 +85,21 @@ class Image(object):
         return img_copy 
         
     def load(self):
+        if self.pixel_array is not None:
+            return ArrayPixelsAdapter(self.pixel_array)
         return PixelsAdapter(self.image)
     
+    def rgba(self):
+        # Same values as PixelsAdapter as a (height, width, 4) array, top row first
+        if self.pixel_array is not None:
+            return self.pixel_array 
+        
+        width, height = self.image.size
+        pixels = numpy.empty(width*height*4, dtype=numpy.float32)
+        self.image.pixels.foreach_get(pixels)
+        pixels = (pixels.astype(numpy.float64)*255).astype(numpy.int32)
+        return pixels.reshape(height, width, 4)[::-1]
+    
     @property
     def size(self):
         return self.width, self.height 
@@ -673,36 +712,9 @@ def decode_image(image_data, palette_data, image_format, palette_format, num_col
   
   image = Image.new("RGBA", (image_width, image_height), (0, 0, 0, 0))
   pixels = image.image.pixels
-  offset = 0
-  block_x = 0
-  block_y = 0
-  print("Decoding...", image_width, image_height)
   
-  values = [0.0 for i in range(image_width*image_height*4)]
-  
-  while block_y < image_height:
-    
-    pixel_color_data = decode_block(image_format, image_data, offset, block_data_size, colors)
-    for i, color in enumerate(pixel_color_data):
-      x_in_block = i % block_width
-      y_in_block = i // block_width
-      x = block_x+x_in_block
-      y = block_y+y_in_block
-      if x >= image_width or y >= image_height:
-        continue
-      index = (x + (image_height - (y+1))*image_width)*4
-      #pixels[index:index+4] = (color[0]/255.0, color[1]/255.0, color[2]/255.0, color[3]/255.0)
-      values[index] = color[0]/255.0
-      values[index+1] = color[1]/255.0
-      values[index+2] = color[2]/255.0
-      values[index+3] = color[3]/255.0
-    
-    offset += block_data_size
-    block_x += block_width
-    if block_x >= image_width:
-      block_x = 0
-      block_y += block_height
-  pixels[:] = values
+  rgba = decode_image_array(image_data, colors, image_format, image_width, image_height)
+  pixels.foreach_set((rgba/255.0).astype(numpy.float32).reshape(-1))
   image.image.update()
   
   return image
@@ -891,6 +903,172 @@ def decode_cmpr_block(image_format, image_data, offset, block_data_size, colors)
 
 
 
+# Array versions of the block decoders above. Each one takes the raw blocks as
+# (blocks, block data size) uint8 and returns (blocks, block height*block width, 4)
+# RGBA in the same pixel order as the block decoder.
+
+def read_blocks(image_data, count, block_data_size):
+  # Missing data at the end is treated as zeroes
+  data = image_data.getbuffer()[:count*block_data_size]
+  blocks = numpy.zeros(count*block_data_size, dtype=numpy.uint8)
+  blocks[:len(data)] = numpy.frombuffer(data, dtype=numpy.uint8)
+  return blocks.reshape(count, block_data_size)
+
+def split_nibbles(blocks):
+  return numpy.stack((blocks >> 4, blocks & 0xF), axis=-1).reshape(len(blocks), -1)
+
+def read_u16_texels(blocks):
+  return blocks.view(">u2").astype(numpy.int32)
+
+def greyscale_to_rgba(l, a):
+  return numpy.stack((l, l, l, a), axis=-1)
+
+def convert_rgb565_array(rgb565):
+  return numpy.concatenate((expand_rgb565(rgb565), numpy.full(rgb565.shape + (1,), 255, dtype=rgb565.dtype)), axis=-1)
+
+def convert_rgb5a3_array(rgb5a3):
+  opaque = (rgb5a3 & 0x8000) != 0
+  a = numpy.where(opaque, 255, swizzle_3_bit_to_8_bit((rgb5a3 >> 12) & 0x7))
+  r = numpy.where(opaque, swizzle_5_bit_to_8_bit((rgb5a3 >> 10) & 0x1F), swizzle_4_bit_to_8_bit((rgb5a3 >> 8) & 0xF))
+  g = numpy.where(opaque, swizzle_5_bit_to_8_bit((rgb5a3 >> 5) & 0x1F), swizzle_4_bit_to_8_bit((rgb5a3 >> 4) & 0xF))
+  b = numpy.where(opaque, swizzle_5_bit_to_8_bit(rgb5a3 & 0x1F), swizzle_4_bit_to_8_bit(rgb5a3 & 0xF))
+  return numpy.stack((r, g, b, a), axis=-1)
+
+def decode_i4_blocks(blocks, palette):
+  i4 = swizzle_4_bit_to_8_bit(split_nibbles(blocks).astype(numpy.int32))
+  return greyscale_to_rgba(i4, i4)
+
+def decode_i8_blocks(blocks, palette):
+  return greyscale_to_rgba(blocks, blocks)
+
+def decode_ia4_blocks(blocks, palette):
+  ia4 = blocks.astype(numpy.int32)
+  return greyscale_to_rgba(swizzle_4_bit_to_8_bit(ia4 & 0xF), swizzle_4_bit_to_8_bit(ia4 >> 4))
+
+def decode_ia8_blocks(blocks, palette):
+  ia8 = read_u16_texels(blocks)
+  return greyscale_to_rgba(ia8 & 0xFF, ia8 >> 8)
+
+def decode_rgb565_blocks(blocks, palette):
+  return convert_rgb565_array(read_u16_texels(blocks))
+
+def decode_rgb5a3_blocks(blocks, palette):
+  return convert_rgb5a3_array(read_u16_texels(blocks))
+
+def decode_rgba32_blocks(blocks, palette):
+  ar = blocks[:, :32].reshape(-1, 16, 2)
+  gb = blocks[:, 32:].reshape(-1, 16, 2)
+  return numpy.stack((ar[:, :, 1], gb[:, :, 0], gb[:, :, 1], ar[:, :, 0]), axis=-1)
+
+def decode_c4_blocks(blocks, palette):
+  return palette[split_nibbles(blocks)]
+
+def decode_c8_blocks(blocks, palette):
+  return palette[blocks]
+
+def decode_c14x2_blocks(blocks, palette):
+  return palette[read_u16_texels(blocks) & 0x3FFF]
+
+BLOCK_ARRAY_DECODERS = {
+  ImageFormat.I4    : decode_i4_blocks,
+  ImageFormat.I8    : decode_i8_blocks,
+  ImageFormat.IA4   : decode_ia4_blocks,
+  ImageFormat.IA8   : decode_ia8_blocks,
+  ImageFormat.RGB565: decode_rgb565_blocks,
+  ImageFormat.RGB5A3: decode_rgb5a3_blocks,
+  ImageFormat.RGBA32: decode_rgba32_blocks,
+  ImageFormat.C4    : decode_c4_blocks,
+  ImageFormat.C8    : decode_c8_blocks,
+  ImageFormat.C14X2 : decode_c14x2_blocks,
+}
+
+def decode_image_array(image_data, colors, image_format, image_width, image_height):
+  # Returns (image_height, image_width, 4) uint8 RGBA with the rows going from
+  # bottom to top like Blender's pixels.
+  if image_format == ImageFormat.CMPR:
+    return decode_cmpr_image(image_data, image_width, image_height)
+  if image_format not in BLOCK_ARRAY_DECODERS:
+    raise Exception("Unknown image format: %s" % image_format.name)
+  
+  block_width = BLOCK_WIDTHS[image_format]
+  block_height = BLOCK_HEIGHTS[image_format]
+  blocks_x = (image_width+block_width-1)//block_width
+  blocks_y = (image_height+block_height-1)//block_height
+  blocks = read_blocks(image_data, blocks_x*blocks_y, BLOCK_DATA_SIZES[image_format])
+  
+  palette = None
+  if image_format in IMAGE_FORMATS_THAT_USE_PALETTES:
+    # Indexes past the end of the palette decode as transparent black
+    palette = numpy.zeros((MAX_COLORS_FOR_IMAGE_FORMAT[image_format], 4), dtype=numpy.int32)
+    if colors:
+      palette[:len(colors)] = colors
+  
+  rgba = BLOCK_ARRAY_DECODERS[image_format](blocks, palette)
+  
+  # block y, block x, y, x -> block y, y, block x, x
+  rgba = rgba.reshape(blocks_y, blocks_x, block_height, block_width, 4).transpose(0, 2, 1, 3, 4)
+  rgba = rgba.reshape(blocks_y*block_height, blocks_x*block_width, 4)[:image_height, :image_width]
+  return rgba[::-1].astype(numpy.uint8)
+
+CMPR_SUBBLOCK_DTYPE = numpy.dtype([("color_0", ">u2"), ("color_1", ">u2"), ("indexes", ">u4")])
+
+def expand_rgb565(rgb565):
+  r = (rgb565 >> 11) & 0x1F
+  g = (rgb565 >> 5) & 0x3F
+  b = rgb565 & 0x1F
+  return numpy.stack((r << 3 | r >> 2, g << 2 | g >> 4, b << 3 | b >> 2), axis=-1)
+
+def get_cmpr_palettes(color_0_rgb565, color_1_rgb565):
+  # Array version of get_interpolated_cmpr_colors, returns (subblocks, 4, 4)
+  color_0 = color_0_rgb565.astype(numpy.int32)
+  color_1 = color_1_rgb565.astype(numpy.int32)
+  rgb_0 = expand_rgb565(color_0)
+  rgb_1 = expand_rgb565(color_1)
+  four_colors = (color_0 > color_1)[:, None]
+  
+  palettes = numpy.empty((len(color_0), 4, 4), dtype=numpy.int32)
+  palettes[:, 0, :3] = rgb_0
+  palettes[:, 1, :3] = rgb_1
+  palettes[:, 2, :3] = numpy.where(four_colors, (2*rgb_0 + rgb_1)//3, rgb_0//2 + rgb_1//2)
+  palettes[:, 3, :3] = numpy.where(four_colors, (rgb_0 + 2*rgb_1)//3, 0)
+  palettes[:, :3, 3] = 255
+  palettes[:, 3, 3] = numpy.where(four_colors[:, 0], 255, 0)
+  return palettes
+
+def decode_cmpr_image(image_data, image_width, image_height):
+  # Decodes every 4x4 subblock at once, same results as decode_cmpr_block.
+  # Returns (image_height, image_width, 4) uint8 RGBA with the rows going from
+  # bottom to top like Blender's pixels.
+  blocks_x = (image_width+7)//8
+  blocks_y = (image_height+7)//8
+  subblocks = read_blocks(image_data, blocks_x*blocks_y*4, CMPR_SUBBLOCK_DTYPE.itemsize)
+  subblocks = subblocks.reshape(-1).view(CMPR_SUBBLOCK_DTYPE)
+  
+  palettes = get_cmpr_palettes(subblocks["color_0"], subblocks["color_1"])
+  
+  shifts = numpy.arange(15, -1, -1, dtype=numpy.uint32)*2
+  color_indexes = (subblocks["indexes"][:, None] >> shifts) & 3
+  colors = numpy.take_along_axis(palettes, color_indexes[:, :, None].astype(numpy.intp), axis=1)
+  
+  # block y, block x, subblock y, subblock x, y, x -> block y, subblock y, y, block x, subblock x, x
+  colors = colors.reshape(blocks_y, blocks_x, 2, 2, 4, 4, 4).transpose(0, 2, 4, 1, 3, 5, 6)
+  colors = colors.reshape(blocks_y*8, blocks_x*8, 4)[:image_height, :image_width]
+  return colors[::-1].astype(numpy.uint8)
+
+def generate_mipmap_chain(rgba, count):
+  # Returns count levels starting with rgba itself, every level is a 2x2 box
+  # filtered copy of the previous one. Odd sizes drop the last row/column.
+  levels = [rgba]
+  for i in range(count-1):
+    prev = levels[-1].astype(numpy.int32)
+    height, width = prev.shape[0]//2, prev.shape[1]//2
+    if width == 0 or height == 0:
+      break
+    prev = prev[:height*2, :width*2]
+    total = prev[0::2, 0::2] + prev[1::2, 0::2] + prev[0::2, 1::2] + prev[1::2, 1::2]
+    levels.append((total + 2)//4)
+  return levels
+
 def encode_image_from_path(new_image_file_path, image_format, palette_format, mipmap_count=1):
   image = Image.open(new_image_file_path)
   image_width, image_height = image.size
@@ -938,6 +1116,9 @@ def encode_image(image, image_format, palette_format, mipmap_count=1):
   return (new_image_data, new_palette_data, encoded_colors)
 
 def encode_mipmap_image(image, image_format, colors_to_color_indexes, image_width, image_height):
+  if image_format == ImageFormat.CMPR and not PY_FAST_BTI_INSTALLED:
+    return BytesIO(encode_cmpr_image(image.rgba()))
+  
   pixels = image.load()
   offset_in_image_data = 0
   block_x = 0
@@ -1205,6 +1386,97 @@ def encode_image_to_c14x2_block(pixels, colors_to_color_indexes, block_x, block_
   new_data.seek(0)
   return new_data.read()
 
+# Amount of 4x4 subblocks encoded per task, the pair search needs 1 KB per subblock
+CMPR_SUBBLOCKS_PER_TASK = 4096
+CMPR_PAIRS = numpy.triu(numpy.ones((16, 16), dtype=bool), k=1)
+
+def encode_cmpr_subblocks(colors, in_image):
+  # colors: (subblocks, 16, 4) int32 RGBA, in_image: (subblocks, 16) False for
+  # pixels that bleed past the edge of the image.
+  # Same results as encode_image_to_cmpr_block without pyfastbti.
+  count = len(colors)
+  subblock_indexes = numpy.arange(count)
+  opaque = in_image & (colors[:, :, 3] >= 16)
+  transparent = in_image & ~opaque
+  needs_transparent_color = transparent.any(axis=1)
+  
+  # get_best_cmpr_key_colors: the first pair (in list order) with the largest distance
+  distances = numpy.abs(colors[:, :, None, :] - colors[:, None, :, :]).sum(axis=3)
+  valid_pairs = opaque[:, :, None] & opaque[:, None, :] & CMPR_PAIRS
+  distances = numpy.where(valid_pairs, distances, -1).reshape(count, 256)
+  best_pair = distances.argmax(axis=1)
+  no_pair = distances[subblock_indexes, best_pair] == -1
+  
+  key_0 = colors[subblock_indexes, best_pair//16, :3]
+  key_1 = colors[subblock_indexes, best_pair % 16, :3]
+  key_0[no_pair] = 0
+  key_1[no_pair] = 0xFF
+  
+  shifts = numpy.array((3, 2, 3))
+  same = numpy.all(key_0 >> shifts == key_1 >> shifts, axis=1)
+  black = numpy.all(key_0 >> shifts == 0, axis=1)
+  key_1[same & black] = 0xFF
+  key_1[same & ~black] = 0
+  
+  def to_rgb565(rgb):
+    return ((rgb[:, 0] >> 3) & 0x1F) << 11 | ((rgb[:, 1] >> 2) & 0x3F) << 5 | ((rgb[:, 2] >> 3) & 0x1F)
+  
+  color_0 = to_rgb565(key_0)
+  color_1 = to_rgb565(key_1)
+  swap = numpy.where(needs_transparent_color, color_0 > color_1, color_0 < color_1)
+  color_0, color_1 = numpy.where(swap, color_1, color_0), numpy.where(swap, color_0, color_1)
+  key_0, key_1 = numpy.where(swap[:, None], key_1, key_0), numpy.where(swap[:, None], key_0, key_1)
+  
+  # The key colors themselves are matched before they are reduced to RGB565
+  palettes = get_cmpr_palettes(color_0, color_1)
+  palettes[:, 0, :3] = key_0
+  palettes[:, 1, :3] = key_1
+  
+  # get_nearest_color_fast: transparent pixels take the transparent entry,
+  # everything else the first palette entry with the smallest distance
+  distances = numpy.abs(colors[:, :, None, :] - palettes[:, None, :, :]).sum(axis=3)
+  color_indexes = distances.argmin(axis=2)
+  color_indexes[transparent] = 3
+  color_indexes[~in_image] = 0
+  
+  index_shifts = numpy.arange(15, -1, -1, dtype=numpy.uint32)*2
+  subblocks = numpy.empty(count, dtype=CMPR_SUBBLOCK_DTYPE)
+  subblocks["color_0"] = color_0
+  subblocks["color_1"] = color_1
+  subblocks["indexes"] = (color_indexes.astype(numpy.uint32) << index_shifts).sum(axis=1, dtype=numpy.uint32)
+  return subblocks
+
+def encode_cmpr_image(rgba):
+  # rgba: (height, width, 4) integer colors with the rows going from top to
+  # bottom. Large images are split into runs of block rows that are encoded on
+  # a thread pool, numpy releases the GIL for the heavy parts.
+  image_height, image_width = rgba.shape[:2]
+  blocks_x = (image_width+7)//8
+  blocks_y = (image_height+7)//8
+  
+  colors = numpy.zeros((blocks_y*8, blocks_x*8, 4), dtype=numpy.int32)
+  colors[:image_height, :image_width] = rgba
+  in_image = numpy.zeros((blocks_y*8, blocks_x*8), dtype=bool)
+  in_image[:image_height, :image_width] = True
+  
+  # block y, subblock y, y, block x, subblock x, x -> block y, block x, subblock y, subblock x, y, x
+  colors = colors.reshape(blocks_y, 2, 4, blocks_x, 2, 4, 4).transpose(0, 3, 1, 4, 2, 5, 6).reshape(-1, 16, 4)
+  in_image = in_image.reshape(blocks_y, 2, 4, blocks_x, 2, 4).transpose(0, 3, 1, 4, 2, 5).reshape(-1, 16)
+  
+  step = max(CMPR_SUBBLOCKS_PER_TASK//(blocks_x*4), 1)*blocks_x*4
+  starts = range(0, len(colors), step)
+  
+  def encode(start):
+    return encode_cmpr_subblocks(colors[start:start+step], in_image[start:start+step])
+  
+  if len(starts) > 1:
+    with ThreadPoolExecutor(max_workers=min(len(starts), os.cpu_count() or 1)) as executor:
+      parts = list(executor.map(encode, starts))
+  else:
+    parts = [encode(start) for start in starts]
+  
+  return b"".join(part.tobytes() for part in parts)
+
 def encode_image_to_cmpr_block(pixels, colors_to_color_indexes, block_x, block_y, block_width, block_height, image_width, image_height):
   new_data = BytesIO()
   subblock_offset = 0
@@ -63,6 +63,8 @@ class BinaryReader(BytesIO):
     def read_object(self, obj=None, count=None):
         if count is None:
             return obj.from_file(self)
+        elif hasattr(obj, "from_file_many"):
+            return obj.from_file_many(self, count)
         else:
             return [obj.from_file(self) for i in range(count)]
     
@@ -1,5 +1,8 @@
 from .binaryreader import *
 from .structs import *
+import mmap
+import struct
+import numpy
 
 try:
     from PIL import Image
@@ -43,6 +46,7 @@ class Color(Struct):
 class UVPoint(object):
     x: float  # ushort
     y: float  # ushort
+    struct_format = ">HH"
 
     def to_file(self, f):
         #print(self.x, self.y)
@@ -57,6 +61,13 @@ class UVPoint(object):
     def default(cls):
         return cls(0.0, 0.0)
     
+    @classmethod
+    def from_struct_values(cls, x, y):
+        return cls(x/4096.0, y/4096.0)
+    
+    def to_struct_values(self):
+        return int(self.x*4096), int(self.y*4096)
+    
     
 @dataclass
 class Tile(Struct):
@@ -90,6 +101,21 @@ class Chunk(Struct):
         return cls(tiles)
 
 
+class RawChunk(object):
+    """Chunk kept as the bytes it's stored as, for chunks copied over from an
+    existing file. Only decoded if its tiles are needed."""
+    def __init__(self, data):
+        assert len(data) == 180*16
+        self.data = data 
+    
+    @property
+    def tiles(self):
+        return BinaryReader(self.data).read_object(Chunk).tiles
+    
+    def to_file(self, f):
+        f.write(self.data)
+
+
 class ChunkSection(object):
     def __init__(self):
         self.chunks = []
@@ -206,15 +232,16 @@ class CollisionMapInfo(Struct):
 class RepeatingValuesContainer(object):
     def __init__(self):
         self.values = []
+        self.indices = {}
     
     def add(self, sequence):
         assert isinstance(sequence, tuple), "Sequence needs to be a tuple"
         
-        try:
-            index = self.values.index(sequence)
-        except ValueError:
+        index = self.indices.get(sequence)
+        if index is None:
             index = len(self.values)
             self.values.append(sequence)
+            self.indices[sequence] = index 
         
         return index
     
@@ -232,6 +259,12 @@ class CollisionMap(object):
         self.indices = [] # Section 1
         self.floats = [] # Section 2: Signed16 converted to float by dividing by 16 
         
+        # State for regenerating only the blocks of chunks that changed
+        self.heights = None # 768x768 heights the blocks are cut from
+        self.blocks = None  # Values of each of the 48x48 blocks
+        self.dirty_chunks = set()
+        self.blocks_loaded = True # Loaded collision data is only turned into blocks when needed
+        
     @classmethod 
     def from_file(cls, f):
         section = cls() 
@@ -241,11 +274,36 @@ class CollisionMap(object):
         
         colmapinfo = f.read_object(CollisionMapInfo)
         section.info = colmapinfo 
-        section.indices = f.read_uint16_be(count=colmapinfo.section1_size//2)
-        section.floats = [f.read_int16_be() / 16.0 for i in range(colmapinfo.section2_size//2)]
-            
+        section.indices = list(f.read_format(fmt=">{}H".format(colmapinfo.section1_size//2)))
+        section.floats = [val / 16.0 for val in f.read_format(fmt=">{}h".format(colmapinfo.section2_size//2))]
+        section.blocks_loaded = False 
+        
         return section
     
+    def load_blocks(self):
+        # Use the loaded collision as the starting point for regenerating dirty chunks,
+        # unless it doesn't have the layout regenerate_from produces
+        self.blocks_loaded = True 
+        self.heights = None 
+        self.blocks = None 
+        
+        if (self.info.size_x != 48 or self.info.size_y != 48 or len(self.indices) != 48*48 
+                or len(self.floats) % 256 != 0 or max(self.indices) >= len(self.floats)//256):
+            return 
+        
+        pool = [tuple(self.floats[i*256:(i+1)*256]) for i in range(len(self.floats)//256)]
+        self.blocks = [pool[index] for index in self.indices]
+        
+        heights = numpy.array(self.blocks).reshape(48, 48, 16, 16)
+        self.heights = heights.transpose(0, 2, 1, 3).reshape(48*16, 48*16)
+    
+    def mark_chunk_dirty(self, x, y):
+        self.dirty_chunks.add((x, y))
+    
+    def mark_all_dirty(self):
+        self.blocks_loaded = True 
+        self.heights = None 
+    
     def to_file(self, f):
         self.info.section1_size = len(self.indices)*2
         self.info.section2_size = len(self.floats)*2
@@ -284,44 +342,56 @@ class CollisionMap(object):
         img.save(outpath)
         
     def regenerate_from(self, chunk_map, chunks):
-        heights = [[44.0 for y in range(48*16)] for x in range(48*16)]
-        for x in range(48*16):
-            for y in range(48*16):
-                if x % 12 == 0 or y % 12 == 0:
-                    heights[x][y] = 0.0
+        if not self.blocks_loaded:
+            self.load_blocks()
         
-        for x in range(64):
-            for y in range(64):
-                entry = chunk_map.entries[x][y]
-                if entry.b == 1:
-                    chunk = chunks.chunks[entry.index]
-                    for tilex in range(4):
-                        for tiley in range(4):
-                            tile = chunk.tiles[tilex*4+tiley]
-                             
-                            for ix in range(3):
-                                for iy in range(3):
-                                    height = tile.heights[ix*4+iy]/16.0
-                                    
-                                    total_x = x*12 + tilex*3 + ix 
-                                    total_y = y*12 + tiley*3 + iy 
-                                    
-                                    heights[total_x][total_y] = height 
+        if self.heights is None or self.blocks is None:
+            self.heights = numpy.full((48*16, 48*16), 44.0)
+            self.blocks = [None for i in range(48*48)]
+            dirty = [(x, y) for x in range(64) for y in range(64)]
+        else:
+            dirty = sorted(self.dirty_chunks)
+        self.dirty_chunks = set()
+        
+        # Chunks that don't exist keep the default pattern of their 12x12 area
+        chunk_view = self.heights.reshape(64, 12, 64, 12).transpose(0, 2, 1, 3)
+        empty = numpy.full((12, 12), 44.0)
+        empty[0, :] = 0.0
+        empty[:, 0] = 0.0
+        
+        existing = []
+        for x, y in dirty:
+            entry = chunk_map.entries[x][y]
+            if entry.b == 1:
+                existing.append((x, y, chunks.chunks[entry.index]))
+            else:
+                chunk_view[x, y] = empty 
+        
+        if existing:
+            xs, ys, chunk_list = zip(*existing)
+            tile_heights = numpy.array([tile.heights for chunk in chunk_list for tile in chunk.tiles])
+            # chunk, tilex, tiley, ix, iy -> chunk, tilex, ix, tiley, iy, skipping the 4th row/column of each tile
+            tile_heights = tile_heights.reshape(-1, 4, 4, 4, 4)[:, :, :, :3, :3]
+            chunk_view[list(xs), list(ys)] = tile_heights.transpose(0, 1, 3, 2, 4).reshape(-1, 12, 12)/16.0
+        
+        # Each chunk covers 12x12 heights which can overlap up to 2x2 blocks of 16x16
+        dirty_blocks = set()
+        for x, y in dirty:
+            for bx in range(x*12//16, (x*12 + 11)//16 + 1):
+                for by in range(y*12//16, (y*12 + 11)//16 + 1):
+                    dirty_blocks.add(bx*48 + by)
+        
+        block_view = self.heights.reshape(48, 16, 48, 16).transpose(0, 2, 1, 3).reshape(48*48, 16*16)
+        dirty_blocks = sorted(dirty_blocks)
+        for i, values in zip(dirty_blocks, block_view[dirty_blocks].tolist()):
+            self.blocks[i] = tuple(values)
         
         indices = []
         height_values = RepeatingValuesContainer()
+        for values in self.blocks:
+            index = height_values.add(values)
+            indices.append(index)
         
-        
-        for x in range(48):
-            for y in range(48):
-                values = []
-                for ix in range(16):
-                    for iy in range(16):
-                        values.append(heights[x*16+ix][y*16+iy])
-                
-                index = height_values.add(tuple(values))
-                indices.append(index)
-                
         self.indices = indices 
         self.floats = height_values.flatten()
         
@@ -414,6 +484,17 @@ class MapMaterialSection(object):
     
     def count(self):
         return len(self.materials)
+    
+    def sorted(self):
+        materials = [mat for mat in self.materials]
+        materials.sort(key=lambda mat: mat.mat_main+mat.mat_detail)
+        
+        remap = {}
+        for i, mat in enumerate(self.materials):
+            new_index = materials.index(mat)
+            remap[i] = new_index 
+        
+        return materials, remap 
 
 
 class TerrainFile(object):
@@ -485,13 +566,7 @@ class TerrainFile(object):
         self.chunks.chunks = [i[0] for i in chunks]
     
     def sort_materials(self):
-        materials = [mat for mat in self.materials.materials]
-        materials.sort(key=lambda mat: mat.mat_main+mat.mat_detail)
-        
-        remap = {}
-        for i, mat in enumerate(self.materials.materials):
-            new_index = materials.index(mat)
-            remap[i] = new_index 
+        materials, remap = self.materials.sorted()
         
         for chunk in self.chunks.chunks:
             for tile in chunk.tiles:
@@ -502,15 +577,19 @@ class TerrainFile(object):
     def clear_chunks(self):
         self.chunkmap = ChunkMap()
         self.chunks.chunks = []
+        self.collmap.mark_all_dirty()
     
     def set_chunk_exist_status(self, cx, cy, exist):
+        self.collmap.mark_chunk_dirty(cx, cy)
         entry = self.chunkmap.entries[cx][cy]
         if exist:
             entry.b = 1 
         else:
             entry.b = 2
     
-    def get_chunk(self, cx, cy, create_if_no_exist=False):
+    def get_chunk(self, cx, cy, create_if_no_exist=False, for_edit=False):
+        # Pass for_edit if the chunk is going to be changed so that its
+        # collision is regenerated
         entry = self.chunkmap.entries[cx][cy]
         
         if create_if_no_exist and not entry.chunk_exists():
@@ -518,9 +597,12 @@ class TerrainFile(object):
             index = len(self.chunks.chunks)
             self.chunks.chunks.append(chunk)
             entry.set_chunk(index)
+            self.collmap.mark_chunk_dirty(cx, cy)
         
         elif entry.chunk_exists():
             chunk = self.chunks.chunks[entry.index]
+            if for_edit:
+                self.collmap.mark_chunk_dirty(cx, cy)
         else:
             chunk = None 
         
@@ -530,6 +612,127 @@ class TerrainFile(object):
         self.collmap.regenerate_from(self.chunkmap, self.chunks)
         
 
+def read_section_offsets(data):
+    # Section name -> (offset of the section header, size) 
+    sections = {}
+    offset = 0
+    while offset + 8 <= len(data):
+        name = data[offset:offset+4][::-1]
+        size = struct.unpack_from("I", data, offset+4)[0]
+        sections[name] = (offset, size)
+        offset += 8 + size 
+    
+    return sections
+
+
+class LazyChunkList(object):
+    """Stands in for ChunkSection.chunks, chunks are decoded from the mapped
+    CHNK section the first time they're accessed."""
+    def __init__(self, data, offset, count, remap):
+        self.data = data 
+        self.offset = offset 
+        self.remap = remap 
+        self.chunks = [None for i in range(count)]
+    
+    def decode(self, index):
+        offset = self.offset + index*180*16
+        compiled = Chunk.compiled()
+        if compiled is not None:
+            chunk = compiled.decode(compiled.struct.unpack_from(self.data, offset), 0)
+        else:
+            chunk = BinaryReader(self.data[offset:offset+180*16]).read_object(Chunk)
+        
+        if self.remap is not None:
+            for tile in chunk.tiles:
+                tile.material_index = self.remap[tile.material_index]
+        
+        return chunk 
+    
+    def __len__(self):
+        return len(self.chunks)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.chunks)))]
+        
+        chunk = self.chunks[index]
+        if chunk is None:
+            chunk = self.decode(index % len(self.chunks))
+            self.chunks[index] = chunk 
+        return chunk 
+    
+    def __setitem__(self, index, chunk):
+        self.chunks[index] = chunk 
+    
+    def __iter__(self):
+        for i in range(len(self.chunks)):
+            yield self[i]
+    
+    def append(self, chunk):
+        self.chunks.append(chunk)
+
+
+class LazyTerrainFile(TerrainFile):
+    """TerrainFile that memory-maps the .out file and only decodes a section when
+    it's first used. Call close() (or use it as a context manager) when done,
+    chunks that weren't accessed before that can't be loaded anymore."""
+    SECTIONS = {
+        "terrain_info": (b"TERR", TerrainInfo),
+        "chunks": (b"CHNK", None),
+        "transform": (b"GPNF", TileTransform),
+        "chunkmap": (b"CMAP", ChunkMap),
+        "uwct": (b"UWCT", UWCTSection),
+        "collmap": (b"COLM", CollisionMap),
+        "materials": (b"MATL", MapMaterialSection)
+    }
+    
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        self.sections = read_section_offsets(self.data)
+    
+    def __getattr__(self, name):
+        if name not in self.SECTIONS:
+            raise AttributeError(name)
+        
+        section_name, section_type = self.SECTIONS[name]
+        if section_name not in self.sections:
+            raise RuntimeError(f"Terrain file has no {section_name} section")
+        offset, size = self.sections[section_name]
+        
+        if name == "chunks":
+            assert size % (180*16) == 0
+            # Chunks get their material indices remapped like TerrainFile.sort_materials does
+            self.materials 
+            value = ChunkSection()
+            value.chunks = LazyChunkList(self.data, offset+8, size//(180*16), 
+                                         self.__dict__.get("material_remap"))
+        else:
+            value = BinaryReader(self.data[offset:offset+8+size]).read_object(section_type)
+        
+        if name == "materials":
+            value.materials, self.material_remap = value.sorted()
+        elif name == "chunkmap":
+            for row in value.entries:
+                for entry in row:
+                    assert entry.a == 0
+                    assert entry.b in (1, 2)
+        
+        setattr(self, name, value)
+        return value 
+    
+    def close(self):
+        self.data.close()
+        self.file.close()
+    
+    def __enter__(self):
+        return self 
+    
+    def __exit__(self, *args):
+        self.close()
+
+
 if __name__ == "__main__":
     with open("C1_OnPatrol.out", "rb") as f:
         data = f.read()
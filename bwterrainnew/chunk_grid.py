@@ -0,0 +1,344 @@
+import hashlib
+import numpy
+
+from .bw_terrain import Chunk, ChunkMap, RawChunk, Tile, Color, UVPoint, read_section_offsets
+
+
+# Layouts of the CMAP entries and CHNK tiles as stored in the .out file
+MAP_DTYPE = numpy.dtype([("a", "u1"), ("b", "u1"), ("chunkindex", ">u2")])
+TILE_DTYPE = numpy.dtype([
+    ("heights", ">u2", (16,)),
+    ("colors", "u1", (16, 4)),
+    ("surface_coordinates", ">u2", (4, 2)),
+    ("detail_coordinates", ">u2", (16, 2)),
+    ("material_index", ">u4")
+])
+assert TILE_DTYPE.itemsize == 180
+
+
+def value_test(values):
+    values = numpy.trunc(values*4096)
+    return (0 <= values) & (values <= 2**16-1)
+
+
+def last_occurrence(indices):
+    # Position of the last occurrence of every distinct index
+    unique, first_reversed = numpy.unique(indices[::-1], return_index=True)
+    return unique, len(indices) - 1 - first_reversed
+
+
+def update_checksum(digest, values):
+    values = numpy.asarray(values)
+    if values.dtype.kind == "f":
+        values = values.astype(numpy.float64)
+        missing = numpy.isnan(values)
+        digest.update(missing.tobytes())
+        values = numpy.where(missing, 0.0, values)
+    else:
+        values = values.astype(numpy.int64)
+    digest.update(numpy.ascontiguousarray(values).tobytes())
+
+
+def object_checksum(size, base_x, base_y, material_keys, heights, deletes, materials, colors, blend,
+                    loop_vertices, uv_main, uv_detail):
+    # Checksum of everything ChunkGrid.add_object reads from a terrain object,
+    # in the same form it's read from Blender during export. material_keys are the
+    # textures and values of the object's material slots.
+    digest = hashlib.sha1()
+    update_checksum(digest, (size, base_x, base_y))
+    digest.update(repr(list(material_keys)).encode("utf-8"))
+    for values in (heights, deletes, materials, colors, blend, loop_vertices, uv_main, uv_detail):
+        update_checksum(digest, values)
+    return digest.hexdigest()
+
+
+class SourceChunks(object):
+    """The CMAP and CHNK sections of an existing .out file. Export copies the
+    chunk records of objects that didn't change since they were imported from it
+    instead of rebuilding them. Chunks are indexed [cx][cy] like ChunkMap.entries.
+    material_remap maps the material indices in the file to the sorted ones
+    TerrainFile uses."""
+
+    def __init__(self, chunkmap_data, chunk_data, material_remap=None):
+        entries = numpy.frombuffer(chunkmap_data, dtype=MAP_DTYPE).reshape(64, 64)
+        self.exists = entries["b"] == 1
+        self.indices = entries["chunkindex"].astype(numpy.int64)
+        self.records = numpy.frombuffer(chunk_data, dtype=numpy.uint8).reshape(-1, 180*16)
+        if material_remap is not None:
+            material_remap = numpy.array([material_remap[i] for i in range(len(material_remap))], dtype=numpy.int64)
+        self.material_remap = material_remap
+
+    @classmethod
+    def from_data(cls, data, material_remap=None):
+        sections = read_section_offsets(data)
+        cmap_offset, cmap_size = sections[b"CMAP"]
+        chnk_offset, chnk_size = sections[b"CHNK"]
+        return cls(bytes(data[cmap_offset+8:cmap_offset+8+cmap_size]),
+                   bytes(data[chnk_offset+8:chnk_offset+8+chnk_size]),
+                   material_remap)
+
+    @staticmethod
+    def area(base_x, base_y, size):
+        # Chunk slices covered by an object, None if it isn't aligned to chunks
+        if base_x % 16 != 0 or base_y % 16 != 0 or size % 16 != 0:
+            return None
+        cxs = slice(max(base_y//16, 0), min((base_y+size)//16, 64))
+        cys = slice(max(base_x//16, 0), min((base_x+size)//16, 64))
+        return cxs, cys
+
+    def checksum(self, base_x, base_y, size):
+        area = self.area(base_x, base_y, size)
+        if area is None:
+            return ""
+        exists = self.exists[area]
+        digest = hashlib.sha1()
+        digest.update(exists.tobytes())
+        digest.update(self.records[self.indices[area][exists]].tobytes())
+        return digest.hexdigest()
+
+    def tiles(self, cx, cy):
+        return self.records[self.indices[cx, cy]].view(TILE_DTYPE)
+
+    def sorted_materials(self, tiles):
+        materials = tiles["material_index"].astype(numpy.int64)
+        if self.material_remap is not None:
+            materials = self.material_remap[materials]
+        return materials
+
+    def record(self, cx, cy, remap):
+        tiles = self.tiles(cx, cy).copy()
+        tiles["material_index"] = remap[self.sorted_materials(tiles)]
+        return tiles.tobytes()
+
+
+class ChunkGrid(object):
+    """Whole-map point, tile and chunk arrays that terrain objects are scattered
+    into during export. Points and tiles are indexed [x][y], chunks [cx][cy] like
+    ChunkMap.entries, so cx = y//16 and cy = x//16.
+
+    With source set, objects passed to splice take their chunks from source as
+    they are, only the other chunks are rebuilt and need new collision."""
+
+    def __init__(self, source=None):
+        self.source = source
+        self.spliced = numpy.full((64, 64), -1, dtype=numpy.int64)  # index into remaps
+        self.remaps = []
+        self.added = numpy.zeros((64, 64), dtype=bool)  # chunks add_object wrote to
+        self.chunk_exists = numpy.zeros((64, 64), dtype=bool)
+        self.heights = numpy.zeros((1024, 1024), dtype=numpy.int64)
+        self.colors = numpy.full((1024, 1024, 4), 255, dtype=numpy.int64)
+        self.detail_coordinates = numpy.zeros((1024, 1024, 2), dtype=numpy.float64)
+        self.surface_coordinates = numpy.zeros((256, 256, 4, 2), dtype=numpy.float64)
+        self.material_indices = numpy.zeros((256, 256), dtype=numpy.int64)
+
+    def reset_chunks(self, cx, cy):
+        # Same values as Chunk.default()
+        for chunkx, chunky in zip(cx.tolist(), cy.tolist()):
+            xs = slice(chunky*16, chunky*16 + 16)
+            ys = slice(chunkx*16, chunkx*16 + 16)
+            self.heights[xs, ys] = 0
+            self.colors[xs, ys] = 255
+            self.detail_coordinates[xs, ys] = 0.0
+            txs = slice(chunky*4, chunky*4 + 4)
+            tys = slice(chunkx*4, chunkx*4 + 4)
+            self.surface_coordinates[txs, tys] = 0.0
+            self.material_indices[txs, tys] = 0
+
+    def splice(self, base_x, base_y, size, remap):
+        # Use the source chunks for an unchanged object. remap maps the source's
+        # sorted material indices to the exported ones, -1 for materials that
+        # aren't exported anymore. Returns False if the chunks can't be used and
+        # the object needs to be added with add_object.
+        area = SourceChunks.area(base_x, base_y, size)
+        if self.source is None or area is None:
+            return False
+        # Chunks that an earlier object was added to would be overwritten with the
+        # source chunks, the object needs to be added on top of them instead
+        if self.added[area].any():
+            return False
+
+        remap = numpy.array(remap, dtype=numpy.int64)
+        exists = self.source.exists[area]
+        for cx, cy in zip(*numpy.nonzero(exists)):
+            materials = self.source.sorted_materials(self.source.tiles(area[0].start + cx, area[1].start + cy))
+            if numpy.any(remap[materials] < 0):
+                return False
+
+        self.remaps.append(remap)
+        self.spliced[area] = len(self.remaps) - 1
+        self.chunk_exists[area] = exists
+        return True
+
+    def unsplice(self, cx, cy):
+        # Copy the source chunks of these chunks into the grid so that an object
+        # can be scattered over them
+        for chunkx, chunky in zip(cx.tolist(), cy.tolist()):
+            remap = self.remaps[self.spliced[chunkx, chunky]]
+            self.spliced[chunkx, chunky] = -1
+            if not self.chunk_exists[chunkx, chunky]:
+                continue
+
+            # tiles are ordered tile y, tile x and points point y, point x
+            tiles = self.source.tiles(chunkx, chunky)
+            xs = slice(chunky*16, chunky*16 + 16)
+            ys = slice(chunkx*16, chunkx*16 + 16)
+            self.heights[xs, ys] = tiles["heights"].reshape(4, 4, 4, 4).transpose(1, 3, 0, 2).reshape(16, 16)
+            self.colors[xs, ys] = tiles["colors"].reshape(4, 4, 4, 4, 4).transpose(1, 3, 0, 2, 4).reshape(16, 16, 4)
+            detail = tiles["detail_coordinates"].reshape(4, 4, 4, 4, 2).transpose(1, 3, 0, 2, 4).reshape(16, 16, 2)
+            self.detail_coordinates[xs, ys] = detail/4096.0
+            txs = slice(chunky*4, chunky*4 + 4)
+            tys = slice(chunkx*4, chunkx*4 + 4)
+            self.surface_coordinates[txs, tys] = tiles["surface_coordinates"].reshape(4, 4, 4, 2).transpose(1, 0, 2, 3)/4096.0
+            self.material_indices[txs, tys] = remap[self.source.sorted_materials(tiles)].reshape(4, 4).T
+
+    def add_object(self, name, size, base_x, base_y, remap,
+                   heights, deletes, materials, colors, blend,
+                   loop_vertices, uv_main, uv_detail):
+        """Scatter one terrain object. heights/deletes/materials are per vertex
+        weights with NaN where the vertex is not in the group, colors/blend are
+        flat RGBA per vertex and uv_main/uv_detail flat per loop UVs.
+
+        Returns the vertex indices that should get Delete weight 1.0 and 0.0 and
+        a per vertex Material weight array (NaN = unchanged)."""
+        ix, iy = numpy.meshgrid(numpy.arange(size), numpy.arange(size), indexing="ij")
+        ix = ix.reshape(-1)
+        iy = iy.reshape(-1)
+        x = base_x + ix
+        y = base_y + iy
+        in_range = (0 <= x) & (x < 1024) & (0 <= y) & (y < 1024)
+
+        # The delete flag is sampled once per chunk, at the chunk's first vertex
+        delete = deletes[(iy//16)*16 + (ix//16)*16*size]
+        deleted = delete > 0.5
+        added = in_range & ~deleted
+        removed = in_range & deleted
+
+        touched = numpy.zeros((64, 64), dtype=bool)
+        touched[y[in_range]//16, x[in_range]//16] = True
+        self.unsplice(*numpy.nonzero(touched & (self.spliced >= 0)))
+        self.added |= touched
+
+        x_add = x[added]
+        y_add = y[added]
+        new_chunks = numpy.zeros((64, 64), dtype=bool)
+        new_chunks[y_add//16, x_add//16] = True
+        new_chunks &= ~self.chunk_exists
+        self.reset_chunks(*numpy.nonzero(new_chunks))
+        self.chunk_exists[new_chunks] = True
+
+        # Material index is read from the tile's corner vertex and written back
+        # to all 16 vertices of the tile
+        material_weights = numpy.full(size*size, numpy.nan)
+        corner = added & (x % 4 == 0) & (y % 4 == 0) & ~numpy.isnan(materials)
+        if numpy.any(corner):
+            corner_materials = numpy.array([int(round(w*100)) for w in materials[corner].tolist()])
+            self.material_indices[x[corner]//4, y[corner]//4] = numpy.array(remap)[corner_materials]
+            block_ix = (ix[corner][:, None] + numpy.arange(16)//4).reshape(-1)
+            block_iy = (iy[corner][:, None] + numpy.arange(16) % 4).reshape(-1)
+            material_weights[block_iy + block_ix*size] = (corner_materials/100.0).repeat(16)
+
+        has_height = added & ~numpy.isnan(heights)
+        self.heights[x[has_height], y[has_height]] = (heights[has_height]*512*16).astype(numpy.int64)
+
+        point_colors = numpy.empty((added.sum(), 4), dtype=numpy.int64)
+        point_colors[:, :3] = (colors.reshape(-1, 4)[added, :3].astype(numpy.float64)*255).astype(numpy.int64)
+        point_colors[:, 3] = (blend.reshape(-1, 4)[added, 3].astype(numpy.float64)*255).astype(numpy.int64)
+        self.colors[x_add, y_add] = point_colors
+
+        for cx, cy in set(zip((y[removed]//16).tolist(), (x[removed]//16).tolist())):
+            self.chunk_exists[cx, cy] = False
+
+        self.add_uvs(name, size, base_x, base_y, loop_vertices, uv_main, uv_detail)
+
+        return numpy.flatnonzero(removed), numpy.flatnonzero(added), material_weights
+
+    def add_uvs(self, name, size, base_x, base_y, loop_vertices, uv_main, uv_detail):
+        local_x = loop_vertices//size
+        local_y = loop_vertices % size
+        x = base_x + local_x
+        y = base_y + local_y
+        valid = (0 <= x) & (x < 1024) & (0 <= y) & (y < 1024)
+        valid[valid] = self.chunk_exists[y[valid]//16, x[valid]//16]
+
+        detail = uv_detail.reshape(-1, 2).astype(numpy.float64)
+        detail[:, 1] = 1 - detail[:, 1]
+        main = uv_main.reshape(-1, 2).astype(numpy.float64)
+        main[:, 1] = 1 - main[:, 1]
+        corner = valid & (x % 4 % 3 == 0) & (y % 4 % 3 == 0)
+
+        bad_detail = valid & ~numpy.all(value_test(detail), axis=1)
+        bad_main = corner & ~numpy.all(value_test(main), axis=1)
+        bad = numpy.flatnonzero(bad_detail | bad_main)
+        if len(bad) > 0:
+            loop_i = bad[0]
+            tile_loc_x = local_x[loop_i]*4
+            tile_loc_y = local_y[loop_i]*4
+            if bad_detail[loop_i]:
+                print(tuple(uv_detail.reshape(-1, 2)[loop_i]), "->", UVPoint(*detail[loop_i].tolist()))
+                raise RuntimeError(f"Tile has Detail UVs out of range: {tile_loc_x},{tile_loc_y} in {name}")
+            else:
+                print(tuple(uv_main.reshape(-1, 2)[loop_i]), "->", UVPoint(*main[loop_i].tolist()))
+                raise RuntimeError(f"Tile has Main UVs out of range: {tile_loc_x},{tile_loc_y} in {name}")
+
+        # A vertex shared by several faces takes the UV of its last loop
+        loops = numpy.flatnonzero(valid)
+        _, last = last_occurrence(loop_vertices[loops])
+        loops = loops[last]
+        self.detail_coordinates[x[loops], y[loops]] = detail[loops]
+
+        loops = numpy.flatnonzero(corner)
+        _, last = last_occurrence(loop_vertices[loops])
+        loops = loops[last]
+        slot = (x[loops] % 4)//3 + ((y[loops] % 4)//3)*2
+        self.surface_coordinates[x[loops]//4, y[loops]//4, slot] = main[loops]
+
+    def apply_to(self, terrain):
+        # Chunks are created in the same order TerrainFile.sort_chunks produces
+        # (x, y axes of the point grids become cy, tile x, point x / cx, tile y, point y)
+        built = self.chunk_exists & (self.spliced < 0)
+
+        def per_tile_points(values):
+            extra = values.shape[2:]
+            values = values.reshape((64, 4, 4, 64, 4, 4) + extra)
+            order = (3, 0, 4, 1, 5, 2) + tuple(range(6, 6 + len(extra)))
+            return values.transpose(order).reshape((64, 64, 16, 16) + extra)[built].tolist()
+
+        def per_tile(values):
+            extra = values.shape[2:]
+            values = values.reshape((64, 4, 64, 4) + extra)
+            order = (2, 0, 3, 1) + tuple(range(4, 4 + len(extra)))
+            return values.transpose(order).reshape((64, 64, 16) + extra)[built].tolist()
+
+        heights = per_tile_points(self.heights)
+        colors = per_tile_points(self.colors)
+        detail = per_tile_points(self.detail_coordinates)
+        surface = per_tile(self.surface_coordinates)
+        materials = per_tile(self.material_indices)
+
+        if self.source is None:
+            terrain.clear_chunks()
+        else:
+            # Spliced chunks keep their collision, everything else that exists now or
+            # existed before changed
+            terrain.chunkmap = ChunkMap()
+            terrain.chunks.chunks = []
+            for cx, cy in zip(*numpy.nonzero((self.spliced < 0) & (self.chunk_exists | self.source.exists))):
+                terrain.collmap.mark_chunk_dirty(int(cx), int(cy))
+
+        i = 0
+        for index, (cx, cy) in enumerate(zip(*numpy.nonzero(self.chunk_exists))):
+            if self.spliced[cx, cy] >= 0:
+                chunk = RawChunk(self.source.record(cx, cy, self.remaps[self.spliced[cx, cy]]))
+            else:
+                tiles = []
+                for t in range(16):
+                    tiles.append(Tile(
+                        heights[i][t],
+                        [Color(*color) for color in colors[i][t]],
+                        [UVPoint(*uv) for uv in surface[i][t]],
+                        [UVPoint(*uv) for uv in detail[i][t]],
+                        materials[i][t]))
+                chunk = Chunk(tiles)
+                i += 1
+            terrain.chunks.chunks.append(chunk)
+            terrain.chunkmap.entries[cx][cy].set_chunk(index)
@@ -3,11 +3,280 @@ import struct
 from io import BytesIO
 from functools import partial
 from dataclasses import dataclass, fields
+from operator import attrgetter
 from .binaryreader import BinaryReader, datatype, uint32, uint16, uint8, float32, fmt, obj, string, fixed_string
+from .binaryreader import uint32be, uint16be, float3be, identifier
+
+
+# Byte order ("=", ">", "<" or None if it doesn't matter) and format of the plain readers
+SCALAR_FORMATS = {
+    uint32: ("=", "I"),
+    uint16: ("=", "H"),
+    uint32be: (">", "I"),
+    uint16be: (">", "H"),
+    uint8: (None, "B"),
+    float32: ("=", "f"),
+    float3be: (">", "f")
+}
+
+
+class CompiledType(object):
+    def __init__(self, order, fmt, count, decode=None, encode=None):
+        self.order = order 
+        self.fmt = fmt 
+        self.count = count  # Amount of values the format unpacks to
+        # decode(values, pos) -> value and encode(value, out) which appends the values to pack.
+        # None means the single value is used as is.
+        self.decode = decode 
+        self.encode = encode 
+
+
+def split_format(fmt):
+    order = "@"
+    if fmt[0] in "@=<>!":
+        order, fmt = fmt[0], fmt[1:]
+    
+    if order == "@":
+        # Native alignment can insert padding that a combined format wouldn't have
+        if struct.calcsize("@" + fmt) != struct.calcsize("=" + fmt):
+            return None 
+        order = "="
+    elif order == "!":
+        order = ">"
+    
+    if all(c in "0123456789sBbcx?p" for c in fmt):
+        order = None 
+    
+    count = len(struct.unpack("=" + fmt, bytes(struct.calcsize("=" + fmt))))
+    return order, fmt, count 
+
+
+def compile_reader(reader):
+    if reader in SCALAR_FORMATS:
+        order, fmt = SCALAR_FORMATS[reader]
+        return CompiledType(order, fmt, 1)
+    
+    if reader == identifier:
+        def encode(value, out):
+            assert len(value) == 4
+            out.append(value[::-1])
+        
+        return CompiledType(None, "4s", 1, lambda v, p: v[p][::-1], encode)
+    
+    read, _ = reader
+    if not isinstance(read, partial):
+        return None 
+    
+    if read.func is BinaryReader.read_format:
+        result = split_format(read.keywords["fmt"])
+        if result is None:
+            return None 
+        order, fmt, count = result
+        
+        # Like write_format the value is passed on as a single argument to pack
+        if read.keywords.get("single", False):
+            return CompiledType(order, fmt, count, lambda v, p: v[p], lambda value, out: out.append(value))
+        else:
+            return CompiledType(order, fmt, count, lambda v, p: v[p:p+count], lambda value, out: out.append(value))
     
+    elif read.func is BinaryReader.read_terminated_string:
+        size = read.keywords["size"]
+        
+        def decode(v, p):
+            data = v[p]
+            return data[:data.find(b"\x00")]
+        
+        def encode(value, out):
+            assert len(value) <= size 
+            out.append(value)
+            
+        return CompiledType(None, f"{size}s", 1, decode, encode)
+    
+    elif read.func is BinaryReader.read_object:
+        cls = read.keywords["obj"]
+        
+        if isinstance(cls, type) and issubclass(cls, Struct):
+            if (cls.from_file.__func__ is not Struct.from_file.__func__ 
+                    or cls.to_file is not Struct.to_file):
+                return None 
+            compiled = cls.compiled()
+            if compiled is None:
+                return None 
+            return CompiledType(compiled.order, compiled.fmt, compiled.count, compiled.decode, compiled.encode)
+        
+        # Non-Struct classes can provide their own layout
+        elif hasattr(cls, "struct_format"):
+            result = split_format(cls.struct_format)
+            if result is None:
+                return None 
+            order, fmt, count = result 
+            from_values = cls.from_struct_values
+            
+            return CompiledType(order, fmt, count, 
+                                lambda v, p: from_values(*v[p:p+count]), 
+                                lambda value, out: out.extend(value.to_struct_values()))
+    
+    return None 
+
+
+def repeat_type(compiled, count):
+    if compiled.count == 1 and compiled.fmt[-1] != "s" and compiled.fmt.isalpha():
+        fmt = f"{count}{compiled.fmt}"
+    else:
+        fmt = compiled.fmt*count 
+    
+    decode = compiled.decode 
+    encode = compiled.encode 
+    width = compiled.count 
+    
+    if decode is None:
+        decode_list = lambda v, p: list(v[p:p+count])
+    else:
+        decode_list = lambda v, p: [decode(v, p+i*width) for i in range(count)]
+    
+    def encode_list(value, out):
+        if len(value) != count:
+            raise struct.error(f"Expected {count} items, got {len(value)}")
+        if encode is None:
+            out.extend(value)
+        else:
+            for item in value:
+                encode(item, out)
+    
+    return CompiledType(compiled.order, fmt, count*width, decode_list, encode_list)
+
+
+class CompiledStruct(CompiledType):
+    def __init__(self, cls):
+        self.cls = cls 
+        orders = set()
+        fmt = ""
+        count = 0
+        plan = []
+        all_plain = True 
+        
+        for field in fields(cls):
+            if "reader" not in field.metadata:
+                continue 
+            if field.metadata.get("countvar") is not None:
+                raise TypeError("Variable length field")
+            
+            compiled = compile_reader(field.metadata["reader"])
+            if compiled is None:
+                raise TypeError("Unsupported field type")
+            if field.metadata.get("count") is not None:
+                compiled = repeat_type(compiled, field.metadata["count"])
+            
+            expect = field.metadata.get("expect")
+            if compiled.decode is not None or compiled.count != 1 or expect is not None:
+                all_plain = False 
+            
+            if compiled.order is not None:
+                orders.add(compiled.order)
+            plan.append((field.name, count, compiled, expect))
+            fmt += compiled.fmt 
+            count += compiled.count 
+        
+        if len(orders) > 1:
+            raise TypeError("Mixed byte order")
+        
+        order = orders.pop() if orders else None 
+        super().__init__(order, fmt, count)
+        self.struct = struct.Struct((order or "=") + fmt)
+        self.plan = plan 
+        self.get_values = attrgetter(*(name for name, _, _, _ in plan)) if plan else lambda value: ()
+        
+        if all_plain:
+            self.decode = lambda v, p: cls(*v[p:p+count])
+            if len(plan) == 1:
+                self.encode = lambda value, out: out.append(self.get_values(value))
+            else:
+                self.encode = lambda value, out: out.extend(self.get_values(value))
+        else:
+            self.decode = self.decode_fields 
+            self.encode = self.encode_fields 
+    
+    def decode_fields(self, values, pos):
+        args = []
+        for name, offset, compiled, expect in self.plan:
+            if compiled.decode is None:
+                value = values[pos+offset]
+            else:
+                value = compiled.decode(values, pos+offset)
+            
+            if expect is not None and not expect(value):
+                raise AssertionError(f"Assertion failed for field {name} in struct {self.cls}")
+            args.append(value)
+        
+        return self.cls(*args)
+    
+    def encode_fields(self, value, out):
+        field_values = self.get_values(value)
+        if len(self.plan) == 1:
+            field_values = (field_values, )
+        
+        for field_value, (name, offset, compiled, expect) in zip(field_values, self.plan):
+            if compiled.encode is None:
+                out.append(field_value)
+            else:
+                compiled.encode(field_value, out)
+    
+    def read(self, f, count=1):
+        size = self.struct.size*count 
+        decode = self.decode 
+        
+        if isinstance(f, BytesIO):
+            # Unpack straight from the reader's buffer instead of copying the data out first
+            offset = f.tell()
+            with f.getbuffer() as view:
+                if len(view) < offset + size:
+                    raise struct.error(f"unpack requires a buffer of {size} bytes")
+                if count == 1:
+                    result = decode(self.struct.unpack_from(view, offset), 0)
+                else:
+                    result = [decode(values, 0) for values in self.struct.iter_unpack(view[offset:offset+size])]
+            f.seek(offset + size)
+            return result 
+        
+        data = f.read(size)
+        if count == 1:
+            return decode(self.struct.unpack(data), 0)
+        else:
+            return [decode(values, 0) for values in self.struct.iter_unpack(data)]
+    
+    def write(self, f, value):
+        out = []
+        self.encode(value, out)
+        f.write(self.struct.pack(*out))
+
+
 class Struct:
+    @classmethod
+    def compiled(cls):
+        # Compiled once per class on first use, None if the layout can't be expressed as
+        # a single struct format (variable length or mixed byte order fields)
+        if "_compiled_struct" not in cls.__dict__:
+            try:
+                cls._compiled_struct = CompiledStruct(cls)
+            except (TypeError, struct.error):
+                cls._compiled_struct = None 
+        
+        return cls._compiled_struct
+    
+    @classmethod
+    def from_file_many(cls, f, count):
+        compiled = cls.compiled()
+        if compiled is None or cls.from_file.__func__ is not Struct.from_file.__func__:
+            return [cls.from_file(f) for i in range(count)]
+        
+        return compiled.read(f, count)
+    
     @classmethod
     def from_file(cls, f: BinaryReader):
+        compiled = cls.compiled()
+        if compiled is not None:
+            return compiled.read(f)
+        
         values = []
         look_back = {}
         
@@ -34,6 +303,15 @@ class Struct:
         return cls(*values)
         
     def to_file(self, f:BinaryReader):
+        compiled = self.compiled()
+        if compiled is not None:
+            try:
+                compiled.write(f, self)
+            except struct.error:
+                pass  # Let the per field writers handle or report it
+            else:
+                return 
+        
         countsrc = {}
         
         for field in fields(self):
@@ -7,9 +7,9 @@ bl_info = {
 }
 
 import bpy
-import bmesh 
 import os 
 import time 
+import numpy
 
 from bpy.props import (BoolProperty,
                        FloatProperty,
@@ -20,14 +20,24 @@ from bpy.props import (BoolProperty,
                        )
 from bpy_extras.io_utils import ExportHelper
 
-import gzip
 import importlib
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 from . import bwterrain 
 importlib.reload(bwterrain)
+from .bwterrain import heightfield
+importlib.reload(heightfield)
 from .bwterrain import bw_terrain
 importlib.reload(bwterrain)
+from .bwterrain import terrain_buffers
+importlib.reload(terrain_buffers)
+from .bwterrain import texcache
+importlib.reload(texcache)
+from .bwterrain import gzipio
+importlib.reload(gzipio)
+from .bwterrainnew import chunk_grid
+importlib.reload(chunk_grid)
 
 from dataclasses import dataclass
 from .bwterrain.bwarchivelib import BattalionArchive
@@ -37,9 +47,9 @@ from timeit import default_timer
 from .bwterrain import bwtex
 from .bwterrain import bwarchivelib
 from .bwterrain.texlib import texture_utils
-from .terrain_tools import rename, sew_terrain, reset_uv_selected_objects
+from .terrain_tools import rename, sew_terrain, reset_uv_selected_objects, read_vertex_group_weights
 
-from .write_terrain import export_terrain
+from .write_terrain import export_terrain, set_chunk_checksums
 
 importlib.reload(texture_utils)
 importlib.reload(bwarchivelib)
@@ -53,21 +63,35 @@ respathBW2 = r"D:\Wii games\BWNAExtracted\DATA\files\Data\CompoundFiles\SP_3.4_L
 respathBW = r"D:\Wii games\BattWars\P-G8WP\files\Data\CompoundFiles\C1_Bonus_Level.res"
 
 
-def open_path(path):
-    if path.endswith(".gz"):
-        return gzip.open(path, "rb") 
-    else:
-        return open(path, "rb") 
-
-
 def make_placeholder_image(name):
     return bpy.data.images.new(name, 32, 32)
 
 
+_texture_cache = None
+
+
+def get_texture_cache():
+    global _texture_cache
+    if _texture_cache is None:
+        directory = bpy.utils.user_resource("DATAFILES", path="bwterrain_texture_cache", create=True)
+        _texture_cache = texcache.TextureCache(directory)
+    return _texture_cache
+
+
 def load_tex(arc, tex):
-    data = BytesIO(tex.data)
     name = tex.name 
+    cache = get_texture_cache()
+    key = texcache.texture_key(tex)
+    
+    pixels = cache.get(key)
+    if pixels is not None:
+        height, width, _ = pixels.shape
+        img = bpy.data.images.new(name, width, height)
+        img.pixels.foreach_set(texcache.rgba8_to_pixels(pixels))
+        img.update()
+        return img 
     
+    data = BytesIO(tex.data)
     if arc.textures.is_bw1:
         texture = bwtex.BW1Texture.from_file(name, data, ignoremips=True)
     else:
@@ -76,6 +100,14 @@ def load_tex(arc, tex):
     img = texture.mipmaps[0].image 
     img.name = name
     
+    width, height = img.size
+    values = numpy.empty(width*height*4, dtype=numpy.float32)
+    img.pixels.foreach_get(values)
+    try:
+        cache.put(key, texcache.pixels_to_rgba8(values, width, height))
+    except OSError as err:
+        print("Couldn't write texture cache:", err)
+    
     return img
 
 
@@ -121,27 +153,30 @@ def unregister():
     bpy.utils.unregister_class(UIDemo)
 
 
-def make_mesh_grid(x, y, z, xsize, ysize, tilesize):
-    vtx = []
-    faces = []
-    for ix in range(xsize):
-        for iy in range(ysize):
-            offsetx = ix//4
-            offsety = iy//4
-            
-            pos = (x+(ix-offsetx)*tilesize, y+(iy-offsety)*tilesize, z)
-            vtx.append(pos)
-            
-            if (ix < xsize-1 and iy < ysize-1
-                and ((ix+1)%4 != 0 and (iy+1) % 4 != 0)):
-                faces.append(
-                    (ix*ysize + iy, 
-                    (ix+1)*ysize + iy,
-                    (ix+1)*ysize + (iy+1),
-                    ix*ysize + (iy+1))
-                    )
-    
-    return vtx, faces
+def make_terrain_mesh(name, sizex, sizey, tilesize, materials):
+    # Mesh with the grid topology, UV maps, color attributes and materials of a
+    # terrain part. import_terrain creates it once and copies it for every part.
+    vertices, faces = terrain_buffers.mesh_grid(sizex, sizey, tilesize)
+    mesh_data = bpy.data.meshes.new(name=name)
+    mesh_data.vertices.add(len(vertices))
+    mesh_data.vertices.foreach_set("co", vertices.reshape(-1))
+    mesh_data.loops.add(faces.size)
+    mesh_data.loops.foreach_set("vertex_index", faces.reshape(-1))
+    mesh_data.polygons.add(len(faces))
+    mesh_data.polygons.foreach_set("loop_start", numpy.arange(0, faces.size, 4, dtype=numpy.int32))
+    mesh_data.update(calc_edges=True)
+    
+    mesh_data.uv_layers.new(name="UVMain")
+    mesh_data.uv_layers.new(name="UVDetail")
+    
+    mesh_data.color_attributes.new(name="Blend", type="BYTE_COLOR", domain="POINT")
+    color = mesh_data.color_attributes.new(name="Color", type="BYTE_COLOR", domain="POINT")
+    mesh_data.color_attributes.active_color = color
+    
+    for mat in materials:
+        mesh_data.materials.append(mat)
+    
+    return mesh_data
             
 
 def make_layout(rows, horiz_spacing, vert_spacing, x_start=0, y_start=0):
@@ -411,9 +446,14 @@ class TerrainGrid(object):
     scale, 
     heightscale,
     materials,
-    geonode=None
+    geonode=None,
+    template_mesh=None
         ):
-        mesh_data = bpy.data.meshes.new(name=f"{name}_mesh")
+        if template_mesh is not None:
+            mesh_data = template_mesh.copy()
+            mesh_data.name = f"{name}_mesh"
+        else:
+            mesh_data = make_terrain_mesh(f"{name}_mesh", sizex, sizey, scale, materials)
         mesh_obj = bpy.data.objects.new(name, mesh_data)
         mesh_obj["BattalionWars"] = True
         mesh_obj.location = (offset[0], offset[1], 0.0)
@@ -426,47 +466,13 @@ class TerrainGrid(object):
         
         bpy.context.scene.collection.objects.link(mesh_obj)
         
-        bm = bmesh.new()
-        offset[0], offset[1]
-        vtxlist, faces = make_mesh_grid(0, 0, 0, sizex, sizey, scale)
-        for pos in vtxlist:
-            bm.verts.new(pos)
-        
-        bm.verts.ensure_lookup_table()
-        
-        for face in faces:
-            bm.faces.new([bm.verts[i] for i in face])
-        
-        bm.to_mesh(mesh_data)
-        mesh_data.update()
-        bm.free()
-        
         bpy.context.view_layer.objects.active = mesh_obj
         bpy.ops.node.new_geometry_nodes_modifier()
         mesh_obj.modifiers["GeometryNodes"].name = "TerrainRenderer"
-            
-        
-        
-        bpy.ops.object.vertex_group_add()
-        bpy.ops.object.vertex_group_add()
-        bpy.ops.object.vertex_group_add()
         
-        mesh_obj.vertex_groups["Group"].name = "Height"
-        mesh_obj.vertex_groups["Group.001"].name = "Delete"
-        mesh_obj.vertex_groups["Group.002"].name = "Material"
-        
-        bpy.ops.mesh.uv_texture_add()
-        bpy.ops.mesh.uv_texture_add()
-        
-        mesh_obj.data.uv_layers["UVMap"].name = "UVMain"
-        mesh_obj.data.uv_layers["UVMap.001"].name = "UVDetail"
-        
-        bpy.ops.geometry.color_attribute_add(name="Blend", data_type="BYTE_COLOR")
-        bpy.ops.geometry.color_attribute_add(name="Color", data_type="BYTE_COLOR")
-        
-        
-        for mat in materials:
-            mesh_obj.data.materials.append(mat)
+        mesh_obj.vertex_groups.new(name="Height")
+        mesh_obj.vertex_groups.new(name="Delete")
+        mesh_obj.vertex_groups.new(name="Material")
             
         mod = mesh_obj.modifiers["TerrainRenderer"]
         if geonode is not None:
@@ -765,8 +771,7 @@ class Timer(object):
 
 def import_terrain(terr_path, res_path, progress_update=None, cached_textures=None):
     timer = Timer()
-    with open_path(res_path) as f:
-        arc = bwarchivelib.BattalionArchive.from_file_textures(f)
+    arc = bwarchivelib.BattalionArchive.from_path_textures(res_path, textures_only=True)
     print("Textures from .res loaded in", timer.passed())
     progress_update(0.1)
     bwtextures = {}
@@ -834,88 +839,77 @@ def import_terrain(terr_path, res_path, progress_update=None, cached_textures=No
     name = os.path.basename(terr_path).replace(".out", "")
     
     PARTS = 4
+    PARTSIZE = 1024//PARTS
     
     geonode = None 
     progress_update(0.3)    
     
-    for px in range(PARTS):
-        for py in range(PARTS):
+    template = make_terrain_mesh(f"{name}_template", PARTSIZE, PARTSIZE, 4*(4/3), blender_mats)
+    loop_vertices = numpy.empty(len(template.loops), dtype=numpy.int32)
+    template.loops.foreach_get("vertex_index", loop_vertices)
+    template_uvs = {}
+    for layer_name in ("UVMain", "UVDetail"):
+        template_uvs[layer_name] = numpy.empty(len(template.loops)*2, dtype=numpy.float32)
+        template.uv_layers[layer_name].data.foreach_get("uv", template_uvs[layer_name])
+    print("Created template mesh in", timer.passed())
+    
+    # Parts are prepared on worker threads while this thread creates the objects
+    # and writes the results of the parts that are done
+    parts = [(px, py) for px in range(PARTS) for py in range(PARTS)]
+    objects = []
+    with ThreadPoolExecutor() as executor:
+        futures = [executor.submit(terrain_buffers.prepare_part, terrain, px, py, PARTSIZE, remap, loop_vertices,
+                                   template_uvs["UVMain"], template_uvs["UVDetail"])
+                   for px, py in parts]
+        
+        for (px, py), future in zip(parts, futures):
             timer.passed()
-            grid = TerrainGrid(f"{name}_{px}_{py}", (-2048+(4096/PARTS)*px, -2048+(4096/PARTS)*py, 0), 64*16//PARTS, 64*16//PARTS, 4*(4/3), 512,
-                                blender_mats, geonode)
+            grid = TerrainGrid(f"{name}_{px}_{py}", (-2048+(4096/PARTS)*px, -2048+(4096/PARTS)*py, 0), PARTSIZE, PARTSIZE, 4*(4/3), 512,
+                                blender_mats, geonode, template)
             
             if geonode is None:
                 geonode = grid.mesh_obj.modifiers["TerrainRenderer"]
-                    
-            group = grid.mesh_obj.vertex_groups["Height"]
             print("Created grid in", timer.passed())
             
-            PARTSIZE = 1024//PARTS
-            PARTSIZE_SMALL = 256//PARTS
-            
+            part = future.result()
+            print("Waited for part in",  timer.passed())
+            objects.append((grid.mesh_obj, part))
+
             # Set the vertex heights and deletion status
-            deleted = []
-            for x in range(PARTSIZE):
-                for y in range(PARTSIZE):
-                    index = x*PARTSIZE + y
-                    vtx = terrain.pointdata[x+px*PARTSIZE][y+py*PARTSIZE]
-                    if vtx is not None:
-                        group.add([index], vtx.height/512.0, "REPLACE")
-                        #vtx_color[index].color = (vtx.color.r, vtx.color.g, vtx.color.b, vtx.color.a)
-                    else:
-                        deleted.append(index)
-            grid.mesh_obj.vertex_groups["Delete"].add(deleted, 1.0, "REPLACE")         
-            print("Set Delete/Height in",  timer.passed())         
-                    
-                    
+            group = grid.mesh_obj.vertex_groups["Height"]
+            for value, indices in part.heights:
+                group.add(indices, value, "REPLACE")
+            grid.mesh_obj.vertex_groups["Delete"].add(part.deleted, 1.0, "REPLACE")
+            print("Set Delete/Height in",  timer.passed())
+
             # Set the material indices
             material_index = grid.mesh_obj.vertex_groups["Material"]
-            
-            for cx in range(PARTSIZE_SMALL):
-                for cy in range(PARTSIZE_SMALL):
-                    matindex = terrain.material_map[cx+px*PARTSIZE_SMALL][cy+py*PARTSIZE_SMALL]
-                    if matindex is not None:
-                        matindex = remap[matindex]
-                        material_index.add([
-                            (cx*4+tx)*PARTSIZE+(cy*4+ty) for tx in range(4) for ty in range(4)
-                            ],
-                            matindex/100.0, 
-                            "REPLACE")
-            print("Set Mat index in",  timer.passed())      
+            for value, indices in part.materials:
+                material_index.add(indices, value, "REPLACE")
+            print("Set Mat index in",  timer.passed())
+
             # Set vertex colors
-            vtx_color = grid.mesh_obj.data.color_attributes["Color"].data
-            
-            blend = grid.mesh_obj.data.color_attributes["Blend"].data
-            
-            for x in range(PARTSIZE):
-                for y in range(PARTSIZE):
-                    vtx = terrain.pointdata[x+px*PARTSIZE][y+py*PARTSIZE]
-                    index = x*PARTSIZE + y
-                    if vtx is not None:
-                        vtx_color[index].color = (vtx.color.r, vtx.color.g, vtx.color.b, vtx.color.a)
-                        blend[index].color = (1.0, 1.0, 1.0, vtx.color.a)
-                        
-                    else:
-                        vtx_color[index].color = (1.0, 1.0, 1.0, 0)
-                        blend[index].color = (1.0, 1.0, 1.0, 1.0)
-            print("Set vertex color in",  timer.passed())  
-            detail = grid.mesh_obj.data.uv_layers['UVDetail']
-            main = grid.mesh_obj.data.uv_layers['UVMain']
-            
-            for face in grid.mesh_obj.data.polygons:
-                for vtx_i, loop_i in zip(face.vertices, face.loop_indices):
-                    x = vtx_i//PARTSIZE
-                    y = vtx_i%PARTSIZE
-                    vtx = terrain.pointdata[x+px*PARTSIZE][y+py*PARTSIZE]
-                    if vtx is not None:
-                        detail.data[loop_i].uv = (vtx.uv_detail.x, 1-vtx.uv_detail.y)
-                        main.data[loop_i].uv = (vtx.uv_main.x, 1-vtx.uv_main.y)
+            mesh = grid.mesh_obj.data
+            mesh.color_attributes["Color"].data.foreach_set("color", part.buffers.colors)
+            mesh.color_attributes["Blend"].data.foreach_set("color", part.buffers.blend)
+            print("Set vertex color in",  timer.passed())
+
+            mesh.uv_layers['UVDetail'].data.foreach_set("uv", part.uv_detail)
+            mesh.uv_layers['UVMain'].data.foreach_set("uv", part.uv_main)
             print("Set UV coords in",  timer.passed())  
             
             if TEST_RUN:
                 raise RuntimeError("Test run complete")
                 
             progress_update(0.3 + ((px*PARTS + py)/(PARTS*PARTS))*0.7)
+    
+    bpy.data.meshes.remove(template)
+    
+    # Lets export keep the chunks of parts that aren't edited
+    source = chunk_grid.SourceChunks(terrain.sections[b"PAMC"], terrain.sections[b"KNHC"])
+    for obj, part in objects:
+        set_chunk_checksums(obj, source, part.buffers.stored_weights())
+    print("Set chunk checksums in", timer.passed())
     print("Total time:", default_timer()-start)
 
 
@@ -1248,40 +1242,18 @@ def duplicate_selected_material(self, context):
     return {"FINISHED"}
 
 
-def try_get(f, ind):
-    try:
-        val = f(ind)
-    except RuntimeError:
-        return None 
-    else:
-        return val
-    
+def apply_material_remap(obj, remap):
+    # Rewrites the Material weights of obj for a table of old index -> new index
+    weights = read_vertex_group_weights(obj, ("Material",))["Material"]
+    add_mat = obj.vertex_groups["Material"].add
+    for value, indices in terrain_buffers.group_by_value(terrain_buffers.remap_material_weights(weights, remap)):
+        add_mat(indices.tolist(), value, "REPLACE")
+
 
 def delete_material_index(index):
     bpy.context.object.active_material_index = index
-    active_index = index
     bpy.ops.object.material_slot_remove()
-    active_obj = bpy.context.active_object
-    get_mat_index = active_obj.vertex_groups["Material"].weight
-
-    replace = {}
-    
-    for i in range(len(active_obj.data.vertices)):
-        material = try_get(get_mat_index, i)
-        
-        
-        if material is not None:
-            index = int(round(material*100))
-            if index >= active_index - 1:
-                if index not in replace:
-                    replace[index] = [i]
-                else:
-                    replace[index].append(i)
-                    
-    add_mat = active_obj.vertex_groups["Material"].add
-    for mat, indices in replace.items():
-        print("moving", mat)
-        add_mat(indices, (mat-1)/100.0, "REPLACE")
+    apply_material_remap(bpy.context.active_object, terrain_buffers.deletion_remap([index - 1]))
     
     
 def delete_selected_material(self, context):
@@ -1298,32 +1270,17 @@ def delete_selected_material(self, context):
     return {"FINISHED"}
 
 
-def get_index_for_mat(slots, mat):
-    for i, slot in enumerate(slots):
-        if slot.material == mat:
-            return i
-    
-    return None 
-
-
 def delete_unused_materials(self, context):
     active_obj = bpy.context.active_object
-    all_materials = [i for i in range(len(active_obj.material_slots))]
-    all_materials.pop(0)
-    get_mat_index = active_obj.vertex_groups["Material"].weight
-    for i in range(len(active_obj.data.vertices)):
-        material = try_get(get_mat_index, i)
-        
-        if material is not None:
-            index = int(round(material*100))
-            if index+1 in all_materials:
-                all_materials.remove(index+1)
-    materials = [bpy.context.object.material_slots[i].material for i in all_materials]
+    weights = read_vertex_group_weights(active_obj, ("Material",))["Material"]
+    used = numpy.unique(terrain_buffers.material_indices(weights))
+    unused = [i for i in range(len(active_obj.material_slots) - 1) if i not in used]
     
-    for mat in materials:
-        i = get_index_for_mat(active_obj.material_slots, mat)
-        assert i is not None
-        delete_material_index(i)
+    # Slots are removed from the back so that the other slot indices stay the same
+    for i in reversed(unused):
+        bpy.context.object.active_material_index = i + 1
+        bpy.ops.object.material_slot_remove()
+    apply_material_remap(active_obj, terrain_buffers.deletion_remap(unused))
     
     rename()
     return {"FINISHED"}
@@ -1392,7 +1349,7 @@ def sort_materials(self, context):
     sorted_materials = [mat for mat in materials]
     get_matname = lambda x: x.image.name.split(".")[0].lower()
     sorted_materials.sort(key=lambda mat:get_matname(mat.node_tree.nodes["texturemain"]) +get_matname(mat.node_tree.nodes["texturedetail"]))
-    remap = {}
+    remap = numpy.arange(terrain_buffers.MATERIAL_INDICES)
     for i, mat in enumerate(materials):
         remap[i] = sorted_materials.index(mat)
     for i, slot in enumerate(active_obj.material_slots):
@@ -1401,26 +1358,7 @@ def sort_materials(self, context):
             mat = sorted_materials[matindex]
             slot.material = mat 
     
-    active_obj = bpy.context.active_object
-    get_mat_index = active_obj.vertex_groups["Material"].weight
-
-    replace = {}
-    
-    for i in range(len(active_obj.data.vertices)):
-        material = try_get(get_mat_index, i)
-        
-        
-        if material is not None:
-            index = int(round(material*100))
-            if index not in replace:
-                replace[index] = [i]
-            else:
-                replace[index].append(i)
-                    
-    add_mat = active_obj.vertex_groups["Material"].add
-    for mat, indices in replace.items():
-        print("moving", mat, "to", remap[mat])
-        add_mat(indices, remap[mat]/100.0, "REPLACE")
+    apply_material_remap(active_obj, remap)
     rename()
     
     return {"FINISHED"}
@@ -0,0 +1,175 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from bwterrainnew.binaryreader import BinaryReader
+from bwterrainnew.bw_terrain import TerrainFile, LazyTerrainFile
+from bwterrain.bwarchivelib import BattalionArchive
+
+
+def find_levels(directory):
+    levels = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".out"):
+            continue
+
+        out_path = os.path.join(directory, filename)
+        res_path = None
+        for suffix in ("_Level.res.gz", "_Level.res"):
+            path = out_path[:-len(".out")] + suffix
+            if os.path.exists(path):
+                res_path = path
+                break
+
+        levels.append((out_path, res_path))
+
+    return levels
+
+
+def read_terrain(path):
+    with open(path, "rb") as f:
+        return BinaryReader(f.read()).read_object(TerrainFile)
+
+
+def write_terrain(terrain, path):
+    out = BinaryReader()
+    out.write_object(terrain)
+    with open(path, "wb") as f:
+        f.write(out.getvalue())
+
+
+def validate_level(out_path, res_path):
+    problems = []
+    terrain = read_terrain(out_path)
+
+    out = BinaryReader()
+    out.write_object(terrain)
+    out.seek(0)
+    reloaded = out.read_object(TerrainFile)
+
+    if reloaded.materials.materials != terrain.materials.materials:
+        problems.append("materials differ after round trip")
+    for cx in range(64):
+        for cy in range(64):
+            if reloaded.get_chunk(cx, cy) != terrain.get_chunk(cx, cy):
+                problems.append(f"chunk {cx},{cy} differs after round trip")
+
+    if res_path is None:
+        problems.append("no _Level.res found")
+    else:
+        arc = BattalionArchive.from_path_textures(res_path, textures_only=True)
+        textures = set(tex.name.lower() for tex in arc.textures.textures)
+
+        for mat in terrain.materials.materials:
+            for name in (mat.mat_main, mat.mat_detail):
+                name = name.strip(b"\x00").decode("ascii", errors="replace").lower()
+                if name not in textures:
+                    problems.append(f"texture {name} missing from {os.path.basename(res_path)}")
+
+    return problems
+
+
+def regenerate_collision(out_path, res_path, output_dir):
+    terrain = read_terrain(out_path)
+    terrain.collmap.mark_all_dirty()
+    dest = out_path if output_dir is None else os.path.join(output_dir, os.path.basename(out_path))
+    write_terrain(terrain, dest)
+    return [f"written to {dest}"]
+
+
+def list_materials(out_path, res_path):
+    with LazyTerrainFile(out_path) as terrain:
+        return [
+            "{:3} {:16} {:16} {} {} {} {}".format(
+                i, mat.mat_main.strip(b"\x00").decode("ascii", errors="replace"),
+                mat.mat_detail.strip(b"\x00").decode("ascii", errors="replace"),
+                mat.unk_1, mat.unk_2, mat.unk_3, mat.unk_4)
+            for i, mat in enumerate(terrain.materials.materials)
+        ]
+
+
+def export_heightmap(out_path, res_path, output_dir):
+    # 16 bit binary PGM, one pixel per terrain point with rows going along y.
+    # Chunks that don't exist are left at 0.
+    heights = numpy.zeros((1024, 1024), dtype=">u2")
+
+    with LazyTerrainFile(out_path) as terrain:
+        for cx, row in enumerate(terrain.chunkmap.entries):
+            for cy, entry in enumerate(row):
+                if entry.chunk_exists():
+                    chunk = terrain.chunks.chunks[entry.index]
+                    values = numpy.array([tile.heights for tile in chunk.tiles])
+                    # tile_y, tile_x, y, x -> tile_y, y, tile_x, x
+                    values = values.reshape(4, 4, 4, 4).transpose(0, 2, 1, 3).reshape(16, 16)
+                    heights[cx*16:cx*16+16, cy*16:cy*16+16] = values
+
+    name = os.path.basename(out_path)[:-len(".out")] + ".pgm"
+    dest = os.path.join(output_dir or os.path.dirname(out_path), name)
+    with open(dest, "wb") as f:
+        f.write(b"P5\n1024 1024\n65535\n")
+        f.write(heights.tobytes())
+
+    return [f"written to {dest}"]
+
+
+def run_level(command, out_path, res_path, output_dir):
+    try:
+        if command == "validate":
+            return validate_level(out_path, res_path), True
+        elif command == "regen-collision":
+            return regenerate_collision(out_path, res_path, output_dir), False
+        elif command == "materials":
+            return list_materials(out_path, res_path), False
+        elif command == "heightmap":
+            return export_heightmap(out_path, res_path, output_dir), False
+    except Exception as err:
+        return [f"{type(err).__module__}.{type(err).__name__}: {err}".replace("builtins.", "")], True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Batch tools for Battalion Wars terrain files that don't need Blender.")
+    parser.add_argument("command", choices=("validate", "regen-collision", "materials", "heightmap"),
+                        help=("validate: round trip every .out and check its textures exist in the _Level.res, "
+                              "regen-collision: rebuild the COLM section, "
+                              "materials: list terrain materials, "
+                              "heightmap: write the raw heights as a 16 bit PGM"))
+    parser.add_argument("directory", help="CompoundFiles directory with .out and _Level.res(.gz) files")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Output directory for regen-collision/heightmap. regen-collision overwrites the .out files if not set.")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Amount of worker processes")
+    args = parser.parse_args(argv)
+
+    levels = find_levels(args.directory)
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(run_level, args.command, out_path, res_path, args.output)
+                   for out_path, res_path in levels]
+
+        for (out_path, res_path), future in zip(levels, futures):
+            lines, is_problem = future.result()
+            name = os.path.basename(out_path)
+
+            if args.command == "validate" or is_problem:
+                status = "FAIL" if lines else "OK"
+                print(f"{status} {name}")
+                if lines:
+                    failed += 1
+            else:
+                print(name)
+
+            for line in lines:
+                print("   ", line)
+
+    print(f"{len(levels)} levels, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
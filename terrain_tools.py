@@ -3,6 +3,10 @@ import bmesh
 import os 
 print(os.getcwd())
 import importlib
+import numpy
+
+from .bwterrain import terrain_buffers
+importlib.reload(terrain_buffers)
 
 
 def rename():
@@ -21,8 +25,9 @@ def sew_terrain(selected_only, visible_only):
         objects = bpy.context.selected_objects
     else:
         objects = bpy.context.scene.objects.values()
-    corner_heights = {}
-
+    
+    sewn_objects = []
+    parts = []
     for obj in objects:
         if obj.get("BattalionWars", False) and (not visible_only or obj.visible_get()):
             vtx_count = len(obj.data.vertices)
@@ -34,29 +39,23 @@ def sew_terrain(selected_only, visible_only):
             base_y = int((obj.location[1] + 2048))//4
             
             print(obj.name, base_x, base_y)
-            get_weight = obj.vertex_groups["Height"].weight
-            
-            for ix in range(size):
-                x = base_x + ix - (base_x + ix)//4
-                
-                for iy in range(size):
-                    y = base_y + iy - (base_y + iy)//4
-                    
-                    if 0 <= base_x + ix < 1024 and 0 <= base_y + iy < 1024:
-                        if (x,y) not in corner_heights:
-                            corner_heights[(x,y)] = []
-                      
-                        try:
-                            weight = get_weight(iy + ix*size)
-                        except RuntimeError:
-                            pass 
-                        else:
-                            corner_heights[(x,y)].append(weight)
-
-
+            heights = read_vertex_group_weights(obj, ("Height",))["Height"]
+            sewn_objects.append(obj)
+            parts.append((size, base_x, base_y, heights))
+    
+    for obj, new_heights in zip(sewn_objects, terrain_buffers.sew_heights(parts)):
+        add_weight = obj.vertex_groups["Height"].add
+        for value, indices in terrain_buffers.group_by_value(new_heights):
+            add_weight(indices.tolist(), value, "REPLACE")
 
+def reset_uv_selected_objects(main_uv=True, detail_uv=True, objects=None, selected_vertices_only=False):
+    # objects defaults to the selected objects. With selected_vertices_only only the
+    # loops of selected vertices are reset.
+    if objects is None:
+        objects = bpy.context.selected_objects
+    
     for obj in objects:
-        if obj.get("BattalionWars", False) and (not visible_only or obj.visible_get()):
+        if obj.get("BattalionWars", False):
             vtx_count = len(obj.data.vertices)
             size = int(vtx_count**0.5)
             assert vtx_count**0.5 % 1 == 0, "needs to be a square number"
@@ -65,53 +64,43 @@ def sew_terrain(selected_only, visible_only):
             base_x = int((obj.location[0] + 2048))//4
             base_y = int((obj.location[1] + 2048))//4
             
-            print(obj.name, base_x, base_y)
-            add_weight = obj.vertex_groups["Height"].add
+            mesh = obj.data
+            loop_vertices = numpy.empty(len(mesh.loops), dtype=numpy.int32)
+            mesh.loops.foreach_get("vertex_index", loop_vertices)
             
-            for ix in range(size):
-                x = base_x + ix - (base_x + ix)//4
-                
-                for iy in range(size):
-                    y = base_y + iy - (base_y + iy)//4
-                    
-                    if 0 <= base_x + ix < 1024 and 0 <= base_y + iy < 1024:
-                        if (x,y) in corner_heights and len(corner_heights[(x,y)]) > 1:
-                            avg = sum(corner_heights[(x,y)])/len(corner_heights[(x,y)])
-                            add_weight([iy + ix*size], avg, "REPLACE")
-
-def reset_uv_selected_objects(main_uv=True, detail_uv=True):
-    for obj in bpy.context.selected_objects:
-        if obj.get("BattalionWars", False):
-            vtx_count = len(obj.data.vertices)
-            size = int(vtx_count**0.5)
-            assert vtx_count**0.5 % 1 == 0, "needs to be a square number"
-            assert size % 4 == 0, "needs to be a multiple of 4"
+            selected = None
+            if selected_vertices_only:
+                selected = numpy.empty(vtx_count, dtype=bool)
+                mesh.vertices.foreach_get("select", selected)
+            loop_uvs, reset = terrain_buffers.tile_corner_loop_uvs(loop_vertices, size, base_x, base_y, selected)
             
-            base_x = int((obj.location[0] + 2048))//4
-            base_y = int((obj.location[1] + 2048))//4
-
-            detail = obj.data.uv_layers['UVDetail']
-            main = obj.data.uv_layers['UVMain']
+            layers = []
+            if main_uv:
+                layers.append(mesh.uv_layers['UVMain'])
+            if detail_uv:
+                layers.append(mesh.uv_layers['UVDetail'])
             
-            for face in obj.data.polygons:
-                for vtx_i, loop_i in zip(face.vertices, face.loop_indices):
-                    local_x = vtx_i//size
-                    local_y = vtx_i%size
-                    
-                    x = base_x + local_x 
-                    y = base_y + local_y
-                    
-                    cx = y // 16 
-                    cy = x // 16
-                    
-                    if 0 <= x < 1024 and 0 <= y < 1024:
-                        tile_x = x % 16 
-                        tile_y = y % 16
-                        
-                        in_tile_x = x % 4 
-                        in_tile_y = y % 4
-     
-                        if main_uv:
-                            main.data[loop_i].uv = (in_tile_x/3.0, in_tile_y/3.0)
-                        if detail_uv:
-                            detail.data[loop_i].uv = (in_tile_x/3.0, in_tile_y/3.0)
\ No newline at end of file
+            for layer in layers:
+                if reset.all():
+                    uvs = loop_uvs
+                else:
+                    uvs = numpy.empty((len(mesh.loops), 2), dtype=numpy.float32)
+                    layer.data.foreach_get("uv", uvs.reshape(-1))
+                    uvs[reset] = loop_uvs[reset]
+                layer.data.foreach_set("uv", uvs.reshape(-1))
+            mesh.update()
+
+def read_vertex_group_weights(obj, names):
+    # Reads the weights of several vertex groups in a single pass over the vertices,
+    # vertices that aren't in a group get NaN
+    vtx_count = len(obj.data.vertices)
+    group_indices = {obj.vertex_groups[name].index: name for name in names}
+    weights = {name: numpy.full(vtx_count, numpy.nan) for name in names}
+    
+    for vtx in obj.data.vertices:
+        for group in vtx.groups:
+            name = group_indices.get(group.group)
+            if name is not None:
+                weights[name][vtx.index] = group.weight
+    
+    return weights
@@ -0,0 +1,34 @@
+"""Load time of BWTerrainV2's structured arrays against decoding every chunk
+into Tile dataclasses, the way chunks were loaded before.
+
+    python tests/benchmark_bw_terrain.py [file.out]
+
+Without a file a synthetic map with every chunk present is used."""
+import os
+import sys
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bwterrain import bw_terrain
+
+from synthetic import make_out
+
+
+def main(args):
+    if args:
+        with open(args[0], "rb") as f:
+            data = f.read()
+    else:
+        data = make_out(fill=1.0, seed=1)
+
+    timer = bw_terrain.Timer()
+    terrain = bw_terrain.BWTerrainV2(BytesIO(data))
+    print("Structured load:", timer.passed())
+
+    chunks = bw_terrain.initiate_from_section(bw_terrain.Chunk, terrain.sections[b"KNHC"])
+    print("Dataclass load:", timer.passed())
+    print("Chunks:", len(chunks), "points:", int(terrain.point_exists.sum()))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
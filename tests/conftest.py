@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The repository root is a Blender addon package, its modules are imported
+# directly so that the tests run without bpy
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
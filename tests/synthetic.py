@@ -0,0 +1,52 @@
+import random
+import struct
+
+
+def section(name, data):
+    return name[::-1] + struct.pack("<I", len(data)) + data
+
+
+def make_out(fill=0.5, seed=1, materials=5, chunks=None):
+    """Bytes of a small but complete .out file with random chunks. chunks is a
+    (64, 64) nested list of booleans, by default each chunk exists with
+    probability fill. Material names are sorted already."""
+    rnd = random.Random(seed)
+    if chunks is None:
+        chunks = [[rnd.random() < fill for cy in range(64)] for cx in range(64)]
+
+    records = []
+    chunkmap = b""
+    for cx in range(64):
+        for cy in range(64):
+            if chunks[cx][cy]:
+                chunkmap += struct.pack(">BBH", 0, 1, len(records))
+                record = b""
+                for t in range(16):
+                    record += struct.pack(">16H", *[rnd.randrange(0, 8000) for i in range(16)])
+                    record += bytes(rnd.randrange(256) for i in range(64))
+                    record += struct.pack(">8H", *[rnd.randrange(65536) for i in range(8)])
+                    record += struct.pack(">32H", *[rnd.randrange(65536) for i in range(32)])
+                    record += struct.pack(">I", rnd.randrange(materials))
+                records.append(record)
+            else:
+                chunkmap += struct.pack(">BBH", 0, 2, 0xFFFF)
+
+    out = section(b"TERR", struct.pack("<IIII", 64, 64, 1, materials))
+    out += section(b"CHNK", b"".join(records))
+    out += section(b"GPNF", bytes(0x4C))
+    out += section(b"CMAP", chunkmap)
+    out += section(b"UWCT", bytes(0xB4*16))
+    info = struct.pack(">14I", 0x66, 0, 0, 0, 0, 0, 48, 48, 0, 0, 2*2304, 2*256, 0, 0)
+    out += section(b"COLM", info + struct.pack(">2304H", *([0]*2304)) + struct.pack(">256h", *([16]*256)))
+    mats = b""
+    for i in range(materials):
+        mats += (b"tex%02d" % i).ljust(16, b"\0") + (b"det%02d" % i).ljust(16, b"\0") + struct.pack("<IIII", i, 1, 2, 3)
+    out += section(b"MATL", mats)
+    return out
+
+
+def write_out(path, **kwargs):
+    data = make_out(**kwargs)
+    with open(path, "wb") as f:
+        f.write(data)
+    return data
@@ -0,0 +1,40 @@
+from io import BytesIO
+
+import numpy
+
+from bwterrain import bw_terrain
+
+from synthetic import make_out
+
+
+def test_structured_load_matches_dataclasses():
+    terrain = bw_terrain.BWTerrainV2(BytesIO(make_out(fill=0.1, seed=3)))
+    chunks = bw_terrain.initiate_from_section(bw_terrain.Chunk, terrain.sections[b"KNHC"])
+
+    for chunkx in range(64):
+        for chunky in range(64):
+            mapchunk = bw_terrain.MapChunkReference.from_array(terrain.sections[b"PAMC"], chunky*64 + chunkx)
+            if mapchunk.b != 1:
+                assert terrain.get_vertex(chunkx*16, chunky*16) is None
+                assert terrain.material_map[chunkx*4, chunky*4] == -1
+                continue
+
+            chunk = chunks[mapchunk.chunkindex]
+            for tilex in range(4):
+                for tiley in range(4):
+                    tile = chunk.tiles[tiley*4 + tilex]
+                    assert terrain.material_map[chunkx*4 + tilex, chunky*4 + tiley] == tile.material_index
+                    for x in range(4):
+                        for y in range(4):
+                            expected = tile.get_vertex(x, y)
+                            vertex = terrain.get_vertex(chunkx*16 + tilex*4 + x, chunky*16 + tiley*4 + y)
+                            values = (expected.height, expected.color.r, expected.color.g, expected.color.b,
+                                      expected.color.a, expected.uv_main.x, expected.uv_main.y,
+                                      expected.uv_detail.x, expected.uv_detail.y)
+                            got = (vertex.height, vertex.color.r, vertex.color.g, vertex.color.b,
+                                   vertex.color.a, vertex.uv_main.x, vertex.uv_main.y,
+                                   vertex.uv_detail.x, vertex.uv_detail.y)
+                            assert numpy.array_equal(numpy.float32(values), numpy.float32(got))
+
+    assert terrain.get_vertex(1024, 0) is None
+    assert terrain.material_map[256, 0] == -1
@@ -0,0 +1,211 @@
+import gzip
+import os
+import stat
+from io import BytesIO
+
+import pytest
+
+from bwterrain.bwarchivelib import (Animation, BattalionArchive, LazySection, LuaScript, Model, NamedSection,
+                                  NameIndex, TextureArchive, TextureBW2, read_uint32)
+
+
+def make_archive():
+    arc = BattalionArchive()
+    for name in ("alpha", "beta", "gamma"):
+        arc.add_script(LuaScript(b"PRCS", name, name.encode("ascii")*10))
+    return arc
+
+
+@pytest.mark.parametrize("name", ["level.res", "level.res.gz"])
+def test_save_keeps_permissions(tmp_path, name):
+    path = str(tmp_path / name)
+    make_archive().save(path)
+    os.chmod(path, 0o644)
+
+    make_archive().save(path)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+    opener = gzip.open if name.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        arc = BattalionArchive.from_file(f)
+    assert arc.get_script("beta").data == b"beta"*10
+    assert [f for f in os.listdir(tmp_path) if f.endswith(".tmp")] == []
+
+
+def test_save_new_file_uses_umask(tmp_path):
+    path = str(tmp_path / "level.res")
+    umask = os.umask(0o022)
+    try:
+        make_archive().save(path)
+    finally:
+        os.umask(umask)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o644
+
+
+def test_renamed_script_is_found_by_its_new_name():
+    arc = make_archive()
+    script = arc.get_script("beta")
+    script.name = "delta"
+
+    assert arc.get_script("delta") is script
+    assert arc.get_script("beta") is None
+    assert arc.get_script("alpha").name == "alpha"
+
+
+class Named(NamedSection):
+    def __init__(self, name):
+        super().__init__(b"TEST", b"")
+        self.name = name
+
+
+def test_name_index_matches_linear_search():
+    resources = [Named(name) for name in ("a", "B", "b", "c")]
+    index = NameIndex()
+
+    def linear(key):
+        for res in resources:
+            if res.name.lower() == key:
+                return res
+        return None
+
+    for key in ("a", "b", "c", "d"):
+        assert index.get(resources, key) is linear(key)
+
+    resources[0].name = "d"
+    resources[3].name = "A"
+    for key in ("a", "b", "c", "d"):
+        assert index.get(resources, key) is linear(key)
+
+
+class CountingIndex(NameIndex):
+    def __init__(self):
+        super().__init__()
+        self.rebuilds = 0
+        self.keys = 0
+        key = self.key
+
+        def counting_key(res):
+            self.keys += 1
+            return key(res)
+        self.key = counting_key
+
+    def rebuild(self, resources):
+        self.rebuilds += 1
+        super().rebuild(resources)
+
+
+def test_name_index_updates_without_scanning():
+    resources = [Named("res%d" % i) for i in range(1000)]
+    resources.append(Named("RES5"))
+    index = CountingIndex()
+    assert index.get(resources, "res5") is resources[5]
+    index.keys = 0
+
+    # Misses, deletes and renames touch single entries
+    for i in range(100):
+        assert index.get(resources, "missing%d" % i) is None
+        res = resources.pop(0)
+        index.removed(res)
+        resources[-1].name = "renamed%d" % i
+        assert index.get(resources, "renamed%d" % i) is resources[-1]
+    assert index.rebuilds == 1
+    assert index.keys < 1000
+
+    # A duplicate takes the place of a deleted resource, renamed resources
+    # keep their place in the list
+    resources = [Named(name) for name in ("a", "b", "A", "c", "d")]
+    index = CountingIndex()
+    assert index.get(resources, "a") is resources[0]
+    index.removed(resources.pop(0))
+    assert index.get(resources, "a") is resources[1]
+    resources[3].name = "B"
+    resources[2].name = "b"
+    assert index.get(resources, "b") is resources[0]
+    index.removed(resources.pop(0))
+    assert index.items["b"] == [resources[1], resources[2]]
+    assert index.get(resources, "b") is resources[1]
+    assert index.rebuilds == 1
+
+def make_full_archive():
+    arc = make_archive()
+    arc.textures = TextureArchive(b"RXET", b"level", [TextureBW2(b"DXTG", "tex", b"T2\x00" + bytes(range(200)))], False)
+    arc.sections.append(arc.textures)
+    arc.sections.append(Model("model", b"MODEL" + bytes(range(100, 250))))
+    arc.sections.append(Animation("anim", b"ANIM"*20))
+    return arc
+
+
+def raw_sections(path):
+    # Everything but the texture archive as plain sections, like the lazy ones
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        arc = BattalionArchive.from_file_textures(f)
+    return arc, [(sec.secname, sec.data) for sec in arc.sections if sec is not arc.textures]
+
+
+@pytest.mark.parametrize("name", ["level.res", "level.res.gz"])
+def test_lazy_sections_survive_saving_to_their_source(tmp_path, name):
+    path = str(tmp_path / name)
+    make_full_archive().save(path)
+    _, expected = raw_sections(path)
+    assert len(expected) == 5
+
+    arc = BattalionArchive.from_path_textures(path)
+    arc.textures.textures[0].data = b"T2\x00changed"
+    arc.save(path)
+    # The sections that were still in the old file read from the new one
+    assert [(sec.secname, sec.data) for sec in arc.sections if sec is not arc.textures] == expected
+
+    arc = BattalionArchive.from_path_textures(path)
+    arc.save(path)
+    arc.save(path)
+    saved, sections = raw_sections(path)
+    assert sections == expected
+    assert saved.textures.textures[0].data == b"T2\x00changed"
+
+
+@pytest.mark.parametrize("name", ["level.res", "level.res.gz"])
+def test_untouched_lazy_sections_write_identical(tmp_path, name):
+    path = str(tmp_path / name)
+    make_full_archive().save(path)
+    opener = gzip.open if name.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        original = f.read()
+
+    arc = BattalionArchive.from_path_textures(path)
+    lazy = [sec for sec in arc.sections if isinstance(sec, LazySection)]
+    assert len(lazy) == 5
+    f = BytesIO()
+    arc.write(f)
+    assert f.getvalue() == original
+    assert not any(sec.loaded for sec in lazy)
+
+    # Reading the data doesn't change what is written
+    assert lazy[0].data == original[lazy[0].offset:lazy[0].offset + lazy[0].size]
+    f = BytesIO()
+    arc.write(f)
+    assert f.getvalue() == original
+
+
+@pytest.mark.parametrize("name", ["level.res", "level.res.gz"])
+def test_textures_only(tmp_path, name):
+    path = str(tmp_path / name)
+    make_full_archive().save(path)
+
+    opener = gzip.open if name.endswith(".gz") else open
+    with opener(path, "rb") as f:
+        full = BattalionArchive.from_file(f)
+        f.seek(0)
+        assert f.read(4) == b"RXET"
+        textures_end = 8 + read_uint32(f)
+        f.seek(0)
+        arc = BattalionArchive.from_file_textures(f, textures_only=True)
+        # Nothing past the texture archive was read
+        assert f.tell() == textures_end
+
+    assert arc.sections == [arc.textures]
+    assert [(tex.name, tex.data) for tex in arc.textures.textures] == \
+           [(tex.name, tex.data) for tex in full.textures.textures]
+    arc = BattalionArchive.from_path_textures(path, textures_only=True)
+    assert arc.sections == [arc.textures] and arc.textures.textures[0].name == "tex"
+    with pytest.raises(AssertionError):
+        arc.write(BytesIO())
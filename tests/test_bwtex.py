@@ -0,0 +1,44 @@
+from io import BytesIO
+
+import numpy
+import pytest
+
+from bwterrain import bwtex
+from bwterrain.texlib.texture_utils import Image, generate_mipmap_chain
+
+
+def make_texture(size=32):
+    rng = numpy.random.default_rng(0)
+    pixels = rng.integers(0, 256, (size, size, 4)).astype(numpy.int32)
+    tex = bwtex.BW1Texture("TEST")
+    tex.fmt = "DXT1"
+    tex.unkint2, tex.unkint3, tex.unkint4, tex.unkint5, tex.unkint6, tex.unkint7 = bwtex.FORMATDEFAULTSBW1["DXT1"]
+    tex.mipmaps = [Image.from_rgba(mip) for mip in generate_mipmap_chain(pixels, 4)]
+    data = BytesIO()
+    tex.write(data)
+    return data.getvalue()
+
+
+@pytest.mark.parametrize("ignoremips", [False, True])
+def test_from_file_stops_at_the_end_of_the_texture(tmp_path, ignoremips):
+    texture = make_texture()
+    path = tmp_path / "textures.bin"
+    path.write_bytes(texture + b"NEXTSECTION")
+
+    with open(path, "rb") as f:
+        f.seek(0x10)
+        tex = bwtex.BW1Texture.from_file("TEST", f, ignoremips)
+        if ignoremips:
+            # Only the first level is read, the caller skips the rest
+            assert len(tex.mipmaps) == 1
+        else:
+            assert f.read() == b"NEXTSECTION"
+
+    memory = BytesIO(texture + b"NEXTSECTION")
+    memory.seek(0x10)
+    in_memory = bwtex.BW1Texture.from_file("TEST", memory, ignoremips)
+    assert in_memory.mipmaps.levels == tex.mipmaps.levels
+    for (offset, size, _, _) in tex.mipmaps.levels:
+        assert bytes(tex.mipmaps.data[offset:offset+size]) == bytes(in_memory.mipmaps.data[offset:offset+size])
+    if not ignoremips:
+        assert memory.read() == b"NEXTSECTION"
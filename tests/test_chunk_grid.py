@@ -0,0 +1,161 @@
+import numpy
+
+from bwterrain.terrain_buffers import mesh_grid
+from bwterrainnew import bw_terrain, chunk_grid
+from bwterrainnew.binaryreader import BinaryReader
+
+from synthetic import make_out
+
+
+SIZE = 64
+MATERIALS = 5
+
+
+def make_object(seed, base_x, base_y):
+    rng = numpy.random.default_rng(seed)
+    count = SIZE*SIZE
+    _, faces = mesh_grid(SIZE, SIZE, 16/3)
+    loops = faces.reshape(-1)
+
+    def float32(values):
+        return values.astype(numpy.float32).astype(numpy.float64)
+
+    heights = float32(rng.random(count))
+    heights[rng.random(count) < 0.2] = numpy.nan
+    materials = float32(rng.integers(0, MATERIALS, count)/100.0)
+    materials[rng.random(count) < 0.2] = numpy.nan
+    return dict(
+        size=SIZE, base_x=base_x, base_y=base_y, remap=list(range(MATERIALS)),
+        heights=heights, deletes=numpy.full(count, numpy.nan), materials=materials,
+        colors=(rng.integers(0, 256, count*4)/255).astype(numpy.float32),
+        blend=(rng.integers(0, 256, count*4)/255).astype(numpy.float32),
+        loop_vertices=loops,
+        uv_main=rng.random(len(loops)*2).astype(numpy.float32),
+        uv_detail=rng.random(len(loops)*2).astype(numpy.float32))
+
+
+def add_object(grid, obj, name="obj"):
+    return grid.add_object(
+        name, obj["size"], obj["base_x"], obj["base_y"], obj["remap"],
+        obj["heights"], obj["deletes"], obj["materials"], obj["colors"], obj["blend"],
+        obj["loop_vertices"], obj["uv_main"], obj["uv_detail"])
+
+
+def write(terrain):
+    out = BinaryReader()
+    out.write_object(terrain)
+    return out.getvalue()
+
+
+def chunk_sections(data):
+    sections = bw_terrain.read_section_offsets(data)
+    result = []
+    for name in (b"CHNK", b"CMAP"):
+        offset, size = sections[name]
+        result.append(data[offset:offset+8+size])
+    return result
+
+
+def read_lazy(path):
+    with bw_terrain.LazyTerrainFile(str(path)) as terrain:
+        for name in terrain.SECTIONS:
+            if name != "chunks":
+                getattr(terrain, name)
+        source = chunk_grid.SourceChunks.from_data(terrain.data, terrain.material_remap)
+        terrain.chunks = bw_terrain.ChunkSection()
+    return terrain, source
+
+
+def export_with_source(path, steps):
+    # steps: (object, whether it's unchanged since the file was written)
+    terrain, source = read_lazy(path)
+    grid = chunk_grid.ChunkGrid(source)
+    for obj, unchanged in steps:
+        if unchanged and grid.splice(obj["base_x"], obj["base_y"], obj["size"], list(range(MATERIALS))):
+            continue
+        add_object(grid, obj)
+    grid.apply_to(terrain)
+    return write(terrain)
+
+
+def export_full(base, objects):
+    terrain = BinaryReader(base).read_object(bw_terrain.TerrainFile)
+    grid = chunk_grid.ChunkGrid()
+    for obj in objects:
+        add_object(grid, obj)
+    grid.apply_to(terrain)
+    return write(terrain)
+
+
+def test_splice_unchanged_objects_matches_full_write(tmp_path):
+    base = make_out(fill=0.0, materials=MATERIALS)
+    objects = [make_object(i, (i % 2)*SIZE, (i//2)*SIZE) for i in range(4)]
+    path = tmp_path / "level.out"
+    path.write_bytes(export_full(base, objects))
+
+    terrain, source = read_lazy(path)
+    grid = chunk_grid.ChunkGrid(source)
+    for obj in objects:
+        assert grid.splice(obj["base_x"], obj["base_y"], obj["size"], list(range(MATERIALS)))
+    grid.apply_to(terrain)
+    assert not terrain.collmap.dirty_chunks
+    assert write(terrain) == path.read_bytes()
+
+
+def test_splice_refuses_unaligned_and_missing_materials(tmp_path):
+    path = tmp_path / "level.out"
+    path.write_bytes(make_out(fill=1.0, materials=MATERIALS))
+    _, source = read_lazy(path)
+
+    assert not chunk_grid.ChunkGrid().splice(0, 0, SIZE, list(range(MATERIALS)))
+    assert not chunk_grid.ChunkGrid(source).splice(8, 0, SIZE, list(range(MATERIALS)))
+    assert not chunk_grid.ChunkGrid(source).splice(0, 0, SIZE, [-1]*MATERIALS)
+
+
+def test_overlapping_objects_in_both_orders(tmp_path):
+    # a was written to the file and is unchanged, b was edited and overlaps
+    # half of a. The result has to be the same as adding both objects.
+    base = make_out(fill=0.0, materials=MATERIALS)
+    a = make_object(1, 0, 0)
+    b = make_object(2, SIZE//2, 0)
+    path = tmp_path / "level.out"
+    path.write_bytes(export_full(base, [a]))
+
+    for order in ([(a, True), (b, False)], [(b, False), (a, True)]):
+        expected = export_full(base, [obj for obj, _ in order])
+        assert chunk_sections(export_with_source(path, order)) == chunk_sections(expected)
+
+
+def test_only_changed_chunks_are_dirty(tmp_path):
+    base = make_out(fill=0.0, materials=MATERIALS)
+    objects = [make_object(i, (i % 2)*SIZE, (i//2)*SIZE) for i in range(4)]
+    path = tmp_path / "level.out"
+    path.write_bytes(export_full(base, objects))
+
+    changed = make_object(10, SIZE, SIZE)
+    terrain, source = read_lazy(path)
+    grid = chunk_grid.ChunkGrid(source)
+    for obj in objects[:3]:
+        assert grid.splice(obj["base_x"], obj["base_y"], obj["size"], list(range(MATERIALS)))
+    add_object(grid, changed)
+    grid.apply_to(terrain)
+
+    chunks = SIZE//16
+    expected = set((cx, cy) for cx in range(chunks, 2*chunks) for cy in range(chunks, 2*chunks))
+    assert terrain.collmap.dirty_chunks == expected
+    assert chunk_sections(write(terrain)) == chunk_sections(export_full(base, objects[:3] + [changed]))
+
+
+def test_object_checksum_covers_material_slots():
+    obj = make_object(1, 0, 0)
+
+    def checksum(material_keys):
+        return chunk_grid.object_checksum(
+            obj["size"], obj["base_x"], obj["base_y"], material_keys,
+            obj["heights"], obj["deletes"], obj["materials"], obj["colors"], obj["blend"],
+            obj["loop_vertices"], obj["uv_main"], obj["uv_detail"])
+
+    keys = [("tex00", "det00", 0, 1, 2, 3), ("tex01", "det01", 1, 1, 2, 3)]
+    assert checksum(keys) == checksum(list(keys))
+    assert checksum(keys) != checksum(keys[::-1])
+    assert checksum(keys) != checksum([keys[0], ("tex01", "det01", 1, 1, 2, 4)])
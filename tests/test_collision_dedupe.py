@@ -0,0 +1,92 @@
+import random
+
+from bwterrainnew import bw_terrain
+from bwterrainnew.binaryreader import BinaryReader
+
+from synthetic import make_out
+
+
+class LinearValuesContainer(object):
+    # RepeatingValuesContainer as it was, with a list.index search
+    def __init__(self):
+        self.values = []
+
+    def add(self, sequence):
+        try:
+            index = self.values.index(sequence)
+        except ValueError:
+            index = len(self.values)
+            self.values.append(sequence)
+        return index
+
+    def flatten(self):
+        out = []
+        for seq in self.values:
+            out.extend(seq)
+        return out
+
+
+def linear_regenerate(chunk_map, chunks):
+    # The per-height regeneration the array version replaced
+    heights = [[44.0 for y in range(48*16)] for x in range(48*16)]
+    for x in range(48*16):
+        for y in range(48*16):
+            if x % 12 == 0 or y % 12 == 0:
+                heights[x][y] = 0.0
+
+    for x in range(64):
+        for y in range(64):
+            entry = chunk_map.entries[x][y]
+            if entry.b == 1:
+                chunk = chunks.chunks[entry.index]
+                for tilex in range(4):
+                    for tiley in range(4):
+                        tile = chunk.tiles[tilex*4+tiley]
+                        for ix in range(3):
+                            for iy in range(3):
+                                heights[x*12 + tilex*3 + ix][y*12 + tiley*3 + iy] = tile.heights[ix*4+iy]/16.0
+
+    indices = []
+    height_values = LinearValuesContainer()
+    for x in range(48):
+        for y in range(48):
+            values = []
+            for ix in range(16):
+                for iy in range(16):
+                    values.append(heights[x*16+ix][y*16+iy])
+            indices.append(height_values.add(tuple(values)))
+    return indices, height_values.flatten()
+
+
+def test_container_matches_linear_search():
+    rnd = random.Random(1)
+    container = bw_terrain.RepeatingValuesContainer()
+    linear = LinearValuesContainer()
+    for i in range(2000):
+        sequence = tuple(rnd.randrange(4) for i in range(rnd.randrange(1, 4)))
+        assert container.add(sequence) == linear.add(sequence)
+    assert container.values == linear.values
+    assert container.flatten() == linear.flatten()
+
+
+def test_regenerate_matches_linear_search():
+    # Empty chunks give many identical blocks, flat chunks some more
+    terrain = BinaryReader(make_out(fill=0.4, seed=2)).read_object(bw_terrain.TerrainFile)
+    for i, chunk in enumerate(terrain.chunks.chunks[::7]):
+        for tile in chunk.tiles:
+            tile.heights = [800 + i % 3]*16
+
+    collmap = bw_terrain.CollisionMap()
+    collmap.regenerate_from(terrain.chunkmap, terrain.chunks)
+    indices, floats = linear_regenerate(terrain.chunkmap, terrain.chunks)
+    assert len(floats) < 48*48*256
+    assert collmap.indices == indices
+    assert collmap.floats == floats
+
+    # And the written section
+    terrain.collmap.mark_all_dirty()
+    f = BinaryReader()
+    terrain.to_file(f)
+    reloaded = BinaryReader(f.getvalue()).read_object(bw_terrain.TerrainFile)
+    assert reloaded.collmap.indices == indices
+    assert reloaded.collmap.floats == floats
@@ -0,0 +1,77 @@
+from bwterrainnew import bw_terrain
+from bwterrainnew.binaryreader import BinaryReader
+
+from synthetic import make_out
+
+
+def load(data):
+    return BinaryReader(data).read_object(bw_terrain.TerrainFile)
+
+
+def full_rebuild(terrain):
+    collmap = bw_terrain.CollisionMap()
+    collmap.regenerate_from(terrain.chunkmap, terrain.chunks)
+    return collmap.indices, collmap.floats
+
+
+def existing_chunks(terrain):
+    return [(cx, cy) for cx in range(64) for cy in range(64) if terrain.chunkmap.entries[cx][cy].chunk_exists()]
+
+
+def saved(terrain, rebuild=False):
+    if rebuild:
+        terrain.collmap.mark_all_dirty()
+    f = BinaryReader()
+    terrain.to_file(f)
+    return f.getvalue()
+
+
+def test_dirty_chunks_match_full_rebuild():
+    # The synthetic collision doesn't match its chunks, write it once so it does
+    terrain = load(saved(load(make_out(fill=0.3, seed=5)), rebuild=True))
+    assert terrain.collmap.blocks is None
+    terrain.regenerate_collmap()
+    assert terrain.collmap.blocks is not None
+    assert (terrain.collmap.indices, terrain.collmap.floats) == full_rebuild(terrain)
+
+    existing = existing_chunks(terrain)
+    edited, deleted = existing[10], existing[20]
+    missing = next((cx, cy) for cx in range(64) for cy in range(64) if (cx, cy) not in existing)
+
+    # Looking at chunks doesn't make them dirty
+    for cx, cy in existing:
+        terrain.get_chunk(cx, cy)
+    assert terrain.collmap.dirty_chunks == set()
+
+    chunk = terrain.get_chunk(*edited, for_edit=True)
+    for tile in chunk.tiles:
+        tile.heights = [height + 800 for height in tile.heights]
+    terrain.set_chunk_exist_status(*deleted, False)
+    terrain.get_chunk(*missing, create_if_no_exist=True).tiles[5].heights[0] = 4000
+    assert terrain.collmap.dirty_chunks == {edited, deleted, missing}
+
+    before = terrain.collmap.floats
+    terrain.regenerate_collmap()
+    assert terrain.collmap.dirty_chunks == set()
+    assert terrain.collmap.floats != before
+    assert (terrain.collmap.indices, terrain.collmap.floats) == full_rebuild(terrain)
+
+    # Nothing dirty, nothing changes
+    terrain.regenerate_collmap()
+    assert (terrain.collmap.indices, terrain.collmap.floats) == full_rebuild(terrain)
+
+
+def test_clear_chunks_rebuilds_everything():
+    terrain = load(saved(load(make_out(fill=0.3, seed=6)), rebuild=True))
+    terrain.regenerate_collmap()
+
+    terrain.clear_chunks()
+    for cx, cy in ((0, 0), (10, 63), (31, 32)):
+        chunk = terrain.get_chunk(cx, cy, create_if_no_exist=True)
+        chunk.tiles[0].heights = list(range(0, 1600, 100))
+    terrain.regenerate_collmap()
+    assert (terrain.collmap.indices, terrain.collmap.floats) == full_rebuild(terrain)
+
+    terrain = load(saved(terrain))
+    terrain.regenerate_collmap()
+    assert (terrain.collmap.indices, terrain.collmap.floats) == full_rebuild(terrain)
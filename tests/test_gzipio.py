@@ -0,0 +1,54 @@
+import gzip
+import io
+import os
+
+import pytest
+
+from bwterrain import gzipio
+
+
+def make_data(size):
+    return b"".join(b"%08d " % i for i in range(size//9 + 1))[:size]
+
+
+def test_writer_output_reads_back_with_gzip(tmp_path):
+    data = make_data(3*gzipio.BLOCK_SIZE + 12345)
+    path = str(tmp_path / "data.gz")
+    with gzipio.open_path(path, "wb") as f:
+        f.write(data[:1000])
+        f.write(data[1000:])
+
+    with gzip.open(path, "rb") as f:
+        assert f.read() == data
+    # Same level as gzip.open, only the block boundaries cost a little
+    assert os.path.getsize(path) <= len(gzip.compress(data, 9))*1.01
+
+
+def test_reader_read_and_seek(tmp_path):
+    data = make_data(3*gzipio.READ_CHUNK_SIZE + 999)
+    path = str(tmp_path / "data.gz")
+    with open(path, "wb") as f:
+        f.write(gzip.compress(data))
+
+    with gzipio.open_path(path, "rb") as f:
+        assert f.read(10) == data[:10]
+        f.seek(2*gzipio.READ_CHUNK_SIZE)
+        assert f.read(100) == data[2*gzipio.READ_CHUNK_SIZE:2*gzipio.READ_CHUNK_SIZE+100]
+        f.seek(-50, io.SEEK_CUR)
+        assert f.read(50) == data[2*gzipio.READ_CHUNK_SIZE+50:2*gzipio.READ_CHUNK_SIZE+100]
+        f.seek(5)
+        assert f.read(5) == data[5:10]
+        assert f.read() == data[10:]
+        assert f.read() == b""
+
+
+def test_reader_error_is_raised_on_every_read(tmp_path):
+    data = gzip.compress(make_data(3*gzipio.READ_CHUNK_SIZE))
+    path = str(tmp_path / "truncated.gz")
+    with open(path, "wb") as f:
+        f.write(data[:len(data)//2])
+
+    with gzipio.open_path(path, "rb") as f:
+        for i in range(3):
+            with pytest.raises(EOFError):
+                f.read()
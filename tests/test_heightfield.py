@@ -0,0 +1,118 @@
+from io import BytesIO
+
+import numpy
+
+from bwterrain import bw_terrain
+from bwterrain.heightfield import HeightfieldRaycaster, intersect_triangles
+
+from synthetic import make_out
+
+
+def random_raycaster(seed, cells=16, deleted=0.0):
+    rng = numpy.random.default_rng(seed)
+    points = rng.random((cells + 1, cells + 1))*100
+    if deleted:
+        points[rng.random(points.shape) < deleted] = numpy.nan
+    corners = numpy.stack((numpy.stack((points[:-1, :-1], points[:-1, 1:]), axis=-1),
+                           numpy.stack((points[1:, :-1], points[1:, 1:]), axis=-1)), axis=2)
+    return HeightfieldRaycaster(corners, spacing=4.0, offset=0.0), rng
+
+
+def test_triangles_match_vertical_rays():
+    raycaster, rng = random_raycaster(1)
+    xs = rng.random(2000)*64
+    zs = rng.random(2000)*64
+
+    heights, gradient_x, gradient_z = raycaster.sample(xs, zs, triangles=True)
+    origins = numpy.stack((xs, numpy.full_like(xs, 1000.0), zs), axis=1)
+    points, distances = raycaster.ray_collide_many(origins, numpy.tile([0.0, -1.0, 0.0], (len(xs), 1)))
+    numpy.testing.assert_allclose(points[:, 1], heights, atol=1e-4)
+
+    # The gradients are those of the triangle that was hit, away from its edges
+    fx, fz = (xs % 4.0)/4.0, (zs % 4.0)/4.0
+    away = (numpy.abs(fx - fz) > 0.01) & (numpy.minimum(fx, fz) > 0.01) & (numpy.maximum(fx, fz) < 0.99)
+    step = 1e-3
+    shifted_x = raycaster.sample(xs + step, zs, triangles=True)[0]
+    shifted_z = raycaster.sample(xs, zs + step, triangles=True)[0]
+    numpy.testing.assert_allclose(((shifted_x - heights)/step)[away], gradient_x[away], rtol=1e-4, atol=1e-6)
+    numpy.testing.assert_allclose(((shifted_z - heights)/step)[away], gradient_z[away], rtol=1e-4, atol=1e-6)
+
+
+def brute_force_distances(raycaster, origins, directions):
+    # Every ray against both triangles of every solid cell, in world space
+    directions = directions/numpy.linalg.norm(directions, axis=1)[:, None]
+    distances = numpy.full(len(origins), numpy.inf)
+    cells_x, cells_y = raycaster.corners.shape[:2]
+    for x in range(cells_x):
+        for y in range(cells_y):
+            corners = raycaster.corners[x, y].astype(numpy.float64)
+            if numpy.isnan(corners).any():
+                continue
+            x0, x1 = x*raycaster.spacing + raycaster.offset, (x+1)*raycaster.spacing + raycaster.offset
+            z0, z1 = y*raycaster.spacing + raycaster.offset, (y+1)*raycaster.spacing + raycaster.offset
+            p00 = numpy.tile([x0, corners[0, 0], z0], (len(origins), 1))
+            p10 = numpy.tile([x1, corners[1, 0], z0], (len(origins), 1))
+            p01 = numpy.tile([x0, corners[0, 1], z1], (len(origins), 1))
+            p11 = numpy.tile([x1, corners[1, 1], z1], (len(origins), 1))
+            for a, b, c in ((p00, p11, p10), (p00, p11, p01)):
+                distances = numpy.minimum(distances, intersect_triangles(origins, directions, a, b, c))
+    return distances
+
+
+def test_oblique_rays_match_brute_force():
+    raycaster, rng = random_raycaster(5, deleted=0.1)
+    solid = ~numpy.isnan(raycaster.corners).any(axis=(2, 3))
+    assert 0 < solid.sum() < solid.size
+
+    # From above, the sides and below the grid, steep to grazing
+    count = 600
+    origins = numpy.stack((rng.random(count)*96 - 16, rng.random(count)*240 - 60, rng.random(count)*96 - 16), axis=1)
+    directions = rng.normal(size=(count, 3))
+    directions[::3, 1] = -numpy.abs(directions[::3, 1])*0.05
+    directions[1::3, 1] = -numpy.abs(directions[1::3, 1])*2
+
+    points, distances = raycaster.ray_collide_many(origins, directions)
+    expected = brute_force_distances(raycaster, origins, directions)
+    hit = numpy.isfinite(expected)
+    assert 50 < hit.sum() < count - 50
+    numpy.testing.assert_array_equal(numpy.isfinite(distances), hit)
+    numpy.testing.assert_allclose(distances[hit], expected[hit], rtol=1e-9, atol=1e-9)
+    assert numpy.isnan(points[~hit]).all()
+
+    # Limited distance
+    points, distances = raycaster.ray_collide_many(origins, directions, max_distance=40.0)
+    numpy.testing.assert_array_equal(numpy.isfinite(distances), expected <= 40.0)
+
+
+def test_bilinear_and_triangles_differ_inside_cells():
+    raycaster, rng = random_raycaster(2)
+    cx, cy = rng.integers(0, 16, 100), rng.integers(0, 16, 100)
+    corners = raycaster.corners[cx, cy].astype(numpy.float64)
+
+    # Same at the corners, a quarter of the diagonal difference in the middle
+    for fx, fy in ((0, 0), (1, 0), (0, 1), (1, 1)):
+        xs, zs = (cx + fx)*4.0, (cy + fy)*4.0
+        numpy.testing.assert_allclose(raycaster.sample(xs, zs)[0], raycaster.sample(xs, zs, triangles=True)[0])
+        numpy.testing.assert_allclose(raycaster.sample(xs, zs)[0], corners[:, fx, fy])
+
+    xs, zs = (cx + 0.5)*4.0, (cy + 0.5)*4.0
+    difference = raycaster.sample(xs, zs)[0] - raycaster.sample(xs, zs, triangles=True)[0]
+    expected = (corners[:, 1, 0] + corners[:, 0, 1] - corners[:, 0, 0] - corners[:, 1, 1])/4
+    numpy.testing.assert_allclose(difference, expected, atol=1e-9)
+
+
+def test_sample_heights_triangles():
+    terrain = bw_terrain.BWTerrainV2(BytesIO(make_out(fill=0.5, seed=4)))
+    rng = numpy.random.default_rng(3)
+    xs = rng.random(500)*4096 - 2048
+    ys = rng.random(500)*4096 - 2048
+
+    heights, normals = terrain.sample_heights(xs, ys, normals=True, triangles=True)
+    hit = ~numpy.isnan(heights)
+    assert hit.sum() > 100
+    assert numpy.allclose(numpy.linalg.norm(normals[hit], axis=1), 1.0)
+
+    origins = numpy.stack((xs, numpy.full_like(xs, 5000.0), ys), axis=1)[hit]
+    points, distances = terrain.ray_collide_many(origins, numpy.tile([0.0, -1.0, 0.0], (len(origins), 1)))
+    numpy.testing.assert_allclose(points[:, 1], heights[hit], atol=1e-3)
+    assert not numpy.allclose(terrain.sample_heights(xs, ys)[hit], heights[hit], atol=1e-3)
@@ -0,0 +1,122 @@
+import struct
+
+import pytest
+
+from bwterrainnew import bw_terrain
+from bwterrainnew.binaryreader import BinaryReader
+from bwterrainnew.bw_terrain import LazyChunkList, LazyTerrainFile, read_section_offsets
+
+from synthetic import make_out
+
+
+NAMES = [b"TERR", b"CHNK", b"GPNF", b"CMAP", b"UWCT", b"COLM", b"MATL"]
+
+
+def unsorted_out(**kwargs):
+    # Reversed materials so that chunk material indices get remapped on load
+    data = make_out(**kwargs)
+    offset, size = read_section_offsets(data)[b"MATL"]
+    data = bytearray(data)
+    records = [data[i:i+48] for i in range(offset + 8, offset + 8 + size, 48)]
+    data[offset + 8:offset + 8 + size] = b"".join(reversed(records))
+    return bytes(data)
+
+
+@pytest.fixture
+def out_path(tmp_path):
+    data = unsorted_out(fill=0.3, seed=8, materials=5)
+    path = str(tmp_path / "level.out")
+    with open(path, "wb") as f:
+        f.write(data)
+    return path, data
+
+
+def test_read_section_offsets():
+    data = make_out(fill=0.1, seed=1)
+    sections = read_section_offsets(data)
+    assert list(sections) == NAMES
+
+    offset = 0
+    for name in NAMES:
+        assert sections[name][0] == offset
+        assert data[offset:offset+4] == name[::-1]
+        assert struct.unpack_from("I", data, offset+4)[0] == sections[name][1]
+        offset += 8 + sections[name][1]
+    assert offset == len(data)
+
+
+def test_lazy_matches_eager(out_path):
+    path, data = out_path
+    eager = BinaryReader(data).read_object(bw_terrain.TerrainFile)
+
+    with LazyTerrainFile(path) as lazy:
+        # Chunks before materials still get the sorted material indices
+        assert isinstance(lazy.chunks.chunks, LazyChunkList)
+        assert len(lazy.chunks.chunks) == len(eager.chunks.chunks)
+        for cx in range(64):
+            for cy in range(64):
+                assert lazy.get_chunk(cx, cy) == eager.get_chunk(cx, cy)
+        assert lazy.material_remap == {i: 4 - i for i in range(5)}
+
+        assert lazy.materials.materials == eager.materials.materials
+        assert lazy.terrain_info == eager.terrain_info
+        assert lazy.transform == eager.transform
+        assert [e.data for e in lazy.uwct.entries] == [e.data for e in eager.uwct.entries]
+        assert [[(e.a, e.b, e.index) for e in row] for row in lazy.chunkmap.entries] == \
+               [[(e.a, e.b, e.index) for e in row] for row in eager.chunkmap.entries]
+        assert (lazy.collmap.indices, lazy.collmap.floats) == (eager.collmap.indices, eager.collmap.floats)
+
+        # And they write the same file
+        expected = BinaryReader()
+        eager.to_file(expected)
+        written = BinaryReader()
+        lazy.to_file(written)
+        assert written.getvalue() == expected.getvalue()
+
+
+def test_untouched_chunks_are_not_decoded(out_path, monkeypatch):
+    path, data = out_path
+    eager = BinaryReader(data).read_object(bw_terrain.TerrainFile)
+    decoded = []
+    decode = LazyChunkList.decode
+
+    def counting_decode(self, index):
+        decoded.append(index)
+        return decode(self, index)
+    monkeypatch.setattr(LazyChunkList, "decode", counting_decode)
+
+    with LazyTerrainFile(path) as lazy:
+        assert lazy.materials.count() == 5
+        assert decoded == []
+
+        chunks = lazy.chunks.chunks
+        assert chunks[3] == eager.chunks.chunks[3]
+        assert chunks[-1] == eager.chunks.chunks[-1]
+        assert chunks[3] is chunks[3]
+        assert decoded == [3, len(chunks) - 1]
+        assert [i for i, chunk in enumerate(chunks.chunks) if chunk is not None] == [3, len(chunks) - 1]
+
+        # Replaced chunks aren't decoded either
+        chunks[5] = eager.chunks.chunks[6]
+        assert chunks[5] is eager.chunks.chunks[6]
+        assert decoded == [3, len(chunks) - 1]
+
+    # Only what was decoded before closing stays available
+    assert chunks[3] == eager.chunks.chunks[3]
+    with pytest.raises(ValueError):
+        chunks[4]
+
+
+def test_missing_section(tmp_path):
+    data = make_out(fill=0.1, seed=1)
+    offset, size = read_section_offsets(data)[b"MATL"]
+    path = str(tmp_path / "level.out")
+    with open(path, "wb") as f:
+        f.write(data[:offset])
+
+    with LazyTerrainFile(path) as lazy:
+        assert lazy.terrain_info.material_count == 5
+        with pytest.raises(RuntimeError):
+            lazy.materials
+        with pytest.raises(AttributeError):
+            lazy.not_a_section
@@ -0,0 +1,128 @@
+import random
+import struct
+from contextlib import contextmanager
+
+import pytest
+
+from bwterrainnew import bw_terrain, structs
+from bwterrainnew.binaryreader import BinaryReader
+
+
+def struct_classes():
+    result = []
+    pending = [structs.Struct]
+    while pending:
+        for cls in pending.pop().__subclasses__():
+            result.append(cls)
+            pending.append(cls)
+    return sorted(set(result), key=lambda cls: (cls.__module__, cls.__name__))
+
+
+COMPILED = [cls for cls in struct_classes() if cls.compiled() is not None]
+
+
+@contextmanager
+def generic():
+    # Per-field readers and writers only, including for nested Structs
+    with pytest.MonkeyPatch.context() as m:
+        for cls in struct_classes():
+            m.setattr(cls, "_compiled_struct", None, raising=False)
+        yield
+
+
+def outcome(func):
+    try:
+        return "ok", func()
+    except (AssertionError, struct.error) as error:
+        return "error", type(error)
+
+
+def read(cls, data, count=None):
+    def run():
+        f = BinaryReader(data)
+        result = f.read_object(cls, count=count)
+        return repr(result), f.tell()
+    return outcome(run)
+
+
+def write(value):
+    def run():
+        f = BinaryReader()
+        f.write_object(value)
+        return f.getvalue()
+    return outcome(run)
+
+
+def test_compiles_terrain_structs():
+    for cls in (bw_terrain.SectionHeader, bw_terrain.Color, bw_terrain.Tile, bw_terrain.Chunk,
+                bw_terrain.ChunkMapEntry, bw_terrain.CollisionMapInfo):
+        assert cls in COMPILED
+    # Mixed byte order
+    assert bw_terrain.TileTransform.compiled() is None
+    assert bw_terrain.Tile.compiled().struct.size == 180
+
+
+@pytest.mark.parametrize("cls", COMPILED, ids=lambda cls: cls.__name__)
+def test_compiled_matches_generic(cls):
+    size = cls.compiled().struct.size
+    rnd = random.Random(cls.__name__)
+
+    for i in range(20):
+        data = bytes(rnd.randrange(256) for i in range(size*3 + 1))
+        compiled_read = [read(cls, data), read(cls, data, count=3)]
+        values = [BinaryReader(data).read_object(cls, count=3)] if compiled_read[1][0] == "ok" else []
+        compiled_write = [write(value) for value in values]
+        # Which error a truncated struct raises depends on whether an expect check comes first
+        assert read(cls, data[:size - 1])[0] == "error"
+
+        with generic():
+            assert [read(cls, data), read(cls, data, count=3)] == compiled_read
+            assert [write(value) for value in values] == compiled_write
+            assert read(cls, data[:size - 1])[0] == "error"
+
+
+def test_expected_fields():
+    info = bw_terrain.TerrainInfo.new()
+    data = write(info)
+    assert data[0] == "ok" and data[1][:4] == b"RRET"
+    assert read(bw_terrain.TerrainInfo, data[1])[1][0] == repr(info)
+
+    with pytest.raises(AssertionError):
+        BinaryReader(b"XXXX" + data[1][4:]).read_object(bw_terrain.TerrainInfo)
+
+    data = struct.pack(">14I", 0x66, *range(1, 14))*2
+    compiled = [read(bw_terrain.CollisionMapInfo, data, count=2), write(bw_terrain.CollisionMapInfo(0x66, *range(1, 14)))]
+    assert compiled[0][0] == "ok" and compiled[1] == ("ok", data[:56])
+    with generic():
+        assert [read(bw_terrain.CollisionMapInfo, data, count=2),
+                write(bw_terrain.CollisionMapInfo(0x66, *range(1, 14)))] == compiled
+
+
+def test_uvpoint_fields():
+    tile = bw_terrain.Tile.default()
+    tile.surface_coordinates[1] = bw_terrain.UVPoint(0.5, 15.99)
+    tile.detail_coordinates[15] = bw_terrain.UVPoint(1/4096, 0.25)
+    compiled = write(tile)
+    with generic():
+        assert write(tile) == compiled
+
+    result = BinaryReader(compiled[1]).read_object(bw_terrain.Tile)
+    assert result.surface_coordinates[1] == bw_terrain.UVPoint(0.5, int(15.99*4096)/4096)
+    assert result.detail_coordinates[15] == bw_terrain.UVPoint(1/4096, 0.25)
+
+
+def test_write_falls_back_to_field_writers():
+    # A count field with the wrong length doesn't fit the compiled format,
+    # the per-field writers write it as it is like they did before
+    tile = bw_terrain.Tile.default()
+    tile.heights = tile.heights[:15]
+    compiled = write(tile)
+    assert compiled[0] == "ok" and len(compiled[1]) == 178
+
+    with generic():
+        assert write(tile) == compiled
+
+    # Errors of the field writers still come through
+    tile = bw_terrain.Tile.default()
+    tile.heights[0] = 0x10000
+    assert write(tile) == ("error", struct.error)
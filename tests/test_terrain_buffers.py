@@ -0,0 +1,285 @@
+from io import BytesIO
+
+import numpy
+
+from bwterrain import bw_terrain, terrain_buffers
+
+from synthetic import make_out
+
+
+def stored(weights):
+    # Vertex group weights are 32 bit floats
+    return numpy.asarray(weights, dtype=numpy.float32).astype(numpy.float64)
+
+
+def apply_weights(weights, new_weights):
+    # vertex_group.add(..., "REPLACE") for every non-NaN new weight
+    weights = weights.copy()
+    for value, indices in terrain_buffers.group_by_value(new_weights):
+        weights[indices] = stored(value)
+    return weights
+
+
+def sew_with_dict(parts):
+    # The per-vertex loops sew_terrain used before sew_heights
+    corner_heights = {}
+    for size, base_x, base_y, heights in parts:
+        for ix in range(size):
+            x = base_x + ix - (base_x + ix)//4
+            for iy in range(size):
+                y = base_y + iy - (base_y + iy)//4
+                if 0 <= base_x + ix < 1024 and 0 <= base_y + iy < 1024:
+                    if (x, y) not in corner_heights:
+                        corner_heights[(x, y)] = []
+                    weight = heights[iy + ix*size]
+                    if not numpy.isnan(weight):
+                        corner_heights[(x, y)].append(weight)
+
+    results = []
+    for size, base_x, base_y, heights in parts:
+        heights = heights.copy()
+        for ix in range(size):
+            x = base_x + ix - (base_x + ix)//4
+            for iy in range(size):
+                y = base_y + iy - (base_y + iy)//4
+                if 0 <= base_x + ix < 1024 and 0 <= base_y + iy < 1024:
+                    if (x, y) in corner_heights and len(corner_heights[(x, y)]) > 1:
+                        avg = sum(corner_heights[(x, y)])/len(corner_heights[(x, y)])
+                        heights[iy + ix*size] = stored(avg)
+        results.append(heights)
+    return results
+
+
+def test_sew_heights_matches_dict_loop():
+    rng = numpy.random.default_rng(1)
+    # Neighbouring parts, one overlapping another, one unaligned and one hanging
+    # off the map
+    layout = [(8, 0, 0), (8, 8, 0), (8, 0, 8), (8, 8, 8), (8, 4, 4), (12, 14, 2), (8, 1020, 1016)]
+    parts = []
+    for size, base_x, base_y in layout:
+        heights = stored(rng.random(size*size))
+        heights[rng.random(size*size) < 0.1] = numpy.nan
+        parts.append((size, base_x, base_y, heights))
+
+    sewn = terrain_buffers.sew_heights(parts)
+    expected = sew_with_dict(parts)
+    changed = 0
+    for (_, _, _, heights), new, old in zip(parts, sewn, expected):
+        numpy.testing.assert_array_equal(apply_weights(heights, new), old)
+        changed += (~numpy.isnan(new)).sum()
+    assert changed > 50
+
+    # Sewing again changes nothing
+    sewn_parts = [(size, base_x, base_y, heights) for (size, base_x, base_y, _), heights in zip(parts, expected)]
+    for new in terrain_buffers.sew_heights(sewn_parts):
+        assert numpy.isnan(new).all()
+
+
+def random_material_weights(rng, count, materials):
+    weights = stored(rng.integers(0, materials, count)/100.0)
+    weights[rng.random(count) < 0.2] = numpy.nan
+    return weights
+
+
+def delete_with_loop(weights, slot):
+    # delete_material_index's old loop, Blender clamps the -0.01 weight to 0
+    weights = weights.copy()
+    for i, material in enumerate(weights):
+        if not numpy.isnan(material):
+            index = int(round(material*100))
+            if index >= slot - 1:
+                weights[i] = stored(max((index - 1)/100.0, 0.0))
+    return weights
+
+
+def test_material_indices():
+    weights = stored([0.0, 0.01, numpy.nan, 0.07, 0.33, 1.0])
+    assert terrain_buffers.material_indices(weights).tolist() == [0, 1, -1, 7, 33, 100]
+
+
+def test_delete_material_matches_loop():
+    rng = numpy.random.default_rng(2)
+    weights = random_material_weights(rng, 500, 6)
+
+    # Slot 0 has no Material index, slot 6 is the last material
+    for slot in range(1, 7):
+        new = terrain_buffers.remap_material_weights(weights, terrain_buffers.deletion_remap([slot - 1]))
+        numpy.testing.assert_array_equal(apply_weights(weights, new), delete_with_loop(weights, slot))
+    assert terrain_buffers.deletion_remap([5])[:7].tolist() == [0, 1, 2, 3, 4, 4, 5]
+
+
+def test_delete_unused_matches_deleting_one_by_one():
+    rng = numpy.random.default_rng(3)
+    weights = random_material_weights(rng, 500, 10)
+    for unused in ([1, 2, 5], [0, 9], [9], [0, 1, 2, 3, 4, 5, 6, 7, 8]):
+        # Nothing uses them
+        used = numpy.isin(terrain_buffers.material_indices(weights), unused, invert=True)
+        used_weights = numpy.where(used, weights, numpy.nan)
+
+        # The old operator deleted the slots in order, each one shifting the next
+        expected = used_weights
+        for deleted, index in enumerate(unused):
+            expected = delete_with_loop(expected, index + 1 - deleted)
+        new = terrain_buffers.remap_material_weights(used_weights, terrain_buffers.deletion_remap(unused))
+        numpy.testing.assert_array_equal(apply_weights(used_weights, new), expected)
+
+
+def test_sort_materials_remap():
+    rng = numpy.random.default_rng(4)
+    weights = random_material_weights(rng, 500, 8)
+    # Indices 6 and 7 have no material slot, sorting keeps them
+    order = [3, 0, 5, 1, 4, 2]
+    remap = numpy.arange(terrain_buffers.MATERIAL_INDICES)
+    remap[:6] = order
+
+    new = terrain_buffers.remap_material_weights(weights, remap)
+    indices = terrain_buffers.material_indices(weights)
+    result = terrain_buffers.material_indices(apply_weights(weights, new))
+    in_range = (indices >= 0) & (indices < 6)
+    assert (result[in_range] == numpy.take(order, indices[in_range])).all()
+    assert (result[~in_range] == indices[~in_range]).all()
+    # Unchanged weights aren't written
+    assert numpy.isnan(new[~in_range | (result == indices)]).all()
+
+    # Indices past a short table are kept too
+    new = terrain_buffers.remap_material_weights(weights, [1, 0])
+    result = terrain_buffers.material_indices(apply_weights(weights, new))
+    expected = indices.copy()
+    expected[indices == 0], expected[indices == 1] = 1, 0
+    assert (result == expected).all()
+
+
+def loop_vertices_of(size):
+    # Loops of mesh_grid's faces in order, like MeshLoop.vertex_index
+    vertices, faces = terrain_buffers.mesh_grid(size, size, 1.0)
+    return faces.reshape(-1)
+
+
+def reset_uvs_with_loop(current, size, base_x, base_y, selected=None):
+    # reset_uv_selected_objects' old per-loop assignment, limited to the selected
+    # vertices like selected_vertices_only
+    uvs = current.reshape(-1, 2).copy()
+    for face, face_vertices in enumerate(loop_vertices_of(size).reshape(-1, 4)):
+        for vtx_i, loop_i in zip(face_vertices, range(face*4, face*4 + 4)):
+            if selected is not None and not selected[vtx_i]:
+                continue
+            x = base_x + vtx_i//size
+            y = base_y + vtx_i % size
+            if 0 <= x < 1024 and 0 <= y < 1024:
+                uvs[loop_i] = ((x % 4)/3.0, (y % 4)/3.0)
+    return uvs
+
+
+def test_tile_corner_uvs_match_loop():
+    rng = numpy.random.default_rng(5)
+    size = 16
+    loop_vertices = loop_vertices_of(size)
+    for base_x, base_y in ((0, 0), (256, 512), (-8, 4), (1012, 1010), (3, 6)):
+        for selected in (None, rng.random(size*size) < 0.4):
+            current = rng.random(len(loop_vertices)*2).astype(numpy.float32)
+            loop_uvs, reset = terrain_buffers.tile_corner_loop_uvs(loop_vertices, size, base_x, base_y, selected)
+
+            # As reset_uv_selected_objects merges them into the layer
+            uvs = current.reshape(-1, 2).copy()
+            uvs[reset] = loop_uvs[reset]
+            numpy.testing.assert_array_equal(uvs, reset_uvs_with_loop(current, size, base_x, base_y, selected))
+            assert reset.any()
+
+
+def test_scatter_loop_uvs_match_loop():
+    rng = numpy.random.default_rng(6)
+    size = 16
+    loop_vertices = loop_vertices_of(size)
+    current = rng.random(len(loop_vertices)*2).astype(numpy.float32)
+    vertex_uvs = rng.random((size*size, 2)).astype(numpy.float32)
+    exists = rng.random(size*size) < 0.7
+
+    # import_terrain's old per-loop assignment, loops of deleted vertices keep their UV
+    expected = current.reshape(-1, 2).copy()
+    for loop_i, vtx_i in enumerate(loop_vertices):
+        if exists[vtx_i]:
+            expected[loop_i] = vertex_uvs[vtx_i]
+    uvs = terrain_buffers.scatter_loop_uvs(current.copy(), loop_vertices, vertex_uvs, exists)
+    numpy.testing.assert_array_equal(uvs.reshape(-1, 2), expected)
+
+
+def part_with_loops(terrain, px, py, partsize, remap):
+    # import_terrain's old per-vertex loops, as flat per vertex arrays
+    count = partsize*partsize
+    heights = numpy.full(count, numpy.nan)
+    materials = numpy.full(count, numpy.nan)
+    colors = numpy.empty((count, 4))
+    blend = numpy.empty((count, 4))
+    uv_main = numpy.zeros((count, 2))
+    uv_detail = numpy.zeros((count, 2))
+    deleted = []
+    for x in range(partsize):
+        for y in range(partsize):
+            index = x*partsize + y
+            vtx = terrain.get_vertex(x+px*partsize, y+py*partsize)
+            if vtx is not None:
+                heights[index] = vtx.height/512.0
+                colors[index] = (vtx.color.r, vtx.color.g, vtx.color.b, vtx.color.a)
+                blend[index] = (1.0, 1.0, 1.0, vtx.color.a)
+                uv_main[index] = (vtx.uv_main.x, 1-vtx.uv_main.y)
+                uv_detail[index] = (vtx.uv_detail.x, 1-vtx.uv_detail.y)
+            else:
+                deleted.append(index)
+                colors[index] = (1.0, 1.0, 1.0, 0)
+                blend[index] = (1.0, 1.0, 1.0, 1.0)
+
+    tiles = partsize//4
+    for cx in range(tiles):
+        for cy in range(tiles):
+            matindex = terrain.material_map[cx+px*tiles][cy+py*tiles]
+            if matindex != -1:
+                matindex = remap[int(matindex)]
+                for tx in range(4):
+                    for ty in range(4):
+                        materials[(cx*4+tx)*partsize+(cy*4+ty)] = matindex/100.0
+    return heights, materials, colors, blend, uv_main, uv_detail, deleted
+
+
+def test_part_buffers_match_vertex_loops():
+    terrain = bw_terrain.BWTerrainV2(BytesIO(make_out(fill=0.5, seed=7, materials=6)))
+    remap = {0: 3, 1: 0, 2: 5, 3: 1, 4: 4, 5: 2}
+    partsize = 64
+
+    for px, py in ((0, 0), (3, 5), (15, 15)):
+        buffers = terrain_buffers.build_part_buffers(terrain, px, py, partsize, remap)
+        heights, materials, colors, blend, uv_main, uv_detail, deleted = part_with_loops(terrain, px, py, partsize, remap)
+        assert 0 < len(deleted) < partsize*partsize
+
+        numpy.testing.assert_array_equal(buffers.deleted, deleted)
+        numpy.testing.assert_array_equal(buffers.exists, ~numpy.isnan(heights))
+        numpy.testing.assert_array_equal(buffers.heights, heights)
+        numpy.testing.assert_array_equal(buffers.materials, materials)
+        numpy.testing.assert_array_equal(buffers.colors, numpy.float32(colors).reshape(-1))
+        numpy.testing.assert_array_equal(buffers.blend, numpy.float32(blend).reshape(-1))
+        numpy.testing.assert_array_equal(buffers.uv_main[buffers.exists], numpy.float32(uv_main)[buffers.exists])
+        numpy.testing.assert_array_equal(buffers.uv_detail[buffers.exists], numpy.float32(uv_detail)[buffers.exists])
+
+        # Written one vertex_group.add per value, the groups read back the same
+        # as adding every vertex on its own
+        weights = buffers.stored_weights()
+        for values, expected in ((buffers.heights, heights), (buffers.materials, materials)):
+            groups = list(terrain_buffers.group_by_value(values))
+            assert len(groups) == len(numpy.unique(expected[~numpy.isnan(expected)]))
+            for value, indices in groups:
+                assert (numpy.diff(indices) > 0).all()
+            numpy.testing.assert_array_equal(apply_weights(numpy.full(len(values), numpy.nan), values), stored(expected))
+        numpy.testing.assert_array_equal(weights["Material"], stored(materials))
+        assert numpy.isnan(weights["Delete"]).sum() == partsize*partsize - len(deleted)
+
+    # Materials grouped per remapped index
+    groups = dict(terrain_buffers.group_by_value(buffers.materials))
+    for value, indices in groups.items():
+        assert (numpy.rint(materials[indices]*100) == round(value*100)).all()
+    assert set(numpy.rint(numpy.array(list(groups))*100).astype(int)) <= set(remap.values())
+
+
+def test_group_by_value():
+    values = numpy.array([0.5, numpy.nan, 0.25, 0.5, 1.0, numpy.nan, 0.25, 0.5])
+    groups = [(value, indices.tolist()) for value, indices in terrain_buffers.group_by_value(values)]
+    assert groups == [(0.25, [2, 6]), (0.5, [0, 3, 7]), (1.0, [4])]
+    assert list(terrain_buffers.group_by_value(numpy.full(3, numpy.nan))) == []
@@ -0,0 +1,86 @@
+import os
+from io import BytesIO
+
+import numpy
+import pytest
+
+import terrain_cli
+from bwterrain.bw_terrain import BWTerrainV2
+from bwterrain.bwarchivelib import BattalionArchive, TextureArchive, TextureBW2
+from bwterrainnew import bw_terrain
+
+from synthetic import write_out
+
+
+def write_level(directory, name, seed, textures=True):
+    data = write_out(os.path.join(directory, name + ".out"), fill=0.2, seed=seed, materials=3)
+    if textures:
+        arc = BattalionArchive()
+        names = ["tex%02d" % i for i in range(3)] + ["DET%02d" % i for i in range(3)]
+        arc.textures = TextureArchive(b"RXET", b"level", [TextureBW2(b"DXTG", name, b"T2\x00") for name in names], False)
+        arc.sections.append(arc.textures)
+        arc.save(os.path.join(directory, name + "_Level.res.gz"))
+    return data
+
+
+@pytest.fixture
+def levels(tmp_path):
+    directory = str(tmp_path / "CompoundFiles")
+    os.makedirs(directory)
+    return directory, {name: write_level(directory, name, seed) for seed, name in enumerate(("C1_1", "C1_2"))}
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_validate(levels, capsys, jobs):
+    directory, _ = levels
+    assert terrain_cli.main(["validate", directory, "--jobs", str(jobs)]) == 0
+    assert capsys.readouterr().out.splitlines() == ["OK C1_1.out", "OK C1_2.out", "2 levels, 0 failed"]
+
+    os.remove(os.path.join(directory, "C1_2_Level.res.gz"))
+    write_level(directory, "C1_3", 5)
+    with open(os.path.join(directory, "C1_3.out"), "r+b") as f:
+        f.truncate(1000)
+    assert terrain_cli.main(["validate", directory, "--jobs", str(jobs)]) == 1
+    out = capsys.readouterr().out.splitlines()
+    assert out[:3] == ["OK C1_1.out", "FAIL C1_2.out", "    no _Level.res found"]
+    assert out[3] == "FAIL C1_3.out" and out[-1] == "3 levels, 2 failed"
+
+
+def test_regen_collision(levels, tmp_path, capsys):
+    directory, data = levels
+    output = str(tmp_path / "output")
+    assert terrain_cli.main(["regen-collision", directory, "-o", output, "-j", "2"]) == 0
+    assert capsys.readouterr().out.splitlines()[-1] == "2 levels, 0 failed"
+
+    for name, original in data.items():
+        with open(os.path.join(directory, name + ".out"), "rb") as f:
+            assert f.read() == original
+        terrain = terrain_cli.read_terrain(os.path.join(output, name + ".out"))
+        collmap = bw_terrain.CollisionMap()
+        collmap.regenerate_from(terrain.chunkmap, terrain.chunks)
+        assert (terrain.collmap.indices, terrain.collmap.floats) == (collmap.indices, collmap.floats)
+
+
+def test_materials(levels, capsys):
+    directory, _ = levels
+    assert terrain_cli.main(["materials", directory]) == 0
+    out = capsys.readouterr().out.splitlines()
+    assert out[0] == "C1_1.out"
+    assert out[1].split() == ["0", "tex00", "det00", "0", "1", "2", "3"]
+    assert out[3].split() == ["2", "tex02", "det02", "2", "1", "2", "3"]
+    assert out[4] == "C1_2.out"
+
+
+def test_heightmap(levels, capsys):
+    directory, data = levels
+    assert terrain_cli.main(["heightmap", directory, "--jobs", "2"]) == 0
+    assert capsys.readouterr().out.splitlines()[-1] == "2 levels, 0 failed"
+
+    # Rows along y, BWTerrainV2's grid is indexed [x][y]
+    terrain = BWTerrainV2(BytesIO(data["C1_1"]))
+    with open(os.path.join(directory, "C1_1.pgm"), "rb") as f:
+        assert f.readline() == b"P5\n" and f.readline() == b"1024 1024\n" and f.readline() == b"65535\n"
+        heights = numpy.frombuffer(f.read(), dtype=">u2").reshape(1024, 1024)
+    expected = numpy.nan_to_num(terrain.heights[:1024, :1024].T*16)
+    assert terrain.point_exists.any()
+    numpy.testing.assert_array_equal(heights, expected)
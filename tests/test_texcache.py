@@ -0,0 +1,79 @@
+import os
+
+import numpy
+
+from bwterrain import texcache
+from bwterrain.bwarchivelib import Section
+from bwterrain.texcache import TextureCache
+
+
+def random_pixels(seed, width=8, height=4):
+    return numpy.random.default_rng(seed).integers(0, 256, (height, width, 4), dtype=numpy.uint8)
+
+
+def test_texture_key(monkeypatch):
+    tex = Section(b"DXTG", b"header and pixels")
+    key = texcache.texture_key(tex)
+    assert key == texcache.texture_key(Section(b"DXTG", b"header and pixels"))
+    assert key != texcache.texture_key(Section(b"TXET", b"header and pixels"))
+    assert key != texcache.texture_key(Section(b"DXTG", b"header and pixelz"))
+
+    # Decoding changes invalidate every entry
+    monkeypatch.setattr(texcache, "CACHE_VERSION", texcache.CACHE_VERSION + 1)
+    assert texcache.texture_key(tex) != key
+
+
+def test_put_get(tmp_path):
+    cache = TextureCache(str(tmp_path))
+    pixels = random_pixels(1)
+    assert cache.get("missing") is None
+
+    cache.put("a", pixels)
+    cached = cache.get("a")
+    assert cached.dtype == numpy.uint8
+    numpy.testing.assert_array_equal(cached, pixels)
+    assert cache.get("b") is None
+
+    # Broken entries are misses and get removed
+    with open(cache.path("b"), "wb") as f:
+        f.write(b"not numpy")
+    assert cache.get("b") is None
+    assert not os.path.exists(cache.path("b"))
+
+    numpy.save(cache.path("c"), numpy.zeros((4, 4), dtype=numpy.uint8))
+    assert cache.get("c") is None
+    assert not os.path.exists(cache.path("c"))
+
+
+def test_blender_pixels_round_trip():
+    pixels = random_pixels(2)
+    floats = texcache.rgba8_to_pixels(pixels)
+    numpy.testing.assert_array_equal(texcache.pixels_to_rgba8(floats, 8, 4), pixels)
+
+
+def test_least_recently_used_evicted(tmp_path):
+    numpy.save(str(tmp_path / "size.npy"), random_pixels(0))
+    entry_size = os.path.getsize(str(tmp_path / "size.npy"))
+    cache = TextureCache(str(tmp_path / "cache"), max_size=entry_size*3)
+
+    for i, key in enumerate("abc"):
+        cache.put(key, random_pixels(i))
+        os.utime(cache.path(key), (1000 + i, 1000 + i))
+    assert sorted(os.listdir(cache.directory)) == ["a.npy", "b.npy", "c.npy"]
+
+    # A hit makes "a" the most recently used, so "b" goes first
+    assert cache.get("a") is not None
+    cache.put("d", random_pixels(3))
+    assert sorted(os.listdir(cache.directory)) == ["a.npy", "c.npy", "d.npy"]
+
+    # Oldest first, only until the directory fits
+    cache.max_size = entry_size*2
+    for key, mtime in (("a", 2000), ("c", 1000), ("d", 3000)):
+        os.utime(cache.path(key), (mtime, mtime))
+    cache.put("e", random_pixels(4))
+    assert sorted(os.listdir(cache.directory)) == ["d.npy", "e.npy"]
+    numpy.testing.assert_array_equal(cache.get("e"), random_pixels(4))
+
+    cache.clear()
+    assert os.listdir(cache.directory) == []
+
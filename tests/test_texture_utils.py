@@ -0,0 +1,149 @@
+from io import BytesIO
+
+import numpy
+import pytest
+
+from bwterrain.texlib import texture_utils
+from bwterrain.texlib.texture_utils import (ArrayPixelsAdapter, BLOCK_ARRAY_DECODERS, BLOCK_DATA_SIZES,
+                                            BLOCK_HEIGHTS, BLOCK_WIDTHS, ImageFormat, PaletteFormat)
+
+
+SIZES = [(1, 1), (5, 3), (8, 8), (13, 21), (32, 16)]
+C14X2_COLORS = 300
+
+
+def random_colors(rng, image_format):
+    if image_format not in texture_utils.IMAGE_FORMATS_THAT_USE_PALETTES:
+        return []
+    if image_format == ImageFormat.C14X2:
+        count = C14X2_COLORS
+    else:
+        count = texture_utils.MAX_COLORS_FOR_IMAGE_FORMAT[image_format]
+    palette_data = BytesIO(rng.integers(0, 256, count*2, dtype=numpy.uint8).tobytes())
+    return texture_utils.decode_palettes(palette_data, PaletteFormat.RGB5A3, count, image_format)
+
+
+def random_image_data(rng, image_format, width, height):
+    block_width, block_height = BLOCK_WIDTHS[image_format], BLOCK_HEIGHTS[image_format]
+    blocks = ((width+block_width-1)//block_width)*((height+block_height-1)//block_height)
+    data = rng.integers(0, 256, blocks*BLOCK_DATA_SIZES[image_format], dtype=numpy.uint8)
+
+    if image_format == ImageFormat.C14X2:
+        # The block decoder has no color for indexes past the palette, keep the
+        # top two bits random but the index itself in range
+        texels = rng.integers(0, C14X2_COLORS, len(data)//2) | (rng.integers(0, 4, len(data)//2) << 14)
+        data = texels.astype(">u2").view(numpy.uint8)
+    elif image_format == ImageFormat.CMPR:
+        # Equal endpoints and color_0 < color_1 use the 3 color palette
+        subblocks = data.view(texture_utils.CMPR_SUBBLOCK_DTYPE)
+        subblocks["color_1"][::3] = subblocks["color_0"][::3]
+    return BytesIO(data.tobytes())
+
+
+def decode_with_blocks(image_data, colors, image_format, image_width, image_height):
+    # The per-pixel loop decode_image used before decode_image_array
+    block_width = BLOCK_WIDTHS[image_format]
+    block_height = BLOCK_HEIGHTS[image_format]
+    block_data_size = BLOCK_DATA_SIZES[image_format]
+    rgba = numpy.zeros((image_height, image_width, 4), dtype=numpy.int32)
+    offset = 0
+    block_x = 0
+    block_y = 0
+    while block_y < image_height:
+        pixel_color_data = texture_utils.decode_block(image_format, image_data, offset, block_data_size, colors)
+        for i, color in enumerate(pixel_color_data):
+            x = block_x + i % block_width
+            y = block_y + i // block_width
+            if x >= image_width or y >= image_height:
+                continue
+            rgba[image_height - (y+1), x] = color
+
+        offset += block_data_size
+        block_x += block_width
+        if block_x >= image_width:
+            block_x = 0
+            block_y += block_height
+    return rgba
+
+
+@pytest.mark.parametrize("image_format", list(ImageFormat), ids=lambda image_format: image_format.name)
+def test_decode_image_array_matches_block_decoders(image_format):
+    rng = numpy.random.default_rng(image_format.value)
+    colors = random_colors(rng, image_format)
+
+    for width, height in SIZES:
+        image_data = random_image_data(rng, image_format, width, height)
+        expected = decode_with_blocks(image_data, colors, image_format, width, height)
+        rgba = texture_utils.decode_image_array(image_data, colors, image_format, width, height)
+        assert rgba.dtype == numpy.uint8 and rgba.shape == (height, width, 4)
+        numpy.testing.assert_array_equal(rgba, expected)
+
+
+@pytest.mark.parametrize("image_format", list(BLOCK_ARRAY_DECODERS), ids=lambda image_format: image_format.name)
+def test_block_array_decoders_match_block_decoders(image_format):
+    rng = numpy.random.default_rng(100 + image_format.value)
+    colors = random_colors(rng, image_format)
+    block_data_size = BLOCK_DATA_SIZES[image_format]
+    image_data = random_image_data(rng, image_format, BLOCK_WIDTHS[image_format]*5, BLOCK_HEIGHTS[image_format])
+
+    palette = None
+    if colors:
+        palette = numpy.zeros((texture_utils.MAX_COLORS_FOR_IMAGE_FORMAT[image_format], 4), dtype=numpy.int32)
+        palette[:len(colors)] = colors
+    blocks = texture_utils.read_blocks(image_data, 5, block_data_size)
+    rgba = BLOCK_ARRAY_DECODERS[image_format](blocks, palette)
+
+    for i in range(5):
+        expected = texture_utils.decode_block(image_format, image_data, i*block_data_size, block_data_size, colors)
+        numpy.testing.assert_array_equal(rgba[i], expected)
+
+
+def encode_with_blocks(rgba):
+    # The per-block path encode_mipmap_image takes without the array encoder
+    image_height, image_width = rgba.shape[:2]
+    pixels = ArrayPixelsAdapter(rgba)
+    data = b""
+    for block_y in range(0, image_height, 8):
+        for block_x in range(0, image_width, 8):
+            data += texture_utils.encode_image_to_cmpr_block(pixels, {}, block_x, block_y, 8, 8, image_width, image_height)
+    return data
+
+
+def cmpr_images(rng, width, height):
+    shape = (height, width, 4)
+    opaque = rng.integers(0, 256, shape)
+    opaque[:, :, 3] = 255
+    transparent = rng.integers(0, 256, shape)
+    palette = rng.integers(0, 256, (4, 4))
+    palette[:, 3] = (0, 8, 255, 255)
+    gradient = numpy.zeros(shape, dtype=numpy.int64)
+    gradient[:, :, 0] = numpy.arange(width)*255//max(width - 1, 1)
+    gradient[:, :, 1] = (numpy.arange(height)*255//max(height - 1, 1))[:, None]
+    gradient[:, :, 3] = 255
+    near_flat = numpy.full(shape, 128) + rng.integers(0, 3, shape)
+    near_flat[:, :, 3] = 255
+    near_black = rng.integers(0, 6, shape)
+    near_black[:, :, 3] = 255
+    return [opaque, transparent, palette[rng.integers(0, 4, (height, width))], gradient,
+            numpy.full(shape, 255), near_flat, near_black]
+
+
+@pytest.mark.parametrize("size", SIZES + [(64, 64)], ids=lambda size: "%dx%d" % size)
+def test_encode_cmpr_image_matches_block_encoder(size):
+    if texture_utils.PY_FAST_BTI_INSTALLED:
+        pytest.skip("encode_image_to_cmpr_block uses pyfastbti")
+    width, height = size
+    rng = numpy.random.default_rng(width*100 + height)
+
+    for rgba in cmpr_images(rng, width, height):
+        rgba = rgba.astype(numpy.int32)
+        data = texture_utils.encode_cmpr_image(rgba)
+        assert data == encode_with_blocks(rgba)
+
+
+def test_encode_cmpr_image_split_into_tasks(monkeypatch):
+    # Several block rows per thread pool task, with the last task shorter
+    rgba = numpy.random.default_rng(7).integers(0, 256, (40, 24, 4)).astype(numpy.int32)
+    expected = texture_utils.encode_cmpr_image(rgba)
+    monkeypatch.setattr(texture_utils, "CMPR_SUBBLOCKS_PER_TASK", 24)
+    assert texture_utils.encode_cmpr_image(rgba) == expected == encode_with_blocks(rgba)
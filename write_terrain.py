@@ -4,6 +4,7 @@ import os
 print(os.getcwd())
 import importlib
 import timeit
+import numpy
 
 from .bwterrain import texlib
 from .bwterrain import bwtex
@@ -14,35 +15,76 @@ importlib.reload(texlib)
 from . import bwterrainnew
 importlib.reload(bwterrainnew)
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
-from .bwterrainnew import bw_terrain, binaryreader
+from .bwterrainnew import bw_terrain, binaryreader, chunk_grid
 from . import bwterrain
 importlib.reload(bwterrain)
+from .bwterrain import gzipio
+importlib.reload(gzipio)
+from .bwterrain.gzipio import open_path
 from .bwterrain.bwarchivelib import BattalionArchive, TextureBW1
 importlib.reload(bwtex)
 importlib.reload(bwterrainnew)
 importlib.reload(bw_terrain)
+importlib.reload(chunk_grid)
+from .bwterrain import terrain_buffers
+from .terrain_tools import read_vertex_group_weights
 
-def open_path(path, mode="rb"):
-    if path.endswith(".gz"):
-        return gzip.open(path, mode) 
-    else:
-        return open(path, mode) 
     
 
 
 
-def try_get(f, ind):
-    try:
-        val = f(ind)
-    except RuntimeError:
-        return None 
-    else:
-        return val
+def read_mesh_data(mesh):
+    # Vertex colors, loops and UVs of a terrain mesh as ChunkGrid.add_object needs them
+    colors = numpy.empty(len(mesh.color_attributes["Color"].data)*4, dtype=numpy.float32)
+    mesh.color_attributes["Color"].data.foreach_get("color", colors)
+    blend = numpy.empty(len(mesh.color_attributes["Blend"].data)*4, dtype=numpy.float32)
+    mesh.color_attributes["Blend"].data.foreach_get("color", blend)
+    
+    loop_vertices = numpy.empty(len(mesh.loops), dtype=numpy.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vertices)
+    uv_main = numpy.empty(len(mesh.loops)*2, dtype=numpy.float32)
+    mesh.uv_layers['UVMain'].data.foreach_get("uv", uv_main)
+    uv_detail = numpy.empty(len(mesh.loops)*2, dtype=numpy.float32)
+    mesh.uv_layers['UVDetail'].data.foreach_get("uv", uv_detail)
+    
+    return colors, blend, loop_vertices, uv_main, uv_detail
+
 
-def value_test(uvval):
-    val = int(uvval*4096)
-    return 0 <= val <= 2**16-1
+def material_slot_keys(obj):
+    # Textures and values of the object's materials. Spliced chunks get their
+    # material indices by these, so a changed slot means the object has changed.
+    keys = []
+    for slot in obj.material_slots[1:]:
+        material = slot.material
+        try:
+            keys.append((
+                material.node_tree.nodes["texturemain"].image.name.split(".")[0].lower(),
+                material.node_tree.nodes["texturedetail"].image.name.split(".")[0].lower(),
+                material["Value 1"], material["Value 2"], material["Value 3"], material["Value 4"]))
+        except (AttributeError, KeyError):
+            keys.append(None)
+    return keys
+
+
+def data_checksum(obj, size, base_x, base_y, weights, mesh_data):
+    colors, blend, loop_vertices, uv_main, uv_detail = mesh_data
+    return chunk_grid.object_checksum(
+        size, base_x, base_y, material_slot_keys(obj),
+        weights["Height"], weights["Delete"], weights["Material"], colors, blend,
+        loop_vertices, uv_main, uv_detail)
+
+
+def set_chunk_checksums(obj, source, weights):
+    # Marks a terrain object as matching the chunks of source, export splices the
+    # object's chunks from the file as long as neither changes. weights are the
+    # Height, Delete and Material weights as they read back from the object.
+    size = int(len(obj.data.vertices)**0.5)
+    base_x = int((obj.location[0] + 2048))//4
+    base_y = int((obj.location[1] + 2048))//4
+    obj["BWDataChecksum"] = data_checksum(obj, size, base_x, base_y, weights, read_mesh_data(obj.data))
+    obj["BWChunkChecksum"] = source.checksum(base_x, base_y, size)
 
 
 def choose_unique_id(num, ids):
@@ -56,18 +98,14 @@ def export_terrain(dest, dest_res=None, dest_xml=None, dest_preload_xml=None, se
     import_textures = dest_res is not None
 
     if import_textures:
-        with open_path(dest_res) as f:
-            arc = BattalionArchive.from_file_textures(f)
+        arc = BattalionArchive.from_path_textures(dest_res)
         
-        existing_textures = []
-        for tex in arc.textures.textures:
-            name = tex.name.upper()
-            existing_textures.append(name)
+        existing_textures = set(tex.name.upper() for tex in arc.textures.textures)
         
-        with open(dest_xml, "rb") as f:
+        with open_path(dest_xml, "rb") as f:
             level_xml = SimpleLevelXML(f)
         
-        with open(dest_preload_xml, "rb") as f:
+        with open_path(dest_preload_xml, "rb") as f:
             preload_xml = SimpleLevelXML(f)
             
         cummulative_ids = level_xml.ids + preload_xml.ids 
@@ -78,11 +116,14 @@ def export_terrain(dest, dest_res=None, dest_xml=None, dest_preload_xml=None, se
     else:
         arc = None 
 
-    with open(dest, "rb") as f:
-        br = binaryreader.BinaryReader(f.read())
-
-    terrain = br.read_object(bw_terrain.TerrainFile)
-    terrain.clear_chunks()
+    # Everything but the chunks is decoded, chunk records are only copied so that
+    # the ones of unchanged objects can be written back as they are
+    with bw_terrain.LazyTerrainFile(dest) as terrain:
+        for name in terrain.SECTIONS:
+            if name != "chunks":
+                getattr(terrain, name)
+        source = chunk_grid.SourceChunks.from_data(terrain.data, terrain.material_remap)
+        terrain.chunks = bw_terrain.ChunkSection()
 
 
 
@@ -111,6 +152,7 @@ def export_terrain(dest, dest_res=None, dest_xml=None, dest_preload_xml=None, se
             obj_remap_tables.append((objname, obj, remap_table))
 
 
+    source_materials = terrain.materials.materials
     terrain.materials.materials = []
     bw_textures = {}
 
@@ -148,7 +190,8 @@ def export_terrain(dest, dest_res=None, dest_xml=None, dest_preload_xml=None, se
                 bw1tex = bwtex.BW1Texture.from_blender_image(
                     material.node_tree.nodes["texturemain"].image,
                     name1.upper(),
-                    "DXT1")
+                    "DXT1",
+                    autogenmipmaps=True)
                 bw_textures[name1.upper()] = bw1tex
                 newid = choose_unique_id(1100000000, cummulative_ids)
                 cummulative_ids.append(newid)
@@ -158,7 +201,8 @@ def export_terrain(dest, dest_res=None, dest_xml=None, dest_preload_xml=None, se
                 bw2tex = bwtex.BW1Texture.from_blender_image(
                     material.node_tree.nodes["texturedetail"].image,
                     name2.upper(),
-                    "DXT1")
+                    "DXT1",
+                    autogenmipmaps=True)
                 bw_textures[name2.upper()] = bw2tex
                 
                 newid = choose_unique_id(1100000000, cummulative_ids)
@@ -167,10 +211,17 @@ def export_terrain(dest, dest_res=None, dest_xml=None, dest_preload_xml=None, se
                 
     start = timeit.default_timer()
     if import_textures:
-        for texname, tex in bw_textures.items():
+        # from_blender_image already read the pixels, the workers only encode arrays
+        def encode_texture(tex):
             data = BytesIO()
             tex.write(data)
             data.seek(0)
+            return data 
+        
+        with ThreadPoolExecutor() as executor:
+            encoded = list(executor.map(encode_texture, bw_textures.values()))
+        
+        for data in encoded:
             bwtex_entry = TextureBW1.from_file_headerless(data)
             arc.textures.textures.append(bwtex_entry)
             print("added", bwtex_entry.name)
@@ -183,6 +234,19 @@ def export_terrain(dest, dest_res=None, dest_xml=None, dest_preload_xml=None, se
 
 
 
+    # Spliced chunks keep the textures they had in the file, their materials need
+    # to be exported with the same textures and values
+    def material_key(mat):
+        return (mat.mat_main.strip(b"\x00").lower(), mat.mat_detail.strip(b"\x00").lower(),
+                mat.unk_1, mat.unk_2, mat.unk_3, mat.unk_4)
+    
+    exported_materials = {}
+    for i, mat in enumerate(terrain.materials.materials):
+        exported_materials.setdefault(material_key(mat), i)
+    source_remap = [exported_materials.get(material_key(mat), -1) for mat in source_materials]
+    
+    grid = chunk_grid.ChunkGrid(source)
+    exported = []
     for objname, obj, remap in obj_remap_tables:
         if obj.get("BattalionWars", False):
             vtx_count = len(obj.data.vertices)
@@ -194,141 +258,39 @@ def export_terrain(dest, dest_res=None, dest_xml=None, dest_preload_xml=None, se
             base_y = int((obj.location[1] + 2048))//4
             
             print(obj.name, base_x, base_y)
-            get_height = obj.vertex_groups["Height"].weight
-            get_mat_index = obj.vertex_groups["Material"].weight
-            add_mat = obj.vertex_groups["Material"].add
-            get_delete = obj.vertex_groups["Delete"].weight
-            vtx_color = obj.data.color_attributes["Color"].data
-            blend = obj.data.color_attributes["Blend"].data
+            weights = read_vertex_group_weights(obj, ("Height", "Delete", "Material"))
+            mesh_data = read_mesh_data(obj.data)
+            colors, blend, loop_vertices, uv_main, uv_detail = mesh_data
             
-            detail = obj.data.uv_layers['UVDetail']
-            main = obj.data.uv_layers['UVMain']
+            exported.append((obj, base_x, base_y, size))
+            checksum = data_checksum(obj, size, base_x, base_y, weights, mesh_data)
             
-            chunk_delete = []
-            chunk_add = []
-            for ix in range(size):
-                x = base_x + ix# - (base_x + ix)//4
-                
-                for iy in range(size):
-                    y = base_y + iy# - (base_y + iy)//4
-                    
-                    if 0 <= base_x + ix < 1024 and 0 <= base_y + iy < 1024:
-                        cx = y // 16 
-                        cy = x // 16
-                        
-                        tile_x = x % 16 
-                        tile_y = y % 16
-                        
-                        in_tile_x = x % 4 
-                        in_tile_y = y % 4
-                        
-                        local_index = iy + ix*size
-                        deleted = try_get(get_delete, (iy//16)*16 + (ix//16)*16*size)
-                        if deleted is None or deleted <= 0.5:
-                            chunk_add.append(local_index)
-                            
-                            chunk = terrain.get_chunk(cx, cy, create_if_no_exist=True)
-                            if chunk is not None:
-                                tile = chunk.tiles[tile_x//4 + (tile_y//4)*4]
-                                
-                                
-                                
-                                if in_tile_x == 0 and in_tile_y == 0:
-                                    mat_indices = {}
-                                    
-                                    """for iiy in range(4):
-                                        for iix in range(4):
-                                            
-                                            material = try_get(get_mat_index, (iy+iiy) + (ix+iix)*size)
-                                            if material is not None:
-                                                matindex = int(round(material*100))
-                                                if matindex not in mat_indices:
-                                                    mat_indices[matindex] = 1
-                                                else:
-                                                    mat_indices[matindex] += 1
-                                    biggest = 0 
-                                    material = None 
-                                    for mat, count in mat_indices.items():
-                                        if count > biggest:
-                                            biggest = count 
-                                            material = mat """
-                                    material = try_get(get_mat_index, (iy) + (ix)*size)
-                                    if material is not None:
-                                        material = int(round(material*100))
-                                        tile.material_index = remap[material]
-                                        add_mat([(iy+iiy) + (ix+iix)*size for iiy in range(4) for iix in range(4)], material/100.0, "REPLACE")
-                                                
-                                
-                                height = try_get(get_height, local_index)
-                                if height is not None:
-                                    tile.heights[in_tile_x + in_tile_y*4] = int(height*512*16) 
-                                
-                                color = vtx_color[local_index].color
-                                alpha = blend[local_index].color[3]
-                                
-                                orig_color = tile.colors[in_tile_x + in_tile_y*4]
-                                orig_color.r = int(color[0]*255)
-                                orig_color.g = int(color[1]*255)
-                                orig_color.b = int(color[2]*255)
-                                orig_color.a = int(alpha*255)
-                        else:
-                            terrain.set_chunk_exist_status(cx, cy, False)
-                            chunk_delete.append(local_index)
+            # Objects that weren't edited since they were imported from or exported to
+            # this file keep their chunks from the file
+            if (obj.get("BWDataChecksum") == checksum 
+                    and obj.get("BWChunkChecksum") == source.checksum(base_x, base_y, size)
+                    and grid.splice(base_x, base_y, size, source_remap)):
+                print(obj.name, "unchanged")
+                continue 
             
-            obj.vertex_groups["Delete"].add(chunk_delete, 1.0, "REPLACE")
-            obj.vertex_groups["Delete"].add(chunk_add, 0.0, "REPLACE")
+            chunk_delete, chunk_add, material_weights = grid.add_object(
+                obj.name, size, base_x, base_y, remap,
+                weights["Height"], weights["Delete"], weights["Material"], colors, blend,
+                loop_vertices, uv_main, uv_detail)
             
-            for face in obj.data.polygons:
-                for vtx_i, loop_i in zip(face.vertices, face.loop_indices):
-                    local_x = vtx_i//size
-                    local_y = vtx_i%size
-                    
-                    x = base_x + local_x 
-                    y = base_y + local_y
-                    
-                    cx = y // 16 
-                    cy = x // 16
-                    
-                    if 0 <= x < 1024 and 0 <= y < 1024:
-                        chunk = terrain.get_chunk(cx, cy)
-                        
-                        if chunk is not None:
-                            tile_x = x % 16 
-                            tile_y = y % 16
-                            
-                            in_tile_x = x % 4 
-                            in_tile_y = y % 4
-                            
-                            
-                            tile = chunk.tiles[tile_x//4 + (tile_y//4)*4]
-                        
-                            uv_detail = detail.data[loop_i].uv
-                            
-                            
-                            uv = tile.detail_coordinates[(in_tile_x) + (in_tile_y)*4]
-                            uv.x, uv.y = uv_detail
-                            uv.y = 1 - uv.y
-                            
-                            if not (value_test(uv.x) and value_test(uv.y)):
-                                tile_loc_x = local_x*4
-                                tile_loc_y = local_y*4
-                                print(uv_detail, "->", uv)
-                                raise RuntimeError(f"Tile has Detail UVs out of range: {tile_loc_x},{tile_loc_y} in {obj.name}")
-                            
-                            if (in_tile_x == 0 or in_tile_x == 3) and (in_tile_y == 0 or in_tile_y == 3):
-                                uv_main = main.data[loop_i].uv
-                                iix = (in_tile_x // 3)
-                                iiy = in_tile_y // 3
-                                uv = tile.surface_coordinates[iix + iiy*2]
-                                uv.x, uv.y = uv_main
-                                uv.y = 1 - uv.y
-                                
-                                if not (value_test(uv.x) and value_test(uv.y)):
-                                    tile_loc_x = local_x*4
-                                    tile_loc_y = local_y*4
-                                    print(uv_main, "->", uv)
-                                    raise RuntimeError(f"Tile has Main UVs out of range: {tile_loc_x},{tile_loc_y} in {obj.name}")
-                                
+            for value, indices in terrain_buffers.group_by_value(material_weights):
+                obj.vertex_groups["Material"].add(indices.tolist(), value, "REPLACE")
+            obj.vertex_groups["Delete"].add(chunk_delete.tolist(), 1.0, "REPLACE")
+            obj.vertex_groups["Delete"].add(chunk_add.tolist(), 0.0, "REPLACE")
+            
+            # Weights as they read back after the changes above (stored as 32 bit floats)
+            changed = ~numpy.isnan(material_weights)
+            weights["Material"][changed] = numpy.float32(material_weights[changed])
+            weights["Delete"][chunk_delete] = 1.0
+            weights["Delete"][chunk_add] = 0.0
+            obj["BWDataChecksum"] = data_checksum(obj, size, base_x, base_y, weights, mesh_data)
+    
+    grid.apply_to(terrain)
     print(len(terrain.materials.materials), "Materials")
     """
     obj = bpy.context.selected_objects[0]
@@ -380,11 +342,7 @@ def export_terrain(dest, dest_res=None, dest_xml=None, dest_preload_xml=None, se
         level_xml.write(tmp_xml)
         tmp_xml.seek(0)
         
-        tmp_arc = BytesIO()
-        arc.write(tmp_arc)
-        tmp_arc.seek(0)
-        with open_path(dest_res, "wb") as f:
-            f.write(tmp_arc.getvalue())
+        arc.save(dest_res)
         print("Saved res to", dest_res)
         
         with open_path(dest_xml, "wb") as f:
@@ -394,6 +352,10 @@ def export_terrain(dest, dest_res=None, dest_xml=None, dest_preload_xml=None, se
     with open(dest, "wb") as f:
         f.write(new.getvalue())
         print("Saved out to", dest)
+    
+    written = chunk_grid.SourceChunks.from_data(new.getvalue())
+    for obj, base_x, base_y, size in exported:
+        obj["BWChunkChecksum"] = written.checksum(base_x, base_y, size)
 """        
 if __name__ == "__main__":
     outpathBW = r"D:\Wii games\BattWars\P-G8WP\files\Data\CompoundFiles\C1_OnPatrol.out"